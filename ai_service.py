@@ -1,14 +1,26 @@
+from __future__ import annotations
+
 import asyncio
 import logging
 import mimetypes
 import os
 import time
 import uuid
+from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import scratch
+import tracing
+from capture import media_info
+from resources import run_blocking
 
-from google import genai
-from google.genai import types as genai_types
+# google.genai takes a noticeable part of a second to import, so it is not
+# imported at startup; resources.warm_gemini_clients loads it in the background
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types as genai_types
 
 # Removed global client - each bot now has its own client instance
 # Global client was removed to support per-session API keys
@@ -16,6 +28,25 @@ from google.genai import types as genai_types
 # Load system prompt from file
 SYSTEM_PROMPT_PATH = "system_prompt.txt"
 
+# Files uploaded to Gemini that are not deleted yet (file name -> (client, file)), cleaned up on shutdown
+_active_uploads: Dict[str, Tuple[genai.Client, genai_types.File]] = {}
+
+GEMINI_REQUEST_SECONDS = metrics.histogram(
+    "gemini_request_seconds", "Duration of call_gemini_api including uploads and retries", ["model", "outcome"]
+)
+GEMINI_RETRIES = metrics.counter("gemini_retries_total", "Gemini calls retried after a transient error", ["model"])
+GEMINI_UPLOAD_SECONDS = metrics.histogram("gemini_upload_seconds", "Duration of a file upload until it is ACTIVE", ["outcome"])
+GEMINI_TOKENS = metrics.counter("gemini_tokens_total", "Tokens used by Gemini calls", ["model", "kind"])
+
+# Prices in USD per 1M tokens: (input, cached input, output incl. thinking) for
+# prompts up to 200k tokens. Taken from the public Gemini API price list,
+# update when it changes
+MODEL_PRICES = {
+    "gemini-2.5-pro": (1.25, 0.31, 10.0),
+    "gemini-flash-latest": (0.30, 0.075, 2.50),
+    "gemini-flash-lite-latest": (0.10, 0.025, 0.40),
+}
+
 
 def load_system_prompt() -> str:
     """Load system prompt from external file"""
@@ -31,13 +62,64 @@ def load_system_prompt() -> str:
 
 
 class GeminiModel(Enum):
-    # FLASH = "gemini-flash-lite-latest"
+    FLASH_LITE = "gemini-flash-lite-latest"
     FLASH = "gemini-flash-latest"
     FLASH_THINKING = "gemini-2.5-pro"
     # FLASH_MULTIMODAL = "gemini-flash-latest"
     FLASH_MULTIMODAL = "gemini-2.5-pro"
 
 
+class GeminiError(str):
+    """
+    Error text that call_gemini_api returns instead of an answer
+
+    It is shown to the user like an answer; callers tell it apart with
+    isinstance rather than by its wording.
+    """
+
+
+@dataclass
+class GeminiUsage:
+    """Token usage of a single Gemini call"""
+    model: str
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    thinking_tokens: int = 0
+    latency: float = 0.0
+    
+    @property
+    def cost(self) -> float:
+        """Estimated cost in USD (0 for models without a known price)"""
+        return estimate_cost(self.model, self.input_tokens, self.cached_tokens, self.output_tokens, self.thinking_tokens)
+    
+    @classmethod
+    def from_response(cls, model: str, response, latency: float) -> "GeminiUsage":
+        """Read usage_metadata of a generate_content response (missing counts are 0)"""
+        meta = getattr(response, "usage_metadata", None)
+        return cls(
+            model=model,
+            input_tokens=getattr(meta, "prompt_token_count", None) or 0,
+            cached_tokens=getattr(meta, "cached_content_token_count", None) or 0,
+            output_tokens=getattr(meta, "candidates_token_count", None) or 0,
+            thinking_tokens=getattr(meta, "thoughts_token_count", None) or 0,
+            latency=latency,
+        )
+
+
+def estimate_cost(model: str, input_tokens: int, cached_tokens: int, output_tokens: int, thinking_tokens: int) -> float:
+    """Estimated cost of a call in USD based on MODEL_PRICES"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    return (
+        (input_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + (output_tokens + thinking_tokens) * output_price
+    ) / 1_000_000
+
+
 def get_mime_type(file_path: str) -> str:
     """
     Determine MIME type for a file using mimetypes library with fallback logic
@@ -84,35 +166,43 @@ async def _upload_and_wait_for_file(client: genai.Client, file_path: str) -> Tup
     Returns:
         Tuple of (uploaded file object, error message if any)
     """
-    loop = asyncio.get_event_loop()
-    
+    started = time.perf_counter()
+    outcome = "error"
     try:
         # Upload file
-        uploaded_file = await loop.run_in_executor(
-            None, 
-            lambda c=client, p=file_path: c.files.upload(file=p)
-        )
+        with tracing.span("gemini.upload", size=os.path.getsize(file_path)):
+            uploaded_file = await run_blocking(
+                "gemini",
+                lambda c=client, p=file_path: c.files.upload(file=p)
+            )
+        _active_uploads[uploaded_file.name] = (client, uploaded_file)
         
         # Wait for file to become ACTIVE (max 15 seconds)
         max_attempts = 30
-        for attempt in range(max_attempts):
-            file_status = await loop.run_in_executor(
-                None, 
-                lambda c=client, n=uploaded_file.name: c.files.get(name=n)
-            )
-            
-            if getattr(file_status, "state", None) == "ACTIVE":
-                logging.info(f"File uploaded and ACTIVE: {uploaded_file.name}")
-                return uploaded_file, None
-            
-            await asyncio.sleep(0.5)
+        with tracing.span("gemini.wait_active") as wait_span:
+            for attempt in range(max_attempts):
+                file_status = await run_blocking(
+                    "gemini",
+                    lambda c=client, n=uploaded_file.name: c.files.get(name=n)
+                )
+                
+                if getattr(file_status, "state", None) == "ACTIVE":
+                    logging.info(f"File uploaded and ACTIVE: {uploaded_file.name}")
+                    wait_span.set(polls=attempt + 1)
+                    outcome = "ok"
+                    return uploaded_file, None
+                
+                await asyncio.sleep(0.5)
         
         # Timeout
+        outcome = "timeout"
         return None, f"Файл {uploaded_file.name} не стал ACTIVE за {max_attempts * 0.5} секунд"
         
     except Exception as e:
         logging.error(f"Error uploading file {file_path}: {str(e)}")
         return None, f"Ошибка при загрузке файла {file_path}: {str(e)}"
+    finally:
+        GEMINI_UPLOAD_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
 
 
 async def _upload_media_files(client: genai.Client, media_paths: List[str], mime_types: Optional[List[str]] = None) -> Tuple[List[genai_types.Part], List[genai_types.File], Optional[str]]:
@@ -127,6 +217,8 @@ async def _upload_media_files(client: genai.Client, media_paths: List[str], mime
     Returns:
         Tuple of (list of content parts, list of uploaded files, error message if any)
     """
+    from google.genai import types as genai_types
+    
     parts = []
     uploaded_files = []
     
@@ -169,32 +261,44 @@ async def _cleanup_uploaded_files(client: genai.Client, uploaded_files: List[gen
         return
     
     logging.info(f"Cleaning up {len(uploaded_files)} uploaded file(s)...")
-    loop = asyncio.get_event_loop()
     
     for file in uploaded_files:
         try:
-            await loop.run_in_executor(None, lambda c=client, f=file: c.files.delete(f.name))
+            await run_blocking("gemini", lambda c=client, f=file: c.files.delete(name=f.name))
             logging.info(f"Deleted uploaded file: {file.name}")
         except Exception as e:
             logging.error(f"Error deleting uploaded file {file.name}: {e}")
+        finally:
+            _active_uploads.pop(file.name, None)
 
 
-def _build_generation_config(model: GeminiModel, is_media_request: bool = False) -> Tuple[str, genai_types.GenerateContentConfig]:
+async def cleanup_pending_uploads():
+    """Delete all files uploaded to Gemini by this process that were not cleaned up yet"""
+    by_client: Dict[int, Tuple[genai.Client, List[genai_types.File]]] = {}
+    for client, file in list(_active_uploads.values()):
+        by_client.setdefault(id(client), (client, []))[1].append(file)
+    
+    for client, files in by_client.values():
+        await _cleanup_uploaded_files(client, files)
+
+
+def _build_generation_config(model: GeminiModel, use_system_prompt: bool = True) -> Tuple[str, genai_types.GenerateContentConfig]:
     """
     Build generation configuration for Gemini API
     
     Args:
         model: The model to use
-        is_media_request: Whether this is a media analysis request
+        use_system_prompt: Whether to add the bot's system prompt
         
     Returns:
         Tuple of (model name, GenerateContentConfig object)
     """
-    # Select model
-    api_model = GeminiModel.FLASH_MULTIMODAL.value if is_media_request else model.value
+    from google.genai import types as genai_types
+    
+    api_model = model.value
     
     # Load system prompt
-    system_prompt_text = load_system_prompt()
+    system_prompt_text = load_system_prompt() if use_system_prompt else ""
     
     config_args = {
         "temperature": 1,
@@ -243,14 +347,18 @@ def _is_transient_error(e: Exception) -> bool:
     )
 
 
+@tracing.traced("gemini.call")
 async def call_gemini_api(
     client: genai.Client,
     query: str,
-    model: GeminiModel = GeminiModel.FLASH,
+    model: Optional[GeminiModel] = None,
     media_paths: Optional[List[str]] = None,
     mime_types: Optional[List[str]] = None,
     is_media_request: bool = False,
+    use_system_prompt: bool = True,
+    history: Optional[List[Tuple[str, str]]] = None,
     retries: int = 3,
+    on_usage: Optional[Callable[[GeminiUsage], None]] = None,
 ) -> str:
     """
     Call Gemini API with the given query text and model asynchronously
@@ -258,17 +366,29 @@ async def call_gemini_api(
     Args:
         client: An initialized google.genai.Client instance
         query: The text query to process
-        model: The Gemini model to use
+        model: The Gemini model to use (FLASH_MULTIMODAL for media requests and FLASH otherwise by default)
         media_paths: Optional list of paths to media files to include
         mime_types: Optional list of MIME types for the media files
         is_media_request: Flag to indicate if this is a media analysis request
+        use_system_prompt: Whether to add the bot's system prompt (off for service tasks like transcription)
+        history: Earlier conversation turns as (role, text) pairs with role "user" or "model";
+            the query and media form the final user turn
         retries: Number of retries for API calls
+        on_usage: Optional callback receiving the token usage of a successful call
 
     Returns:
-        Response text from Gemini
+        Response text from Gemini, or a GeminiError describing why there is none
     """
+    from google.genai import types as genai_types
+    
+    if model is None:
+        model = GeminiModel.FLASH_MULTIMODAL if is_media_request else GeminiModel.FLASH
     parts = []
     uploaded_files = []
+    # Replaced with the model actually used once the config is built
+    api_model = model.value
+    started = time.perf_counter()
+    outcome = "error"
     
     try:
         # Upload media files if provided
@@ -277,7 +397,8 @@ async def call_gemini_api(
             media_parts, uploaded_files, error = await _upload_media_files(client, media_paths, mime_types)
             
             if error:
-                return f"Ошибка: {error}"
+                outcome = "upload_error"
+                return GeminiError(f"Ошибка: {error}")
             
             parts.extend(media_parts)
         
@@ -286,32 +407,39 @@ async def call_gemini_api(
             parts.append(genai_types.Part.from_text(text=query))
         
         if not parts:
-            return "Ошибка: Не удалось подготовить контент для запроса (нет текста или медиа)."
+            return GeminiError("Ошибка: Не удалось подготовить контент для запроса (нет текста или медиа).")
         
-        # Build content
-        contents = [genai_types.Content(role="user", parts=parts)]
+        # Build content: earlier turns, then the request itself
+        contents = [
+            genai_types.Content(role=role, parts=[genai_types.Part.from_text(text=text)])
+            for role, text in history or []
+        ]
+        contents.append(genai_types.Content(role="user", parts=parts))
         
         # Get generation config
-        api_model, gen_config = _build_generation_config(model, is_media_request)
+        api_model, gen_config = _build_generation_config(model, use_system_prompt)
         
         logging.info(f"Sending request to Gemini model {api_model} with {len(parts)} parts.")
         
         # Call API with retries
-        loop = asyncio.get_event_loop()
-        
         for attempt in range(retries):
             try:
-                result = await loop.run_in_executor(
-                    None,
-                    lambda c=client, m=api_model, ct=contents, cfg=gen_config: c.models.generate_content(
-                        model=m,
-                        contents=ct,
-                        config=cfg,
-                    ),
-                )
+                with tracing.span("gemini.generate", model=api_model, attempt=attempt + 1) as generate_span:
+                    result = await run_blocking(
+                        "gemini",
+                        lambda c=client, m=api_model, ct=contents, cfg=gen_config: c.models.generate_content(
+                            model=m,
+                            contents=ct,
+                            config=cfg,
+                        ),
+                    )
                 
                 response_text = result.text
                 logging.info("Received response from Gemini.")
+                outcome = "ok"
+                usage = GeminiUsage.from_response(api_model, result, time.perf_counter() - started)
+                generate_span.set(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens)
+                _report_usage(usage, on_usage)
                 
                 # Add thinking hat emoji for thinking model
                 if model == GeminiModel.FLASH_THINKING and not is_media_request:
@@ -322,34 +450,82 @@ async def call_gemini_api(
                 if _is_transient_error(e):
                     logging.warning(f"Gemini transient error (attempt {attempt + 1}/{retries}): {e}")
                     if attempt < retries - 1:
+                        GEMINI_RETRIES.inc(model=api_model)
                         await asyncio.sleep(2 ** attempt)
                         continue
-                    return "⚠️ ИИ временно недоступен (перегрузка или лимиты). Попробуйте позже."
+                    outcome = "unavailable"
+                    return GeminiError("⚠️ ИИ временно недоступен (перегрузка или лимиты). Попробуйте позже.")
                 raise
     except Exception as e:
         logging.error(f"Error calling Gemini API: {str(e)}")
         error_message = f"Ошибка при вызове Gemini API: {str(e)}"
         if media_paths:
             error_message += f"\nФайлы: {media_paths}"
-        return error_message
+        return GeminiError(error_message)
         
     finally:
         # Clean up uploaded files
-        await _cleanup_uploaded_files(client, uploaded_files)
+        if uploaded_files:
+            with tracing.span("gemini.cleanup", files=len(uploaded_files)):
+                await _cleanup_uploaded_files(client, uploaded_files)
+        GEMINI_REQUEST_SECONDS.observe(time.perf_counter() - started, model=api_model, outcome=outcome)
+        call_span = tracing.current_span()
+        if call_span is not None:
+            call_span.set(model=api_model, outcome=outcome)
+
+
+def _report_usage(usage: GeminiUsage, on_usage: Optional[Callable[[GeminiUsage], None]]):
+    """Count tokens in metrics and pass the usage to the caller's callback"""
+    for kind in ("input", "cached", "output", "thinking"):
+        GEMINI_TOKENS.inc(getattr(usage, f"{kind}_tokens"), model=usage.model, kind=kind)
+    
+    if on_usage is not None:
+        try:
+            on_usage(usage)
+        except Exception as e:
+            # Accounting must never break the answer
+            logging.error(f"Error recording Gemini usage: {e}")
 
 
-async def download_media(client, message, download_dir="data/media"):
+@tracing.traced("telegram.download")
+async def download_media(client, message, background: bool = False):
     """
-    Download media from a Telegram message
+    Download media from a Telegram message into the media scratch store
+    
+    The file is tracked until it is removed with remove_media_file, so files
+    left behind by interrupted requests are removed on shutdown.
     
     Args:
         client: Pyrogram client
         message: Message object with media
-        download_dir: Directory to save downloaded media
+        background: Speculative or background download, uses the scratch store's background slots
         
     Returns:
         Path to downloaded file or None
+    
+    Raises:
+        scratch.MediaRejected: The file is too large or the scratch store is full
     """
+    size = (media_info(message) or {}).get("size")
+    async with scratch.STORE.download(size, background) as reservation:
+        path = await _download_media(client, message, reservation.directory)
+        if path:
+            reservation.keep(path)
+    return path
+
+
+def remove_media_file(path: str):
+    """Remove a downloaded media file"""
+    scratch.STORE.release(path)
+
+
+def cleanup_downloaded_media():
+    """Remove all downloaded media files that were not removed yet"""
+    scratch.STORE.cleanup()
+
+
+async def _download_media(client, message, download_dir: str):
+    """Download media from a Telegram message to download_dir (see download_media)"""
     os.makedirs(download_dir, exist_ok=True)
     unique_id = uuid.uuid4().hex[:8]
     
@@ -374,6 +550,13 @@ async def download_media(client, message, download_dir="data/media"):
             file_name=f"{download_dir}/voice_{message.id}_{unique_id}.ogg"
         )
     
+    # Video note
+    if getattr(message, "video_note", None):
+        return await client.download_media(
+            message.video_note, 
+            file_name=f"{download_dir}/video_note_{message.id}_{unique_id}.mp4"
+        )
+    
     # Audio
     if message.audio:
         ext = ".ogg"  # default
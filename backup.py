@@ -0,0 +1,339 @@
+"""
+Online backups of the bot databases.
+
+While the bots run, BackupScheduler copies every bot database with SQLite's
+online backup API every BACKUP_INTERVAL seconds, skipping databases that did
+not change since their last snapshot. The copy runs in the shared I/O
+executor in steps of BACKUP_STEP_PAGES pages with a pause between steps, so
+it costs little I/O and never blocks the event loop; as the databases use a
+write-ahead log, the copy does not block writers either. Each copy is checked
+with PRAGMA quick_check, compressed and stored as
+<BACKUP_DIR>/<name>/<name>-<time>.db.gz; only the newest BACKUP_KEEP
+snapshots of a database are kept.
+
+Command line (from the repository root, stop the bot before restoring):
+
+    python backup.py list [data/backups]
+    python backup.py create data/mybot.db
+    python backup.py verify data/backups/mybot/mybot-20250101-120000.db.gz
+    python backup.py restore data/backups/mybot/mybot-20250101-120000.db.gz data/mybot.db
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+from resources import run_blocking
+
+# Directory of the snapshots; backups are disabled if empty
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "")
+# Seconds between backups of a database
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", str(6 * 3600)))
+# Snapshots kept per database
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+# Pages copied per step and pause between steps (seconds)
+BACKUP_STEP_PAGES = int(os.environ.get("BACKUP_STEP_PAGES", "256"))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", "0.02"))
+
+# A step-wise copy restarts when the database is written to; after this many
+# restarts the rest is copied in one step (a read snapshot, writers go on)
+MAX_RESTARTS = 3
+
+SUFFIX = ".db.gz"
+
+BACKUP_SECONDS = metrics.histogram("backup_seconds", "Duration of database backups", ["outcome"])
+BACKUPS = metrics.counter("backups_total", "Database backups by outcome", ["outcome"])
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _copy(source_path: str, target_path: str, pages: int, pause: float) -> int:
+    """
+    Copy a live database with the online backup API
+
+    Returns:
+        Number of restarts caused by concurrent writes
+    """
+    restarts = 0
+    last_remaining: Optional[int] = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=pages, progress=progress, sleep=pause)
+            except _TooManyRestarts:
+                source.backup(target, pages=-1)
+            # Self-contained file without a write-ahead log
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return restarts
+
+
+def check_database(path: str) -> Dict[str, int]:
+    """
+    Check the integrity of a database file
+
+    Returns:
+        Row count of every table
+
+    Raises:
+        ValueError: The database is damaged
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise ValueError(f"integrity check failed: {result}")
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+        return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+    except sqlite3.DatabaseError as e:
+        raise ValueError(str(e)) from e
+    finally:
+        conn.close()
+
+
+def _gzip(source_path: str, target_path: str):
+    """Compress a file, replacing target_path only once it is complete"""
+    partial = target_path + ".partial"
+    with open(source_path, "rb") as src, gzip.open(partial, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(partial, target_path)
+
+
+def _gunzip(source_path: str, target_path: str):
+    with gzip.open(source_path, "rb") as src, open(target_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def snapshot_name(db_path: str) -> str:
+    """Name of the snapshots of a database (file name without extension)"""
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+def list_snapshots(backup_dir: str, name: str) -> List[str]:
+    """Snapshots of a database, oldest first"""
+    return sorted(glob.glob(os.path.join(backup_dir, name, f"{glob.escape(name)}-*{SUFFIX}")))
+
+
+def _changed_since(db_path: str, snapshot: str) -> bool:
+    """Whether the database (or its write-ahead log) was modified after the snapshot was taken"""
+    taken = os.path.getmtime(snapshot)
+    return any(os.path.exists(path) and os.path.getmtime(path) >= taken for path in (db_path, db_path + "-wal"))
+
+
+def backup_database(db_path: str, backup_dir: str, keep: int = BACKUP_KEEP,
+                    pages: int = BACKUP_STEP_PAGES, pause: float = BACKUP_STEP_PAUSE) -> Tuple[str, int]:
+    """
+    Write a verified, compressed snapshot of a database and remove old ones (blocking)
+
+    Returns:
+        Path of the snapshot and the number of restarts of the copy
+    """
+    name = snapshot_name(db_path)
+    directory = os.path.join(backup_dir, name)
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    target = os.path.join(directory, f"{name}-{stamp}{SUFFIX}")
+
+    started = time.time()
+    fd, copy_path = tempfile.mkstemp(prefix=f"{name}-", suffix=".db", dir=directory)
+    os.close(fd)
+    try:
+        restarts = _copy(db_path, copy_path, pages, pause)
+        check_database(copy_path)
+        _gzip(copy_path, target)
+    finally:
+        os.remove(copy_path)
+    # The snapshot is dated by the start of the copy, so writes made during it count as changes
+    os.utime(target, (started, started))
+
+    for old in list_snapshots(backup_dir, name)[:-max(1, keep)]:
+        os.remove(old)
+    return target, restarts
+
+
+class BackupScheduler:
+    """Periodic online backups of the databases of the running bots"""
+
+    def __init__(self, databases: Callable[[], Iterable[Tuple[str, str]]], backup_dir: str = BACKUP_DIR,
+                 interval: float = BACKUP_INTERVAL, keep: int = BACKUP_KEEP):
+        """
+        Args:
+            databases: Returns (bot name, database path) pairs of the running bots
+            backup_dir: Directory of the snapshots
+            interval: Seconds between backups of a database
+            keep: Snapshots kept per database
+        """
+        self.databases = databases
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+
+    async def run(self):
+        """Back up the databases every interval seconds until cancelled"""
+        logging.info(f"Backing up databases to {self.backup_dir} every {self.interval:.0f}s")
+        while True:
+            await asyncio.sleep(self._delay())
+            for name, db_path in list(self.databases()):
+                await self.backup(name, db_path)
+
+    def _delay(self) -> float:
+        """Seconds until the oldest latest snapshot is due (at least a minute, so startup is not slowed down)"""
+        due = []
+        for _, db_path in self.databases():
+            snapshots = list_snapshots(self.backup_dir, snapshot_name(db_path))
+            due.append(os.path.getmtime(snapshots[-1]) + self.interval - time.time() if snapshots else 0)
+        return max(60.0, min(due, default=self.interval))
+
+    async def backup(self, name: str, db_path: str) -> Optional[str]:
+        """
+        Back up one database if it is due and changed
+
+        Returns:
+            Path of the new snapshot, or None if it was skipped or failed
+        """
+        snapshots = list_snapshots(self.backup_dir, snapshot_name(db_path))
+        if snapshots and (time.time() - os.path.getmtime(snapshots[-1]) < self.interval
+                          or not _changed_since(db_path, snapshots[-1])):
+            return None
+        if not os.path.exists(db_path):
+            return None
+
+        started = time.perf_counter()
+        try:
+            path, restarts = await run_blocking("io", backup_database, db_path, self.backup_dir, self.keep)
+        except Exception as e:
+            BACKUPS.inc(outcome="error", bot=name)
+            BACKUP_SECONDS.observe(time.perf_counter() - started, outcome="error", bot=name)
+            logging.error(f"[{name}] Backup of {db_path} failed: {e}")
+            return None
+
+        elapsed = time.perf_counter() - started
+        BACKUPS.inc(outcome="ok", bot=name)
+        BACKUP_SECONDS.observe(elapsed, outcome="ok", bot=name)
+        logging.info(f"[{name}] Backed up {db_path} to {path} in {elapsed:.1f}s ({os.path.getsize(path)} bytes, {restarts} restart(s))")
+        return path
+
+
+# --- Command line ---
+
+def _verify(snapshot: str) -> Optional[Dict[str, int]]:
+    with tempfile.TemporaryDirectory(prefix="buisbot-restore-") as work_dir:
+        path = os.path.join(work_dir, "check.db")
+        try:
+            _gunzip(snapshot, path)
+            return check_database(path)
+        except (OSError, EOFError, ValueError) as e:
+            print(f"❌ {snapshot}: {e}", file=sys.stderr)
+            return None
+
+
+def _list_command(args) -> int:
+    if not os.path.isdir(args.backup_dir):
+        print(f"Нет каталога {args.backup_dir}", file=sys.stderr)
+        return 1
+    for name in sorted(os.listdir(args.backup_dir)):
+        for snapshot in list_snapshots(args.backup_dir, name):
+            taken = datetime.datetime.fromtimestamp(os.path.getmtime(snapshot)).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{snapshot}  {taken}  {os.path.getsize(snapshot)} bytes")
+    return 0
+
+
+def _create_command(args) -> int:
+    path, restarts = backup_database(args.database, args.backup_dir, args.keep)
+    print(f"✅ {path} ({os.path.getsize(path)} bytes, {restarts} restart(s))")
+    return 0
+
+
+def _verify_command(args) -> int:
+    failed = 0
+    for snapshot in args.snapshots:
+        counts = _verify(snapshot)
+        if counts is None:
+            failed += 1
+            continue
+        print(f"✅ {snapshot}: " + ", ".join(f"{table} {count}" for table, count in counts.items()))
+    return 1 if failed else 0
+
+
+def _restore_command(args) -> int:
+    counts = _verify(args.snapshot)
+    if counts is None:
+        return 1
+    if os.path.exists(args.database) and not args.force:
+        print(f"❌ {args.database} существует; остановите бота и повторите с --force", file=sys.stderr)
+        return 1
+
+    directory = os.path.dirname(os.path.abspath(args.database))
+    fd, partial = tempfile.mkstemp(prefix="restore-", suffix=".db", dir=directory)
+    os.close(fd)
+    try:
+        _gunzip(args.snapshot, partial)
+        # The replaced database is kept together with its write-ahead log, which
+        # must not stay next to the restored database (it would be applied to it)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.database + suffix):
+                os.replace(args.database + suffix, args.database + ".before-restore" + suffix)
+        os.replace(partial, args.database)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    print(f"✅ {args.database} восстановлена из {args.snapshot}: " + ", ".join(f"{table} {count}" for table, count in counts.items()))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Backups of the bot databases")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="List snapshots")
+    list_parser.add_argument("backup_dir", nargs="?", default=BACKUP_DIR or "data/backups")
+    list_parser.set_defaults(handler=_list_command)
+
+    create_parser = commands.add_parser("create", help="Back up a database now")
+    create_parser.add_argument("database")
+    create_parser.add_argument("--backup-dir", default=BACKUP_DIR or "data/backups")
+    create_parser.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    create_parser.set_defaults(handler=_create_command)
+
+    verify_parser = commands.add_parser("verify", help="Check snapshots")
+    verify_parser.add_argument("snapshots", nargs="+")
+    verify_parser.set_defaults(handler=_verify_command)
+
+    restore_parser = commands.add_parser("restore", help="Restore a database from a snapshot (stop the bot first)")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("database")
+    restore_parser.add_argument("--force", action="store_true", help="Replace an existing database (kept as .before-restore)")
+    restore_parser.set_defaults(handler=_restore_command)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
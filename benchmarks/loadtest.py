@@ -0,0 +1,343 @@
+"""
+Offline end-to-end load test with fake Telegram and Gemini backends.
+
+Runs real Bot instances (router, request queue, outbound scheduler, SQLite
+database, call_gemini_api) against a fake Pyrogram client that injects
+synthetic messages and a fake genai client with configurable latency and
+error rate. No accounts or API keys are needed.
+
+Usage (from the repository root):
+
+    python -m benchmarks.loadtest                          # 2 bots, 20 chats each, 30 s
+    python -m benchmarks.loadtest --bots 10 --rate 20 --duration 60
+    python -m benchmarks.loadtest --gemini-latency 3 --error-rate 0.1
+
+Reports throughput, end-to-end latency per request type (time from the
+incoming message to the last outbound operation of its answer) and the
+event loop lag.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from bot import Bot
+import resources
+
+MEDIA_FIELDS = ["photo", "voice", "document", "audio", "video", "video_note", "contact", "location", "venue",
+                "sticker", "animation", "forward_from", "forward_from_chat", "sender_chat", "via_bot"]
+
+# Outbound texts that are progress updates, not the answer
+PROGRESS_PREFIXES = ("💭", "⏳", "✅ Загружено")
+
+
+# --- Fake Telegram ---
+
+class Trace:
+    """End-to-end timing of one injected message"""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    def touch(self, text: Optional[str]):
+        if text is None or not str(text).startswith(PROGRESS_PREFIXES):
+            self.finished = time.perf_counter()
+
+
+class FakeMessage:
+    """The subset of pyrogram.types.Message used by the bot"""
+    _ids = itertools.count(1)
+
+    def __init__(self, client: "FakeClient", chat_id: int, user, text: Optional[str], trace: Trace, **media):
+        self._client = client
+        self.trace = trace
+        self.id = next(self._ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = user
+        self.outgoing = bool(user and user.is_self)
+        self.text = text
+        self.caption = None
+        self.date = datetime.datetime.now()
+        self.reply_to_message = None
+        self.media_group_id = None
+        for name in MEDIA_FIELDS:
+            setattr(self, name, media.get(name))
+
+    async def reply(self, text, **kwargs):
+        await self._client.api_call()
+        self.trace.touch(text)
+        return FakeMessage(self._client, self.chat.id, self._client.me, text, self.trace)
+
+    async def edit_text(self, text, **kwargs):
+        await self._client.api_call()
+        self.text = text
+        self.trace.touch(text)
+        return self
+
+    async def delete(self):
+        await self._client.api_call()
+        return True
+
+
+class FakeClient:
+    """Stands in for pyrogram.Client: collects the handler and answers API calls after a delay"""
+    _user_ids = itertools.count(1000)
+
+    def __init__(self, name: str, api_latency: float, media_size: int, media_dir: str):
+        self.name = name
+        self.api_latency = api_latency
+        self.media_size = media_size
+        self.media_dir = media_dir
+        self.is_connected = False
+        self.me = SimpleNamespace(id=next(self._user_ids), first_name=name, username=name, is_self=True)
+        self.handler = None
+        self.api_calls = 0
+
+    def on_message(self, _filters=None):
+        def decorator(func):
+            self.handler = func
+            return func
+        return decorator
+
+    async def api_call(self):
+        self.api_calls += 1
+        await asyncio.sleep(self.api_latency * random.uniform(0.5, 1.5))
+
+    async def start(self):
+        await self.api_call()
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    async def get_me(self):
+        await self.api_call()
+        return self.me
+
+    async def get_media_group(self, chat_id, message_id):
+        return []
+
+    async def get_messages(self, chat_id, message_id):
+        return None
+
+    async def download_media(self, media, file_name: str):
+        await self.api_call()
+        path = os.path.join(self.media_dir, os.path.basename(file_name))
+        with open(path, "wb") as f:
+            f.write(os.urandom(self.media_size))
+        return path
+
+    async def inject(self, message: FakeMessage):
+        """Deliver an incoming update the way Pyrogram's dispatcher does"""
+        await self.handler(self, message)
+
+
+# --- Fake Gemini ---
+
+class ServiceUnavailable(Exception):
+    """Named like the SDK error so call_gemini_api treats it as transient"""
+
+
+class FakeGemini:
+    """Stands in for genai.Client; blocking like the real SDK, called from executor threads"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, upload_latency: float, response_chars: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.upload_latency = upload_latency
+        self.response_chars = response_chars
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._files = itertools.count(1)
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.files = SimpleNamespace(upload=self._upload, get=self._get_file, delete=self._delete_file)
+
+    def _generate_content(self, model, contents, config=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise ServiceUnavailable("503 model overloaded (fake)")
+        prompt_tokens = sum(len(str(part)) for content in contents for part in (content.parts or [])) // 4
+        text = ("Синтетический **ответ** модели. " * (self.response_chars // 32 + 1))[:self.response_chars]
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, cached_content_token_count=0,
+                                candidates_token_count=len(text) // 4, thoughts_token_count=0)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def _upload(self, file):
+        time.sleep(self.upload_latency)
+        name = f"files/fake-{next(self._files)}"
+        return SimpleNamespace(name=name, uri=f"https://example.invalid/{name}", state="ACTIVE")
+
+    def _get_file(self, name):
+        return SimpleNamespace(name=name, state="ACTIVE")
+
+    def _delete_file(self, name):
+        return None
+
+
+# --- Load generation ---
+
+async def _loop_lag_sampler(samples: List[float], interval: float = 0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def _generate_load(client: FakeClient, chats: List[int], users: list, args, traces: List[Trace]):
+    """Inject messages into one bot at args.rate messages per second (Poisson arrivals)"""
+    deadline = time.perf_counter() + args.duration
+    tasks = set()
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(random.expovariate(args.rate))
+        chat_id = random.choice(chats)
+        user = random.choice(users)
+        roll = random.random()
+
+        if roll < args.media_ratio:
+            trace = Trace("media")
+            target = FakeMessage(client, chat_id, user, None, trace, photo=SimpleNamespace())
+            message = FakeMessage(client, chat_id, user, "!media что на картинке?", trace)
+            message.reply_to_message = target
+        elif roll < args.media_ratio + args.gemini_ratio:
+            trace = Trace("gemini")
+            message = FakeMessage(client, chat_id, user, f"Гемини, вопрос номер {len(traces)}", trace)
+        else:
+            trace = Trace("store")
+            message = FakeMessage(client, chat_id, user, "обычное сообщение в чате", trace)
+
+        traces.append(trace)
+        task = asyncio.create_task(client.inject(message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        if trace.kind == "store":
+            # Plain messages get no answer: they are done when the handler returns
+            task.add_done_callback(lambda _, trace=trace: trace.touch(None))
+
+    return tasks
+
+
+def _percentiles(values: List[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return f"p50 {q[49] * 1000:8.1f} ms   p95 {q[94] * 1000:8.1f} ms   p99 {q[98] * 1000:8.1f} ms   max {max(values) * 1000:8.1f} ms"
+
+
+def report(traces: List[Trace], lag: List[float], elapsed: float, bots: List[Bot], clients: List[FakeClient], gemini: FakeGemini):
+    print(f"\n=== Load test: {len(bots)} bot(s), {elapsed:.1f}s ===")
+    print(f"Injected messages: {len(traces)} ({len(traces) / elapsed:.1f}/s)")
+
+    by_kind: Dict[str, List[Trace]] = defaultdict(list)
+    for trace in traces:
+        by_kind[trace.kind].append(trace)
+
+    for kind, kind_traces in sorted(by_kind.items()):
+        done = [t.finished - t.started for t in kind_traces if t.finished is not None]
+        print(f"{kind:<7} {len(done):>6}/{len(kind_traces):<6} answered ({len(done) / elapsed:7.1f}/s)   {_percentiles(done)}")
+
+    print(f"Gemini calls: {gemini.calls}, injected errors: {gemini.errors}")
+    print(f"Telegram API calls: {sum(c.api_calls for c in clients)}")
+    print(f"Rejected/queued now: {sum(b.request_queue.total_depth for b in bots)} request(s) still queued, "
+          f"{sum(b.sender.pending for b in bots)} send(s) pending")
+    print(f"Event loop lag:   {_percentiles(lag)}")
+
+
+async def run(args) -> int:
+    work_dir = tempfile.mkdtemp(prefix="buisbot-loadtest-")
+    gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.error_rate, args.upload_latency, args.response_chars)
+    bots: List[Bot] = []
+    clients: List[FakeClient] = []
+    bot_chats: List[List[int]] = []
+    traces: List[Trace] = []
+    lag: List[float] = []
+
+    try:
+        for i in range(args.bots):
+            name = f"loadtest{i}"
+            client = FakeClient(name, args.api_latency, args.media_size, work_dir)
+            bot = Bot(
+                session_name=name, api_id=0, api_hash="", bot_owner_id=-1,
+                db_path=os.path.join(work_dir, f"{name}.db"), gemini_api_key="",
+                max_concurrent_requests=args.max_concurrent,
+                client=client, gemini_client=gemini,
+            )
+            await bot.start()
+            chats = [-(1_000_000 * (i + 1) + c) for c in range(args.chats)]
+            for chat_id in chats:
+                bot.db.add_chat_to_whitelist(chat_id)
+            bots.append(bot)
+            clients.append(client)
+            bot_chats.append(chats)
+
+        users = [SimpleNamespace(id=100 + u, first_name=f"User{u}", is_self=False) for u in range(50)]
+        # Like run_bots, load the Gemini SDK off the event loop before traffic arrives
+        await resources.warm_gemini_clients([])
+        sampler = asyncio.create_task(_loop_lag_sampler(lag))
+
+        started = time.perf_counter()
+        generators = [_generate_load(client, chats, users, args, traces) for client, chats in zip(clients, bot_chats)]
+        pending = set().union(*await asyncio.gather(*generators))
+
+        # Give in-flight requests time to finish before reporting
+        if pending:
+            await asyncio.wait(pending, timeout=args.drain)
+        for bot in bots:
+            await bot.request_queue.drain(args.drain)
+            await bot.sender.flush(args.drain)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+
+        report(traces, lag, elapsed, bots, clients, gemini)
+    finally:
+        for bot in bots:
+            await bot.shutdown(timeout=1)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline load test of Bot with fake Telegram and Gemini backends")
+    parser.add_argument("--bots", type=int, default=2, help="Number of bots (default: 2)")
+    parser.add_argument("--chats", type=int, default=20, help="Chats per bot (default: 20)")
+    parser.add_argument("--rate", type=float, default=10.0, help="Incoming messages per second per bot (default: 10)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load generation (default: 30)")
+    parser.add_argument("--drain", type=float, default=30.0, help="Seconds to wait for in-flight answers afterwards (default: 30)")
+    parser.add_argument("--gemini-ratio", type=float, default=0.1, help="Share of messages that are Gemini requests (default: 0.1)")
+    parser.add_argument("--media-ratio", type=float, default=0.01, help="Share of messages that are !media requests (default: 0.01)")
+    parser.add_argument("--gemini-latency", type=float, default=1.5, help="Mean fake Gemini latency in seconds (default: 1.5)")
+    parser.add_argument("--gemini-jitter", type=float, default=0.5, help="Standard deviation of the Gemini latency (default: 0.5)")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Share of Gemini calls failing with a transient error (default: 0.02)")
+    parser.add_argument("--upload-latency", type=float, default=0.3, help="Fake Gemini file upload latency in seconds (default: 0.3)")
+    parser.add_argument("--response-chars", type=int, default=1500, help="Length of fake Gemini answers (default: 1500)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Mean fake Telegram API latency in seconds (default: 0.05)")
+    parser.add_argument("--media-size", type=int, default=200_000, help="Size of fake downloaded media in bytes (default: 200000)")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="max_concurrent_requests of each bot (default: 4)")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the bots (default: WARNING)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Replay of captured production traffic against fake Telegram and Gemini backends.
+
+Feeds capture files written with CAPTURE_DIR (see capture.py) through real
+Bot instances, one bot per file, with the recorded arrival times. Gemini
+calls take the recorded latency and answer length of the original request;
+media downloads produce files of the recorded size. No accounts or API keys
+are needed.
+
+Usage (from the repository root):
+
+    python -m benchmarks.replay data/capture/mybot-20250101-120000.jsonl
+    python -m benchmarks.replay data/capture/*.jsonl --speed 10      # 10x faster arrivals
+    python -m benchmarks.replay capture.jsonl --speed 0              # as fast as possible
+
+Only the arrival times are scaled by --speed, Gemini and Telegram latencies
+stay as recorded, so a faster replay means proportionally more concurrent
+requests. The report is the same as the one of the load test.
+"""
+import argparse
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from benchmarks.loadtest import FakeClient, FakeGemini, FakeMessage, ServiceUnavailable, Trace, _loop_lag_sampler, report
+from bot import Bot
+from capture import read_capture, replay_stub
+import resources
+
+# Commands that are not replayed (they would only measure themselves)
+SKIPPED_COMMANDS = {"!profile"}
+
+OWNER_ID = 99
+
+
+class ReplayClient(FakeClient):
+    """Fake client whose downloads have the recorded media size"""
+
+    def __init__(self, name: str, api_latency: float, media_size: int, media_dir: str, max_media_size: int):
+        super().__init__(name, api_latency, media_size, media_dir)
+        self.max_media_size = max_media_size
+
+    async def download_media(self, media, file_name: str):
+        await self.api_call()
+        size = min(getattr(media, "file_size", None) or self.media_size, self.max_media_size)
+        path = os.path.join(self.media_dir, os.path.basename(file_name))
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+
+class ReplayGemini(FakeGemini):
+    """Fake Gemini answering with the latency and length recorded for the replayed request"""
+
+    def _generate_content(self, model, contents, config=None):
+        stub = replay_stub.get()
+        if stub is None:
+            return super()._generate_content(model, contents, config)
+        with self._lock:
+            self.calls += 1
+        time.sleep(stub["lat"])
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise ServiceUnavailable("503 model overloaded (fake)")
+        chars = max(1, stub.get("out", 0) * 4)
+        text = ("Синтетический **ответ** модели. " * (chars // 32 + 1))[:chars]
+        usage = SimpleNamespace(prompt_token_count=stub.get("in", 0), cached_content_token_count=0,
+                                candidates_token_count=stub.get("out", 0), thoughts_token_count=stub.get("think", 0))
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+def _media(info: Optional[dict]) -> Dict[str, SimpleNamespace]:
+    """Media attributes for FakeMessage from a recorded media description"""
+    if not info or "kind" not in info:
+        return {}
+    media = SimpleNamespace(
+        file_size=info.get("size"), duration=info.get("duration") or 0, file_name="file", mime_type=None,
+        title=None, performer=None, first_name="Контакт",
+    )
+    return {info["kind"]: media}
+
+
+def _kind(record: dict) -> str:
+    """Request type used in the report"""
+    text = (record.get("text") or record.get("caption") or "").lower()
+    first_word = text.split(maxsplit=1)[0] if text.strip() else ""
+    if first_word.startswith("!"):
+        return "media" if first_word == "!media" else "command"
+    if "гемини" in text and record.get("w"):
+        return "gemini"
+    return "store"
+
+
+def build_message(client: ReplayClient, chat_id: int, record: dict, users: Dict[int, SimpleNamespace], trace: Trace) -> FakeMessage:
+    """Recreate an incoming message from its capture record"""
+    if record.get("me"):
+        user = client.me
+    elif record.get("o"):
+        user = SimpleNamespace(id=OWNER_ID, first_name="Owner", is_self=False)
+    elif record.get("u") is not None:
+        alias = record["u"]
+        user = users.setdefault(alias, SimpleNamespace(id=100_000 + alias, first_name=f"User{alias}", is_self=False))
+    else:
+        user = None
+
+    message = FakeMessage(client, chat_id, user, record.get("text"), trace, **_media(record.get("media")))
+    message.caption = record.get("caption")
+    if record.get("album"):
+        message.media_group_id = f"album-{message.id}"
+    if record.get("fwd"):
+        message.forward_from = SimpleNamespace(first_name="Forwarded", last_name=None)
+    if "reply" in record:
+        message.reply_to_message = FakeMessage(client, chat_id, None, None, trace, **_media(record["reply"]))
+    return message
+
+
+async def _replay_bot(client: ReplayClient, bot_index: int, messages: list, gemini: Dict[int, dict],
+                      speed: float, started: float, traces: List[Trace]) -> set:
+    """Inject the recorded messages of one bot at their recorded times"""
+    users: Dict[int, SimpleNamespace] = {}
+    tasks = set()
+    for record in messages:
+        words = (record.get("text") or record.get("caption") or "").split(maxsplit=1)
+        if words and words[0].lower() in SKIPPED_COMMANDS:
+            continue
+
+        if speed > 0:
+            delay = started + record["t"] / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        trace = Trace(_kind(record))
+        chat_id = -(1_000_000 * (bot_index + 1) + record["c"])
+        message = build_message(client, chat_id, record, users, trace)
+        traces.append(trace)
+
+        # The recorded Gemini answer travels with the update through the context
+        context = contextvars.copy_context()
+        context.run(replay_stub.set, gemini.get(record["n"]))
+        task = asyncio.create_task(client.inject(message), context=context)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        if trace.kind != "gemini":
+            # Everything except queued Gemini requests is done when the handler returns
+            task.add_done_callback(lambda _, trace=trace: trace.touch(None))
+
+        if speed <= 0:
+            await asyncio.sleep(0)
+    return tasks
+
+
+async def run(args) -> int:
+    captures = [read_capture(path) for path in args.captures]
+    work_dir = tempfile.mkdtemp(prefix="buisbot-replay-")
+    gemini = ReplayGemini(1.0, 0.0, args.error_rate, args.upload_latency, 1000)
+    bots: List[Bot] = []
+    clients: List[ReplayClient] = []
+    traces: List[Trace] = []
+    lag: List[float] = []
+
+    try:
+        for i, (header, messages, _) in enumerate(captures):
+            name = f"replay{i}"
+            client = ReplayClient(name, args.api_latency, args.media_size, work_dir, args.max_media_size)
+            bot = Bot(
+                session_name=name, api_id=0, api_hash="", bot_owner_id=OWNER_ID,
+                db_path=os.path.join(work_dir, f"{name}.db"), gemini_api_key="",
+                max_concurrent_requests=args.max_concurrent,
+                client=client, gemini_client=gemini,
+            )
+            await bot.start()
+            # Chats the bot handled messages of in the capture are whitelisted
+            for chat in {r["c"] for r in messages if r.get("w") and not r.get("o")}:
+                bot.db.add_chat_to_whitelist(-(1_000_000 * (i + 1) + chat))
+            bots.append(bot)
+            clients.append(client)
+            duration = messages[-1]["t"] if messages else 0
+            print(f"{args.captures[i]}: bot {header.get('bot', '?')}, {len(messages)} updates over {duration:.0f}s", file=sys.stderr)
+
+        # Like run_bots, load the Gemini SDK off the event loop before traffic arrives
+        await resources.warm_gemini_clients([])
+        sampler = asyncio.create_task(_loop_lag_sampler(lag))
+
+        started = time.perf_counter()
+        replays = [
+            _replay_bot(client, i, messages, gemini_records, args.speed, started, traces)
+            for i, (client, (_, messages, gemini_records)) in enumerate(zip(clients, captures))
+        ]
+        pending = set().union(*await asyncio.gather(*replays))
+
+        if pending:
+            await asyncio.wait(pending, timeout=args.drain)
+        for bot in bots:
+            await bot.request_queue.drain(args.drain)
+            await bot.sender.flush(args.drain)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+
+        report(traces, lag, elapsed, bots, clients, gemini)
+    finally:
+        for bot in bots:
+            await bot.shutdown(timeout=1)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay captured traffic against fake Telegram and Gemini backends")
+    parser.add_argument("captures", nargs="+", help="Capture files (one bot per file)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Arrival speed-up factor, 0 for no delays (default: 1)")
+    parser.add_argument("--drain", type=float, default=60.0, help="Seconds to wait for in-flight answers afterwards (default: 60)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Gemini calls failing with a transient error (default: 0)")
+    parser.add_argument("--upload-latency", type=float, default=0.3, help="Fake Gemini file upload latency in seconds (default: 0.3)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Mean fake Telegram API latency in seconds (default: 0.05)")
+    parser.add_argument("--media-size", type=int, default=200_000, help="Size of downloads without a recorded size (default: 200000)")
+    parser.add_argument("--max-media-size", type=int, default=20_000_000, help="Upper bound for replayed download sizes (default: 20000000)")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="max_concurrent_requests of each bot (default: 4)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the fake Telegram latencies")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the bots (default: WARNING)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""
+Benchmarks for the storage and prompt-building hot paths.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run                              # run with defaults
+    python -m benchmarks.run --rows 2000000               # bigger synthetic database
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+
+The synthetic database is cached in the work directory and reused as long
+as its parameters do not change, so repeated runs measure the same data.
+With --compare the exit code is 1 if any benchmark regressed by more than
+the threshold.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from database import Database, MessageImportance
+from utils import build_conversation, format_chat_history, generate_tags
+
+# History sizes used for get_last_messages, format_chat_history and build_conversation
+# (5 is the default context, 3000 the maximum of !контекст=N)
+HISTORY_SIZES = [5, 50, 500, 3000]
+
+WORDS = (
+    "привет как дела что нового сегодня завтра встреча проект задача код бот "
+    "сообщение файл фото видео ссылка вопрос ответ гемини посмотри помоги спасибо"
+).split()
+AUTHORS = ["Алиса", "Борис", "Вика", "Гена", "Даша", "Егор"]
+
+
+# --- Synthetic data ---
+
+def _random_text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+
+
+def remove_database(path: str):
+    """Remove a database file together with its write-ahead log"""
+    for file in (path, path + "-wal", path + "-shm"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file)
+
+
+def build_database(path: str, rows: int, chats: int, seed: int):
+    """Fill a fresh database with `rows` messages spread over `chats` chats"""
+    remove_database(path)
+    Database(path)
+
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    importance = [MessageImportance.DEFAULT.value] * 90 + [MessageImportance.GEMINI.value] * 9 + [MessageImportance.IMPORTANT.value]
+    batch_size = 50_000
+
+    # Closing the connection checkpoints the write-ahead log, so the file is complete before it is renamed
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        conn.executemany("INSERT INTO whitelisted_chats (chat_id) VALUES (?)", [(chat,) for chat in range(1, chats + 1)])
+        for offset in range(0, rows, batch_size):
+            batch = []
+            for i in range(offset, min(rows, offset + batch_size)):
+                batch.append((
+                    rng.randint(1, chats),
+                    i,
+                    rng.choice(AUTHORS),
+                    (start + datetime.timedelta(seconds=i * 7)).isoformat(),
+                    _random_text(rng),
+                    "содержит фото" if rng.random() < 0.05 else "",
+                    rng.choice(importance),
+                ))
+            conn.executemany(
+                "INSERT INTO messages (chat_id, message_id, author, date, content, tags, important) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+            conn.commit()
+
+
+def prepare_database(work_dir: str, rows: int, chats: int, seed: int) -> str:
+    """Return the path of a synthetic database with the given parameters, building it if needed"""
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, f"bench_{rows}_{chats}_{seed}.db")
+    if not os.path.exists(path):
+        print(f"Generating {rows} messages in {chats} chats ({path})...", file=sys.stderr)
+        started = time.perf_counter()
+        build_database(path + ".tmp", rows, chats, seed)
+        os.replace(path + ".tmp", path)
+        print(f"Generated in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return path
+
+
+def synthetic_messages(count: int, seed: int) -> List[SimpleNamespace]:
+    """Objects with the attributes generate_tags reads, with a realistic mix of media"""
+    rng = random.Random(seed)
+    fields = ["photo", "voice", "document", "audio", "video", "video_note", "contact", "location", "venue",
+              "sticker", "animation", "forward_from", "forward_from_chat", "reply_to_message", "sender_chat", "via_bot"]
+    messages = []
+    for i in range(count):
+        msg = SimpleNamespace(**{name: None for name in fields})
+        roll = rng.random()
+        if roll < 0.15:
+            msg.photo = object()
+        elif roll < 0.20:
+            msg.voice = SimpleNamespace(duration=rng.randint(1, 300))
+        elif roll < 0.23:
+            msg.document = SimpleNamespace(file_name=f"file_{i}.pdf", file_size=rng.randint(1, 10_000_000))
+        elif roll < 0.25:
+            msg.audio = SimpleNamespace(title="Song", performer=None, duration=rng.randint(60, 400))
+        if rng.random() < 0.3:
+            msg.reply_to_message = SimpleNamespace(id=i)
+        if rng.random() < 0.05:
+            msg.forward_from = SimpleNamespace(first_name="Иван", last_name=None)
+        messages.append(msg)
+    return messages
+
+
+# --- Measurement ---
+
+def measure(func: Callable[[], object], min_time: float, min_samples: int = 20) -> Dict[str, float]:
+    """
+    Call func repeatedly for at least min_time seconds and min_samples samples
+
+    Very fast functions are timed in batches of calls (at least ~50 us per
+    sample) so the timer overhead does not dominate; latencies are then the
+    per-call average of a batch.
+
+    Returns:
+        ops/sec and latency percentiles in microseconds
+    """
+    # Warm-up (page cache, statement cache) and batch size calibration
+    started = time.perf_counter()
+    for _ in range(3):
+        func()
+    per_call = (time.perf_counter() - started) / 3
+    batch = max(1, int(50e-6 / per_call)) if per_call > 0 else 1000
+
+    latencies: List[float] = []
+    calls = 0
+    started = time.perf_counter()
+    while len(latencies) < min_samples or time.perf_counter() - started < min_time:
+        sample_started = time.perf_counter()
+        for _ in range(batch):
+            func()
+        latencies.append((time.perf_counter() - sample_started) / batch)
+        calls += batch
+    total = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "ops": calls,
+        "ops_per_sec": round(calls / total, 2),
+        "p50_us": round(quantiles[49] * 1e6, 2),
+        "p95_us": round(quantiles[94] * 1e6, 2),
+        "p99_us": round(quantiles[98] * 1e6, 2),
+    }
+
+
+def run_benchmarks(db_path: str, chats: int, min_time: float, seed: int) -> Dict[str, Dict[str, float]]:
+    db = Database(db_path)
+    rng = random.Random(seed)
+    results: Dict[str, Dict[str, float]] = {}
+
+    def bench(name: str, func: Callable[[], object]):
+        results[name] = measure(func, min_time)
+        r = results[name]
+        print(f"{name:<32} {r['ops_per_sec']:>12.1f} ops/s   p50 {r['p50_us']:>10.1f} us   "
+              f"p95 {r['p95_us']:>10.1f} us   p99 {r['p99_us']:>10.1f} us")
+
+    bench("is_chat_whitelisted", lambda: db.is_chat_whitelisted(rng.randint(1, chats * 2)))
+
+    for size in HISTORY_SIZES:
+        bench(f"get_last_messages[{size}]", lambda size=size: db.get_last_messages(rng.randint(1, chats), limit=size))
+
+    for size in HISTORY_SIZES:
+        history = db.get_last_messages(1, limit=size)
+        bench(f"format_chat_history[{size}]", lambda history=history: format_chat_history(history))
+        bench(f"build_conversation[{size}]", lambda history=history: build_conversation(history, "Гемини, что скажешь?"))
+
+    messages = synthetic_messages(1000, seed)
+    bench("generate_tags", lambda: generate_tags(rng.choice(messages)))
+
+    # Writes go last and into chats the reads do not use, so they do not change what the reads see
+    now = datetime.datetime.now()
+    bench("store_message", lambda: db.store_message(
+        chat_id=chats + 1 + rng.randint(0, 100), message_id=0, author="bench", date=now,
+        content=_random_text(rng), tags="", importance=MessageImportance.DEFAULT,
+    ))
+
+    return results
+
+
+# --- Baselines ---
+
+def save_baseline(path: str, results: dict, params: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"params": params, "machine": platform.platform(), "python": platform.python_version(), "results": results},
+                  f, indent=2, ensure_ascii=False)
+    print(f"\nBaseline saved to {path}")
+
+
+def compare_baseline(path: str, results: dict, params: dict, threshold: float) -> bool:
+    """
+    Print the change against a saved baseline
+
+    Returns:
+        True if no benchmark got slower by more than threshold (fraction)
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    if baseline.get("params") != params:
+        print(f"\nWarning: baseline was recorded with different parameters: {baseline.get('params')}")
+
+    ok = True
+    print(f"\nComparison with {path} (regression threshold {threshold:.0%}):")
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"  {name:<32} new")
+            continue
+        throughput = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        p50 = result["p50_us"] / old["p50_us"] - 1 if old["p50_us"] else 0.0
+        p95 = result["p95_us"] / old["p95_us"] - 1 if old["p95_us"] else 0.0
+        # Tail latencies are too noisy on shared machines to fail a run on their own
+        regressed = throughput < -threshold or p50 > threshold
+        ok = ok and not regressed
+        flag = "REGRESSION" if regressed else ("faster" if throughput > threshold else "ok")
+        print(f"  {name:<32} ops/s {throughput:+7.1%}   p50 {p50:+7.1%}   p95 {p95:+7.1%}   {flag}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark storage and prompt-building hot paths")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of synthetic messages (default: 1000000)")
+    parser.add_argument("--chats", type=int, default=200, help="Number of synthetic chats (default: 200)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic data")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds spent on each benchmark (default: 1)")
+    parser.add_argument("--work-dir", default="data/bench", help="Where the synthetic database is kept")
+    parser.add_argument("--save", metavar="PATH", help="Save results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare results with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed slowdown before a regression is reported (default: 0.15)")
+    args = parser.parse_args()
+
+    params = {"rows": args.rows, "chats": args.chats, "seed": args.seed}
+    db_path = prepare_database(args.work_dir, args.rows, args.chats, args.seed)
+
+    # Benchmarks write, so they run on a copy of the generated database
+    run_path = db_path + ".run"
+    with contextlib.closing(sqlite3.connect(db_path)) as src, contextlib.closing(sqlite3.connect(run_path)) as dst:
+        src.backup(dst)
+
+    try:
+        results = run_benchmarks(run_path, args.chats, args.min_time, args.seed)
+    finally:
+        remove_database(run_path)
+
+    if args.save:
+        save_baseline(args.save, results, params)
+    if args.compare:
+        return 0 if compare_baseline(args.compare, results, params, args.threshold) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
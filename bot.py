@@ -1,24 +1,45 @@
+import asyncio
+import datetime
+import io
 import logging
 import os
-from typing import Optional
+import time
+from typing import List, Optional
 
-from google import genai
 from pyrogram import Client, filters
 from pyrogram.enums import ParseMode
 from pyrogram.errors import FileReferenceExpired
 from pyrogram.types import Message
 
-from ai_service import GeminiModel, call_gemini_api, download_media
+from ai_service import GeminiError, GeminiUsage, call_gemini_api, download_media, remove_media_file
+from capture import TrafficRecorder
 from database import Database, MessageImportance
-from utils import format_chat_history, generate_tags
+from formatting import MAX_MESSAGE_LENGTH, render_chunks, render_markdown, split_markdown
+from prefetch import PREFETCH, Prefetcher
+import profiler
+import routing
+import tracing
+from request_queue import ChatRequestQueue
+from resources import get_gemini_client, run_blocking
+from router import UpdateRouter
+from scratch import MEDIA_BACKGROUND_DOWNLOADS_PER_BOT, MEDIA_DOWNLOADS_PER_BOT, MediaRejected
+from sender import OutboundScheduler
+from transcriber import AUTO_TRANSCRIBE, Transcriber
+from utils import add_query, build_conversation, build_history_turns, format_chat_history, generate_tags
 
 context_limit = 5
+EMPTY_RESPONSE_TEXT = "❌ Gemini вернул пустой ответ"
+SHUTDOWN_TEXT = "🔌 Бот перезапускается, повторите запрос через минуту"
+# Longest period !usage reports on (days)
+MAX_USAGE_DAYS = 3650
 class Bot:
     """
     Business Bot class - encapsulates a single bot instance with its own client, database, and handlers
     """
     
-    def __init__(self, session_name: str, api_id: int, api_hash: str, bot_owner_id: int, db_path: str, gemini_api_key: str):
+    def __init__(self, session_name: str, api_id: int, api_hash: str, bot_owner_id: int, db_path: str, gemini_api_key: str,
+                 max_concurrent_requests: int = 4, max_queued_per_chat: int = 3,
+                 client: Optional[Client] = None, gemini_client=None):
         """
         Initialize a bot instance
         
@@ -29,127 +50,283 @@ class Bot:
             bot_owner_id: Telegram user ID of the bot owner
             db_path: Path to the SQLite database file
             gemini_api_key: Google Gemini API key for this bot instance
+            max_concurrent_requests: Maximum number of Gemini requests processed at once by this bot
+            max_queued_per_chat: Maximum number of Gemini requests waiting in a single chat
+            client: Telegram client to use instead of creating one (e.g. a fake one for load tests)
+            gemini_client: Gemini client to use instead of the shared one for the API key
         """
         self.session_name = session_name
         self.owner_id = bot_owner_id
         
         # Initialize Pyrogram client
         # Sessions are stored in data/ directory
-        self.client = Client(f"data/{session_name}", api_id=api_id, api_hash=api_hash)
+        self.client = client or Client(f"data/{session_name}", api_id=api_id, api_hash=api_hash)
         
-        # Initialize database
-        self.db = Database(db_path)
+        # Database schema is created in start(), off the event loop
+        self.db = Database(db_path, init_schema=False)
+        self._db_ready = False
         
-        # Initialize personal Gemini client for this bot
-        if not gemini_api_key:
+        # Gemini client is taken from the shared registry on first use
+        self._gemini_api_key = gemini_api_key
+        self._injected_gemini_client = gemini_client
+        if not gemini_api_key and gemini_client is None:
             logging.error(f"Gemini API key is missing for bot {session_name}. AI features will fail.")
-            self.gemini_client = None
-        else:
-            self.gemini_client = genai.Client(api_key=gemini_api_key)
-            logging.info(f"Gemini client initialized for bot '{session_name}'")
+        
+        # Set on shutdown: new Gemini and media requests are refused
+        self.draining = False
+        
+        # Outbound scheduler: rate limits, FloodWait handling and edit coalescing for all sends
+        self.sender = OutboundScheduler(session_name)
+        
+        # Concurrent media downloads of this bot (the scratch store also limits them process-wide);
+        # prefetch and transcription downloads have their own, smaller limit
+        self.download_slots = asyncio.Semaphore(max(1, MEDIA_DOWNLOADS_PER_BOT))
+        self.background_download_slots = asyncio.Semaphore(max(1, MEDIA_BACKGROUND_DOWNLOADS_PER_BOT))
+        
+        # Per-chat request queue for Gemini requests
+        self.request_queue = ChatRequestQueue(
+            session_name,
+            max_concurrent=max_concurrent_requests,
+            max_pending_per_chat=max_queued_per_chat,
+        )
+        
+        # Anonymized traffic capture for replay, only if CAPTURE_DIR is set
+        self.recorder = TrafficRecorder.for_bot(session_name)
+        
+        # Background transcription of voice messages and video notes, only if AUTO_TRANSCRIBE is set
+        self.transcriber = Transcriber(
+            session_name, self.db, lambda: self.gemini_client, self._download_background_media, self._usage_recorder,
+        ) if AUTO_TRANSCRIBE else None
+        
+        # Speculative history and reply media prefetch, only if PREFETCH is set
+        self.prefetcher = Prefetcher(
+            session_name, self.db, context_limit, self._download_background_media,
+        ) if PREFETCH else None
         
         # Register handlers
         self._register_handlers()
         
         logging.info(f"Bot '{session_name}' initialized")
     
+    @property
+    def gemini_client(self):
+        """Gemini client for this bot's key, shared with other bots using the same key (None if the key is missing)"""
+        if self._injected_gemini_client is not None:
+            return self._injected_gemini_client
+        return get_gemini_client(self._gemini_api_key)
+    
+    def update_settings(self, gemini_api_key: Optional[str] = None, max_concurrent_requests: Optional[int] = None,
+                        max_queued_per_chat: Optional[int] = None):
+        """
+        Apply new settings to a running bot without reconnecting
+        
+        Args:
+            gemini_api_key: New Gemini API key (requests already in flight finish with the old client)
+            max_concurrent_requests: New limit of concurrent Gemini requests
+            max_queued_per_chat: New limit of queued Gemini requests per chat
+        """
+        if gemini_api_key is not None:
+            if not gemini_api_key:
+                logging.error(f"Gemini API key is missing for bot {self.session_name}. AI features will fail.")
+            self._gemini_api_key = gemini_api_key
+        self.request_queue.resize(max_concurrent=max_concurrent_requests, max_pending_per_chat=max_queued_per_chat)
+    
     async def start(self):
-        """Start the bot"""
+        """Start the bot, logging how long each startup phase took"""
+        started = time.perf_counter()
+        
+        if not self._db_ready:
+            await run_blocking("io", self.db.create_tables)
+            self._db_ready = True
+        db_done = time.perf_counter()
+        
         await self.client.start()
-        me = await self.client.get_me()
-        logging.info(f"Bot '{self.session_name}' started as {me.first_name} (@{me.username})")
+        connected = time.perf_counter()
+        
+        # Client.start() already fetched the account info
+        me = self.client.me or await self.client.get_me()
+        logging.info(
+            f"Bot '{self.session_name}' started as {me.first_name} (@{me.username}) in {connected - started:.2f}s "
+            f"(database {db_done - started:.2f}s, connect {connected - db_done:.2f}s)"
+        )
+    
+    async def monitor(self, interval: float = 300, timeout: float = 30, max_failures: int = 3):
+        """
+        Periodically check that the Telegram connection works
+        
+        Pyrogram reconnects on its own after short network problems, so only
+        several failed checks in a row are treated as a dead connection.
+        
+        Raises:
+            ConnectionError: If max_failures checks in a row failed
+        """
+        failures = 0
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.wait_for(self.client.get_me(), timeout=timeout)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logging.warning(f"[{self.session_name}] Health check failed ({failures}/{max_failures}): {e}")
+                if failures >= max_failures:
+                    raise ConnectionError(f"Telegram connection of bot '{self.session_name}' is not responding")
     
     async def stop(self):
         """Stop the bot"""
+        if not self.client.is_connected:
+            return
         await self.client.stop()
         logging.info(f"Bot '{self.session_name}' stopped")
     
-    # --- Custom Filters ---
-    
-    async def _whitelist_filter_func(self, _, __, message):
-        """Filter function to check if chat is whitelisted"""
-        return self.db.is_chat_whitelisted(message.chat.id)
-    
-    @property
-    def whitelist(self):
-        """Custom filter for whitelisted chats"""
-        return filters.create(self._whitelist_filter_func)
+    async def shutdown(self, timeout: float):
+        """
+        Gracefully stop the bot
+        
+        New Gemini and media requests are refused, running and queued requests
+        get `timeout` seconds to finish and are cancelled after that (their
+        cleanup code still runs), pending transcriptions and prefetched media
+        are dropped, pending Telegram sends are flushed and the client is stopped.
+        
+        Args:
+            timeout: Seconds given to in-flight requests to finish
+        """
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        
+        logging.info(f"[{self.session_name}] Draining {self.request_queue.total_depth} queued request(s) and {self.router.active} running handler(s)...")
+        drained = await self.request_queue.drain(timeout)
+        drained = await self.router.wait_idle(max(0.0, deadline - loop.time())) and drained
+        
+        if not drained:
+            logging.warning(f"[{self.session_name}] Requests did not finish in {timeout}s, cancelling them")
+            self.request_queue.cancel_all()
+            self.router.cancel_active()
+            await self.request_queue.drain(5)
+            await self.router.wait_idle(5)
+        
+        if self.transcriber is not None:
+            await self.transcriber.stop()
+        if self.prefetcher is not None:
+            await self.prefetcher.stop()
+        await self.sender.flush(timeout=max(1.0, deadline - loop.time()))
+        await self.stop()
+        if self.recorder is not None:
+            self.recorder.close()
     
     # --- Handler Registration ---
     
+    def _is_allowed(self, message: Message) -> bool:
+        """Whether triggers and message storage may handle this message (owner or whitelisted chat)"""
+        if message.from_user and message.from_user.id == self.owner_id:
+            return True
+        return self.db.is_chat_whitelisted(message.chat.id)
+    
     def _register_handlers(self):
-        """Register all message handlers"""
+        """Register all message handlers in the router and attach it to the client"""
+        self.router = UpdateRouter(self.session_name, self._is_allowed)
         
         # Whitelist management
-        self.client.on_message(filters.me & filters.command("enable", prefixes="!"))(self.enable_command)
-        self.client.on_message(filters.me & filters.command("disable", prefixes="!"))(self.disable_command)
+        self.router.command("enable", self.enable_command)
+        self.router.command("disable", self.disable_command)
         
         # Statistics and pins management (owner only)
-        self.client.on_message(filters.me & filters.command("stats", prefixes="!"))(self.stats_command)
-        self.client.on_message(filters.me & filters.command("pins", prefixes="!"))(self.pins_command)
-        self.client.on_message(filters.me & filters.command("unpin", prefixes="!"))(self.unpin_command)
+        self.router.command("stats", self.stats_command)
+        self.router.command("pins", self.pins_command)
+        self.router.command("unpin", self.unpin_command)
+        self.router.command("usage", self.usage_command)
         
         # Debug command
-        self.client.on_message(filters.me & filters.command("debug", prefixes="!"))(self.debug_command)
+        self.router.command("debug", self.debug_command)
+        
+        # Live process profile (owner only)
+        self.router.command("profile", self.profile_command)
         
         # Test prompt command - shows full AI prompt without calling AI (owner only)
-        self.client.on_message(filters.me & filters.command("test", prefixes="!"))(self.test_prompt_command)
+        self.router.command("test", self.test_prompt_command)
         
         # Media analysis command
-        self.client.on_message(filters.all & filters.command("media", prefixes="!"))(self.media_command)
+        self.router.command("media", self.media_command, me_only=False)
         
-        # Mark as important (must be before process_gemini to take precedence)
-        self.client.on_message(filters.me & filters.command(["Гемини", "гемини"], prefixes="!"))(self.mark_important)
+        # Mark as important (commands take precedence over the process_gemini trigger)
+        self.router.command("гемини", self.mark_important)
         
         # Process Gemini requests (case-insensitive)
-        self.client.on_message(filters.all & filters.regex(r"(?i)гемини"))(self.process_gemini)
+        self.router.trigger(r"(?i)гемини", self.process_gemini)
+        
+        # Store all other messages
+        self.router.fallback(self.store_message)
         
-        # Store all messages (last handler, catches everything)
-        self.client.on_message(filters.all)(self.store_message)
+        # One Pyrogram handler for everything: the router classifies each update in a single pass
+        self.client.on_message(filters.all)(self._record_and_dispatch if self.recorder else self.router.dispatch)
+    
+    async def _record_and_dispatch(self, client, message: Message):
+        """Pyrogram message handler used while capturing traffic"""
+        try:
+            owner = bool(message.from_user and message.from_user.id == self.owner_id)
+            self.recorder.record_message(message, allowed=self._is_allowed(message), owner=owner)
+        except Exception as e:
+            logging.warning(f"[{self.session_name}] Failed to capture update: {e}")
+        await self.router.dispatch(client, message)
     
     # --- Helper Methods ---
 
     async def send_chunked_response(self, message: Message, text: str):
         """
         Helper to send long messages in chunks.
+        
+        The Markdown is rendered locally (see formatting.py), so every chunk is
+        valid HTML and is sent exactly once.
         """
-        max_length = 4096
-        
-        # Split into chunks
-        chunks = []
-        current_chunk = ""
-        for line in text.split('\n'):
-            if len(current_chunk) + len(line) + 1 > max_length:
-                chunks.append(current_chunk)
-                current_chunk = line + '\n'
-            else:
-                current_chunk += line + '\n'
-        if current_chunk:
-            chunks.append(current_chunk)
-            
-        for chunk in chunks:
-            try:
-                await message.reply(chunk, parse_mode=ParseMode.MARKDOWN)
-            except Exception:
-                await message.reply(chunk, parse_mode=ParseMode.DISABLED)
+        await self._reply_chunks(message, render_chunks(text))
+    
+    async def _reply_chunks(self, message: Message, chunks: List[str]):
+        """Reply with already rendered HTML chunks"""
+        # Queue all chunks at once so they are pipelined by the scheduler (order is preserved)
+        await asyncio.gather(*(
+            self.sender.reply(message, chunk, parse_mode=ParseMode.HTML)
+            for chunk in chunks
+        ))
 
+    def _usage_recorder(self, message: Message, request_type: str, context_size: int = 0):
+        """Callback for call_gemini_api that stores the token usage of a request"""
+        def record(usage: GeminiUsage):
+            self.db.store_usage(
+                chat_id=message.chat.id,
+                user_id=message.from_user.id if message.from_user else None,
+                model=usage.model,
+                request_type=request_type,
+                context_size=context_size,
+                input_tokens=usage.input_tokens,
+                cached_tokens=usage.cached_tokens,
+                output_tokens=usage.output_tokens,
+                thinking_tokens=usage.thinking_tokens,
+                latency=usage.latency,
+                cost=usage.cost,
+            )
+            if self.recorder is not None:
+                self.recorder.record_gemini(message, usage.model, usage.latency, usage.input_tokens,
+                                            usage.output_tokens, usage.thinking_tokens)
+        return record
+    
     # --- Command Handlers ---
     
     async def enable_command(self, client, message: Message):
         """Enable bot in current chat"""
         chat_id = message.chat.id
         if self.db.add_chat_to_whitelist(chat_id):
-            await message.edit_text(f"{message.text}\n\nChat enabled ✅")
+            await self.sender.edit(message, f"{message.text}\n\nChat enabled ✅")
         else:
-            await message.edit_text(f"{message.text}\n\nChat already enabled ✅")
+            await self.sender.edit(message, f"{message.text}\n\nChat already enabled ✅")
     
     async def disable_command(self, client, message: Message):
         """Disable bot in current chat"""
         chat_id = message.chat.id
         if self.db.remove_chat_from_whitelist(chat_id):
-            await message.edit_text(f"{message.text}\n\nChat disabled ❌")
+            await self.sender.edit(message, f"{message.text}\n\nChat disabled ❌")
         else:
-            await message.edit_text(f"{message.text}\n\nChat already disabled ❌")
+            await self.sender.edit(message, f"{message.text}\n\nChat already disabled ❌")
     
     async def stats_command(self, client, message: Message):
         """Show database statistics (owner only)"""
@@ -169,7 +346,68 @@ class Bot:
             for chat_id, count in stats['messages_by_chat'][:5]:
                 response += f"  • Chat {chat_id}: {count}\n"
         
-        await message.reply(response, parse_mode=ParseMode.MARKDOWN)
+        if self.router.stats:
+            response += "\n⏱ Обработчики (вызовы / среднее / максимум):\n"
+            for name, handler_stats in sorted(self.router.stats.items(), key=lambda item: -item[1].total_time):
+                response += f"  • {name}: {handler_stats.calls} / {handler_stats.avg_time * 1000:.1f} мс / {handler_stats.max_time * 1000:.1f} мс\n"
+        
+        if self.db.query_stats:
+            response += "\n🗄 SQL-запросы по суммарному времени (вызовы / среднее / максимум / медленных):\n"
+            for sql, query_stats in sorted(self.db.query_stats.items(), key=lambda item: -item[1].total_time)[:5]:
+                short_sql = sql if len(sql) <= 80 else sql[:77] + "..."
+                response += (
+                    f"  • `{short_sql}`: {query_stats.calls} / {query_stats.avg_time * 1000:.1f} мс / "
+                    f"{query_stats.max_time * 1000:.1f} мс / {query_stats.slow}\n"
+                )
+        
+        model_health = routing.MODEL_STATS.snapshot()
+        if model_health:
+            response += "\n🤖 Модели за последние минуты (вызовы / ошибки / медиана):\n"
+            for model, health in model_health.items():
+                degraded = " ⚠️" if routing.MODEL_STATS.degraded(model) else ""
+                response += f"  • {model.value}: {health.calls} / {health.error_rate:.0%} / {health.median_latency:.1f} с{degraded}\n"
+        
+        await self.sender.reply(message, response, parse_mode=ParseMode.MARKDOWN)
+    
+    async def usage_command(self, client, message: Message):
+        """Show Gemini token usage and estimated cost for the last N days (owner only)"""
+        if not message.from_user or message.from_user.id != self.owner_id:
+            return
+        
+        parts = message.text.split()
+        try:
+            days = min(max(1, int(parts[1])), MAX_USAGE_DAYS) if len(parts) > 1 else 7
+        except ValueError:
+            await self.sender.reply(message, "❌ Использование: `!usage [дней]`", parse_mode=ParseMode.MARKDOWN)
+            return
+        
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        usage = self.db.get_usage_stats(since)
+        requests, input_tokens, cached_tokens, output_tokens, thinking_tokens, cost, avg_latency = usage['totals']
+        
+        if not requests:
+            await self.sender.reply(message, f"📈 Запросов к Gemini за {days} дн. не было")
+            return
+        
+        response = f"📈 **Использование Gemini за {days} дн.**\n\n"
+        response += f"🔁 Запросов: **{requests}** (в среднем {avg_latency:.1f} с)\n"
+        response += f"📥 Входных токенов: **{input_tokens}** (из кэша {cached_tokens})\n"
+        response += f"📤 Выходных токенов: **{output_tokens}** + размышления {thinking_tokens}\n"
+        response += f"💰 Оценка стоимости: **${cost:.4f}**\n"
+        
+        response += "\n🤖 По моделям (запросы / вход / выход / $):\n"
+        for model, count, model_input, model_output, model_cost, _ in usage['by_model']:
+            response += f"  • {model}: {count} / {model_input} / {model_output} / ${model_cost:.4f}\n"
+        
+        response += "\n📅 По дням (запросы / вход / выход / $):\n"
+        for day, count, day_input, day_output, day_cost in usage['by_day']:
+            response += f"  • {day}: {count} / {day_input} / {day_output} / ${day_cost:.4f}\n"
+        
+        response += "\n🏆 Самые затратные чаты (запросы / вход / выход / $ / средний контекст):\n"
+        for chat_id, count, chat_input, chat_output, chat_cost, avg_context in usage['top_chats']:
+            response += f"  • Chat {chat_id}: {count} / {chat_input} / {chat_output} / ${chat_cost:.4f} / {avg_context:.0f}\n"
+        
+        await self.send_chunked_response(message, response)
     
     async def pins_command(self, client, message: Message):
         """Show all pinned messages (owner only)"""
@@ -180,7 +418,7 @@ class Bot:
         pins = self.db.get_pinned_messages(chat_id)
         
         if not pins:
-            await message.reply("📌 Нет закрепленных сообщений в этом чате")
+            await self.sender.reply(message, "📌 Нет закрепленных сообщений в этом чате")
             return
         
         response = f"📌 **Закрепленные сообщения ({len(pins)})**:\n\n"
@@ -194,7 +432,7 @@ class Bot:
         
         response += "\n💡 Используйте `!unpin <ID>` для удаления"
         
-        await message.reply(response, parse_mode=ParseMode.MARKDOWN)
+        await self.sender.reply(message, response, parse_mode=ParseMode.MARKDOWN)
     
     async def unpin_command(self, client, message: Message):
         """Unpin a message by database ID (owner only)"""
@@ -204,19 +442,19 @@ class Bot:
         # Parse message ID
         parts = message.text.split()
         if len(parts) < 2:
-            await message.reply("❌ Использование: `!unpin <message_id>`", parse_mode=ParseMode.MARKDOWN)
+            await self.sender.reply(message, "❌ Использование: `!unpin <message_id>`", parse_mode=ParseMode.MARKDOWN)
             return
         
         try:
             db_id = int(parts[1])
         except ValueError:
-            await message.reply("❌ ID должен быть числом")
+            await self.sender.reply(message, "❌ ID должен быть числом")
             return
         
         if self.db.unpin_message(db_id):
-            await message.edit_text(f"{message.text}\n\n✅ Сообщение откреплено")
+            await self.sender.edit(message, f"{message.text}\n\n✅ Сообщение откреплено")
         else:
-            await message.edit_text(f"{message.text}\n\n❌ Сообщение не найдено или уже откреплено")
+            await self.sender.edit(message, f"{message.text}\n\n❌ Сообщение не найдено или уже откреплено")
     
     async def debug_command(self, client, message: Message):
         """Show last messages from database"""
@@ -224,11 +462,44 @@ class Bot:
         logging.info(f"Debug command triggered in chat {chat_id} by {self.session_name}")
         messages = self.db.get_last_messages(chat_id, 10)
         history = format_chat_history(messages)
-        await message.reply(f"Last 10 messages:\n\n{history}")
+        await self.sender.reply(message, f"Last 10 messages:\n\n{history}")
+    
+    async def profile_command(self, client, message: Message):
+        """Profile the process for N seconds and send the report to Saved Messages (owner only)"""
+        if not message.from_user or message.from_user.id != self.owner_id:
+            return
+        
+        parts = message.text.split()
+        try:
+            seconds = int(parts[1]) if len(parts) > 1 else 30
+        except ValueError:
+            await self.sender.reply(message, "❌ Использование: `!profile <секунд>`", parse_mode=ParseMode.MARKDOWN)
+            return
+        seconds = max(1, min(seconds, 300))
+        
+        if profiler.is_running():
+            await self.sender.reply(message, "⏳ Профилирование уже идёт, дождитесь отчёта")
+            return
+        
+        await self.sender.edit(message, f"{message.text}\n\n⏱ Профилирую {seconds} с...")
+        logging.info(f"[{self.session_name}] Profiling the process for {seconds}s")
+        report = await profiler.capture(seconds)
+        
+        # The report goes to Saved Messages: it lists code and chat internals that should not land in a group
+        file_name = f"profile_{self.session_name}_{datetime.datetime.now():%Y%m%d_%H%M%S}.txt"
+        data = report.encode("utf-8")
+        
+        def send_report():
+            document = io.BytesIO(data)
+            document.name = file_name
+            return client.send_document("me", document, caption=f"📈 Профиль процесса за {seconds} с")
+        
+        await self.sender.submit(client.me.id, send_report, op="document")
+        await self.sender.edit(message, f"{message.text}\n\n✅ Отчёт отправлен в Избранное")
     
     async def test_prompt_command(self, client, message: Message):
         """Show the full prompt that would be sent to AI (without calling AI)"""
-        from ai_service import load_system_prompt, GeminiModel
+        from ai_service import load_system_prompt
         import re
         
         chat_id = message.chat.id
@@ -257,14 +528,15 @@ class Bot:
         
         # Get chat history with specified limit
         messages = self.db.get_last_messages(chat_id, limit=context_limit)
-        history = format_chat_history(messages)
         
-        # Build combined query (same as process_gemini)
-        combined_query = history + "\n\nТекущий запрос пользователя: " + query
+        # Build conversation turns (same as process_gemini)
+        turns = build_conversation(messages, query)
+        contents_text = "\n\n".join(f"[{role}]\n{text}" for role, text in turns)
+        contents_length = sum(len(text) for _, text in turns)
         
-        # Determine model
-        model = GeminiModel.FLASH_THINKING if "!думай" in query.lower() else GeminiModel.FLASH
-        model_name = model.value
+        # Determine model (same as process_gemini)
+        route = routing.route_text(query, contents_length - len(query))
+        model_name = f"{route.model.value} ({route.reason})"
         
         # Load system prompt
         system_prompt = load_system_prompt()
@@ -280,9 +552,9 @@ class Bot:
 {system_prompt}
 
 {separator}
-💬 **USER CONTENT (Combined Query):**
+💬 **CONTENTS ({len(turns)} ходов):**
 {separator}
-{combined_query}
+{contents_text}
 
 {separator}
 ⚙️ **НАСТРОЙКИ:**
@@ -299,114 +571,165 @@ Tools: Google Search
 📊 **СТАТИСТИКА:**
 {separator}
 Длина system prompt: {len(system_prompt)} символов
-Длина user content: {len(combined_query)} символов
-Общая длина: {len(system_prompt) + len(combined_query)} символов
+Длина contents: {contents_length} символов
+Общая длина: {len(system_prompt) + contents_length} символов
 Количество сообщений в истории: {len(messages)}
 """
         
-        # Send in chunks if too long
-        max_length = 4000
-        if len(full_display) > max_length:
-            # Split into chunks
-            chunks = []
-            current_chunk = ""
-            for line in full_display.split('\n'):
-                if len(current_chunk) + len(line) + 1 > max_length:
-                    chunks.append(current_chunk)
-                    current_chunk = line + '\n'
-                else:
-                    current_chunk += line + '\n'
-            if current_chunk:
-                chunks.append(current_chunk)
-            
+        # Send in chunks if too long (leave room for the "Часть i/n" header)
+        chunks = split_markdown(full_display, MAX_MESSAGE_LENGTH - 96)
+        if len(chunks) > 1:
             # Send first chunk as edit
-            await message.edit_text(f"{message.text}\n\n✅ Генерирую тест промпта...")
+            await self.sender.edit(message, f"{message.text}\n\n✅ Генерирую тест промпта...")
             
-            # Send remaining chunks as replies
-            for i, chunk in enumerate(chunks, 1):
-                await message.reply(f"**Часть {i}/{len(chunks)}:**\n\n{chunk}", parse_mode=ParseMode.MARKDOWN)
+            # Send remaining chunks as replies (queued at once, sent in order)
+            await asyncio.gather(*(
+                self.sender.reply(message, f"<b>Часть {i}/{len(chunks)}:</b>\n\n{render_markdown(chunk)}", parse_mode=ParseMode.HTML)
+                for i, chunk in enumerate(chunks, 1)
+            ))
         else:
-            await message.reply(full_display, parse_mode=ParseMode.MARKDOWN)
+            await self.sender.reply(message, render_markdown(full_display), parse_mode=ParseMode.HTML)
+    
+    @staticmethod
+    def _has_supported_media(msg: Message) -> bool:
+        """Check whether a message carries media that Gemini can analyze"""
+        return bool(
+            msg.photo
+            or msg.video
+            or msg.voice
+            or msg.audio
+            or getattr(msg, "animation", None)
+            or getattr(msg, "video_note", None)
+            or (msg.document and msg.document.mime_type and 
+                (msg.document.mime_type.startswith(("image/", "video/", "audio/")) or 
+                 msg.document.mime_type == "application/ogg"))
+        )
+    
+    async def _collect_media_messages(self, client, reply_msg: Message) -> List[Message]:
+        """
+        Get all messages with supported media for a reply target.
+        
+        If the replied message is part of an album (media group), every member
+        of the album is returned, otherwise just the replied message itself.
+        """
+        if reply_msg.media_group_id:
+            try:
+                group = await client.get_media_group(reply_msg.chat.id, reply_msg.id)
+                media_msgs = [m for m in group if self._has_supported_media(m)]
+                if media_msgs:
+                    logging.info(f"[{self.session_name}] Found album {reply_msg.media_group_id} with {len(media_msgs)} media file(s)")
+                    return media_msgs
+            except Exception as e:
+                logging.warning(f"[{self.session_name}] Failed to fetch media group {reply_msg.media_group_id}: {e}")
+        
+        return [reply_msg] if self._has_supported_media(reply_msg) else []
+    
+    async def _download_message_media(self, client, msg: Message, background: bool = False) -> Optional[str]:
+        """Download media of a single message, refreshing it once if the file reference expired"""
+        async with self.background_download_slots if background else self.download_slots:
+            try:
+                return await download_media(client, msg, background)
+            except FileReferenceExpired:
+                logging.warning(f"[{self.session_name}] FileReferenceExpired, refreshing message {msg.id}...")
+                refreshed_msg = await client.get_messages(msg.chat.id, msg.id)
+                return await download_media(client, refreshed_msg, background)
+    
+    async def _download_background_media(self, client, msg: Message) -> Optional[str]:
+        """Download media for prefetch or transcription without taking the slots of requests"""
+        return await self._download_message_media(client, msg, background=True)
+    
+    async def _media_for_request(self, client, msg: Message) -> Optional[str]:
+        """Prefetched media of a message if there is any, downloaded now otherwise"""
+        if self.prefetcher is not None:
+            path = await self.prefetcher.take_media(msg)
+            if path:
+                return path
+        return await self._download_message_media(client, msg)
     
     async def media_command(self, client, message: Message):
-        """Analyze media file using Gemini"""
+        """Analyze media file (or a whole album) using Gemini"""
+        if self.draining:
+            await self.sender.reply(message, SHUTDOWN_TEXT)
+            return
+        
         # Check if Gemini client is available
         if not self.gemini_client:
-            await message.reply("❌ Ошибка: Gemini API key не настроен для этого бота.")
+            await self.sender.reply(message, "❌ Ошибка: Gemini API key не настроен для этого бота.")
             return
         
         # Check if the message is a reply to a message with media
         if not message.reply_to_message:
-            await message.reply("Эта команда должна быть использована в ответ на сообщение с медиафайлом")
+            await self.sender.reply(message, "Эта команда должна быть использована в ответ на сообщение с медиафайлом")
             return
         
-        reply_msg = message.reply_to_message
-        
-        # Check if reply has supported media
-        has_media = (
-            reply_msg.photo
-            or reply_msg.video
-            or reply_msg.voice
-            or reply_msg.audio
-            or getattr(reply_msg, "animation", None)
-            or getattr(reply_msg, "video_note", None)
-            or (reply_msg.document and reply_msg.document.mime_type and 
-                (reply_msg.document.mime_type.startswith(("image/", "video/", "audio/")) or 
-                 reply_msg.document.mime_type == "application/ogg"))
-        )
+        media_msgs = await self._collect_media_messages(client, message.reply_to_message)
         
-        if not has_media:
-            await message.reply("В сообщении, на которое вы отвечаете, нет поддерживаемого медиафайла")
+        if not media_msgs:
+            await self.sender.reply(message, "В сообщении, на которое вы отвечаете, нет поддерживаемого медиафайла")
             return
         
         # Get prompt from message
+        default_prompt = "Опиши этот медиафайл подробно" if len(media_msgs) == 1 else "Опиши эти медиафайлы подробно"
         prompt_parts = message.text.split(" ", 1)
-        prompt = prompt_parts[1].strip() if len(prompt_parts) > 1 else "Опиши этот медиафайл подробно"
+        prompt = prompt_parts[1].strip() if len(prompt_parts) > 1 else default_prompt
         
-        processing_msg = await message.reply("⏳ Загрузка и обработка медиафайла...")
-        media_path: Optional[str] = None
+        processing_msg = await self.sender.reply(message, f"⏳ Загрузка и обработка медиафайлов ({len(media_msgs)})..." if len(media_msgs) > 1 else "⏳ Загрузка и обработка медиафайла...")
+        media_paths: List[str] = []
         
         try:
-            # Download media file
-            try:
-                media_path = await download_media(client, reply_msg)
-            except FileReferenceExpired:
-                logging.warning(f"[{self.session_name}] FileReferenceExpired, refreshing message...")
-                refreshed_msg = await client.get_messages(message.chat.id, reply_msg.id)
-                media_path = await download_media(client, refreshed_msg)
+            # Download all media files concurrently (taking the ones prefetched already)
+            results = await asyncio.gather(
+                *(self._media_for_request(client, m) for m in media_msgs),
+                return_exceptions=True,
+            )
+            
+            rejected = None
+            for msg, result in zip(media_msgs, results):
+                if isinstance(result, MediaRejected):
+                    logging.warning(f"[{self.session_name}] Media of message {msg.id} rejected: {result}")
+                    rejected = result
+                elif isinstance(result, Exception):
+                    logging.error(f"[{self.session_name}] Failed to download media from message {msg.id}: {result}")
+                elif result and os.path.exists(result):
+                    media_paths.append(result)
             
-            if not media_path or not os.path.exists(media_path):
-                await processing_msg.edit_text("❌ Не удалось загрузить медиафайл")
+            # Skip empty downloads
+            non_empty_paths = [p for p in media_paths if os.path.getsize(p) > 0]
+            
+            if not media_paths:
+                await self.sender.edit(processing_msg, f"❌ {rejected}" if rejected else "❌ Не удалось загрузить медиафайл")
                 return
             
-            file_size = os.path.getsize(media_path)
-            if file_size == 0:
-                await processing_msg.edit_text("❌ Загруженный файл пустой (0 байт)")
-                if os.path.exists(media_path):
-                    os.remove(media_path)
+            if not non_empty_paths:
+                await self.sender.edit(processing_msg, "❌ Загруженный файл пустой (0 байт)")
                 return
             
-            await processing_msg.edit_text(f"✅ Файл загружен ({file_size} байт)\n⏳ Отправляем в Gemini...")
-            logging.info(f"[{self.session_name}] Calling Gemini for media analysis: {media_path}")
+            total_size = sum(os.path.getsize(p) for p in non_empty_paths)
+            # Status update is not awaited: if the answer arrives first, the pending edit is replaced by it
+            self.sender.edit(processing_msg, f"✅ Загружено файлов: {len(non_empty_paths)} ({total_size} байт)\n⏳ Отправляем в Gemini...", background=True)
+            route = routing.route_media(media_msgs, prompt)
+            logging.info(f"[{self.session_name}] Calling Gemini {route.model.value} ({route.reason}) for media analysis: {non_empty_paths}")
             
-            # Call Gemini API with media (using bot's personal client)
+            # Call Gemini API once with all media files (using bot's personal client)
+            started = time.perf_counter()
             response = await call_gemini_api(
                 client=self.gemini_client,
                 query=prompt,
-                media_paths=[media_path],
+                model=route.model,
+                media_paths=non_empty_paths,
                 is_media_request=True,
+                on_usage=self._usage_recorder(message, "media"),
             )
+            routing.record_call(route, time.perf_counter() - started, response)
             
             # Check for errors
-            if response.startswith("Ошибка"):
-                await processing_msg.edit_text(f"❌ {response}")
+            if isinstance(response, GeminiError):
+                await self.sender.edit(processing_msg, f"❌ {response}")
             else:
-                # Send successful response
-                try:
-                    await processing_msg.edit_text(response, parse_mode=ParseMode.MARKDOWN)
-                except Exception as e:
-                    logging.warning(f"Failed to send with Markdown: {e}, sending as plain text.")
-                    await processing_msg.edit_text(response)
+                # Send successful response: first chunk replaces the status message
+                chunks = render_chunks(response) or [EMPTY_RESPONSE_TEXT]
+                await self.sender.edit(processing_msg, chunks[0], parse_mode=ParseMode.HTML)
+                await self._reply_chunks(message, chunks[1:])
                 
                 # Store the response in database
                 self.db.store_message(
@@ -422,16 +745,12 @@ Tools: Google Search
         except Exception as e:
             error_msg = f"Критическая ошибка при обработке медиафайла: {str(e)}"
             logging.exception(f"[{self.session_name}] Critical error during media command:")
-            await processing_msg.edit_text(f"❌ {error_msg}")
+            await self.sender.edit(processing_msg, f"❌ {error_msg}")
         
         finally:
-            # Clean up local file
-            if media_path and os.path.exists(media_path):
-                try:
-                    os.remove(media_path)
-                    logging.info(f"Removed local media file: {media_path}")
-                except Exception as e_clean:
-                    logging.error(f"Failed to remove local media file: {e_clean}")
+            # Clean up local files
+            for media_path in media_paths:
+                remove_media_file(media_path)
     
     async def mark_important(self, client, message: Message):
         """Mark message as important (only for owner)"""
@@ -457,13 +776,13 @@ Tools: Google Search
             importance=MessageImportance.IMPORTANT
         )
         
-        await message.edit_text(f"{message.text}\n\nОтмечено как важное ⭐")
+        await self.sender.edit(message, f"{message.text}\n\nОтмечено как важное ⭐")
     
     async def process_gemini(self, client, message: Message):
         """Process Gemini request with chat history"""
         # Check if Gemini client is available
         if not self.gemini_client:
-            await message.reply("❌ Ошибка: Gemini API key не настроен для этого бота.")
+            await self.sender.reply(message, "❌ Ошибка: Gemini API key не настроен для этого бота.")
             return
         
         chat_id = message.chat.id
@@ -486,6 +805,19 @@ Tools: Google Search
             importance=MessageImportance.DEFAULT,
         )
         
+        if self.draining:
+            await self.sender.reply(message, SHUTDOWN_TEXT)
+            return
+        
+        # Answer in the per-chat queue: requests are processed in order and bounded globally
+        user_id = message.from_user.id if message.from_user else None
+        if not self.request_queue.submit(chat_id, user_id, lambda: self._answer_gemini(message)):
+            await self.sender.reply(message, "⏳ Слишком много запросов в этом чате, попробуйте чуть позже")
+    
+    async def _answer_gemini(self, message: Message):
+        """Build the prompt for a queued Gemini request, call the model and send the answer"""
+        chat_id = message.chat.id
+        
         # Extract query from message
         query = message.text
         if "," in query:
@@ -513,33 +845,44 @@ Tools: Google Search
                 except ValueError:
                     logging.warning(f"[{self.session_name}] Invalid context limit value, using default")
         
-        # Get chat history with specified limit
-        messages = self.db.get_last_messages(chat_id, limit=current_context_limit)
-        history = format_chat_history(messages)
-        
-        combined_query = history + "\n\nТекущий запрос пользователя: " + query
-        
-        # Select model based on query
-        model = GeminiModel.FLASH_THINKING if "!думай" in query.lower() else GeminiModel.FLASH
+        # Get chat history with specified limit (prefetched for recently active chats)
+        prefetched = self.prefetcher.history(chat_id, current_context_limit) if self.prefetcher is not None else None
+        if prefetched is not None:
+            messages, history_turns = prefetched
+        else:
+            messages = self.db.get_last_messages(chat_id, limit=current_context_limit)
+        with tracing.span("prompt.format", messages=len(messages), prefetched=prefetched is not None) as prompt_span:
+            if prefetched is None:
+                history_turns = build_history_turns(messages)
+            turns = add_query(history_turns, query)
+            chars = sum(len(text) for _, text in turns)
+            prompt_span.set(turns=len(turns), chars=chars)
+        
+        # Select model based on the query, context size and recent model health
+        route = routing.route_text(query, chars - len(query))
+        logging.info(f"[{self.session_name}] Routed Gemini request to {route.model.value} ({route.reason})")
         
         try:
             # Send a "Thinking..." message first
-            thinking_message = await message.reply("💭 Думаю...")
+            thinking_message = await self.sender.reply(message, "💭 Думаю...")
             
             try:
                 # Call Gemini API (using bot's personal client)
-                response = await call_gemini_api(self.gemini_client, combined_query, model)
+                started = time.perf_counter()
+                response = await call_gemini_api(
+                    self.gemini_client, turns[-1][1], route.model,
+                    history=turns[:-1],
+                    on_usage=self._usage_recorder(message, "gemini", len(messages)),
+                )
+                routing.record_call(route, time.perf_counter() - started, response)
                 
-                # Handle response sending
-                if len(response) > 4096:
-                    await thinking_message.delete()
-                    await self.send_chunked_response(message, response)
+                # Handle response sending (Markdown is rendered locally, each chunk is sent once)
+                chunks = render_chunks(response) or [EMPTY_RESPONSE_TEXT]
+                if len(chunks) > 1:
+                    await self.sender.delete(thinking_message)
+                    await self._reply_chunks(message, chunks)
                 else:
-                    try:
-                        await thinking_message.edit_text(response, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        logging.warning(f"Failed to send with Markdown: {e}")
-                        await thinking_message.edit_text(response, parse_mode=ParseMode.DISABLED)
+                    await self.sender.edit(thinking_message, chunks[0], parse_mode=ParseMode.HTML)
                 
                 # Store the Gemini response
                 self.db.store_message(
@@ -557,11 +900,11 @@ Tools: Google Search
                 logging.error(f"[{self.session_name}] {error_msg}")
                 if "thinking_message" in locals():
                     try:
-                        await thinking_message.edit_text(f"❌ {error_msg}")
+                        await self.sender.edit(thinking_message, f"❌ {error_msg}")
                     except Exception:
                         pass
                 else:
-                    await message.reply(f"❌ {error_msg}")
+                    await self.sender.reply(message, f"❌ {error_msg}")
 
         except (ValueError, KeyError) as e:
             error_str = str(e)
@@ -572,15 +915,22 @@ Tools: Google Search
     
     async def store_message(self, client, message: Message):
         """Store all messages in the database"""
-        # Skip messages without text content
-        if not message.text and not message.caption:
-            return
-        
         # Only store messages from whitelisted chats or owner's chats
         chat_id = message.chat.id
         if not (message.from_user and message.from_user.id == self.owner_id) and not self.db.is_chat_whitelisted(chat_id):
             return
         
+        # A reply to media may be followed by !media: start downloading it
+        reply = message.reply_to_message
+        if self.prefetcher is not None and reply is not None and not self.draining and self._has_supported_media(reply):
+            self.prefetcher.prefetch_media(client, reply)
+        
+        # Voice messages and video notes are stored once transcribed
+        if not message.text and not message.caption:
+            if self.transcriber is not None and not self.draining and self.gemini_client and Transcriber.wants(message):
+                self.transcriber.submit(client, message)
+            return
+        
         message_id = message.id
         author = message.from_user.first_name if message.from_user else "unknown"
         content = message.text or message.caption or ""
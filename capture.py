@@ -0,0 +1,194 @@
+import contextvars
+import datetime
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Opt-in capture of incoming traffic for offline replay (benchmarks/replay.py).
+#
+# When CAPTURE_DIR is set, every bot appends one JSON line per incoming update
+# to <CAPTURE_DIR>/<session>-<start time>.jsonl. Only metadata is stored:
+# chats and users are replaced by sequential aliases, message text is reduced
+# to its shape (commands, the Gemini trigger and the !контекст / !думай flags
+# are kept, every other word is replaced by x's of the same length) and media
+# by its type and size. Gemini answers are stored as their latency and token
+# counts, so the replay can stub them.
+
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "")
+
+FORMAT_VERSION = 1
+
+# Media attributes of a message, in the order they are checked
+MEDIA_KINDS = ("photo", "video", "voice", "audio", "video_note", "document", "animation", "sticker",
+               "contact", "location", "venue")
+
+# Words kept verbatim: commands and the words the router and handlers look for
+_KEEP_WORD = re.compile(r"(?i)^(![\w=]{1,30}|.*гемини.*)$")
+
+# Sequence numbers of recent messages, so Gemini usage can refer to the request that caused it
+_MAX_TRACKED = 10_000
+
+# Recorded Gemini answer for the update being replayed (set by the replay tool)
+replay_stub: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("replay_stub", default=None)
+
+
+def anonymize_text(text: str) -> str:
+    """Keep the shape of a message: commands and trigger words stay, other words become x's"""
+    return re.sub(r"\S+", lambda m: m.group(0) if _KEEP_WORD.match(m.group(0)) else "x" * len(m.group(0)), text)
+
+
+def media_info(message) -> Optional[Dict]:
+    """Type, size and duration of the media of a message (None if it has none)"""
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            info = {"kind": kind}
+            size = getattr(media, "file_size", None)
+            duration = getattr(media, "duration", None)
+            if isinstance(size, int):
+                info["size"] = size
+            if isinstance(duration, int):
+                info["duration"] = duration
+            return info
+    return None
+
+
+class TrafficRecorder:
+    """Append-only capture of the anonymized incoming traffic of one bot"""
+
+    def __init__(self, path: str, session_name: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._started = time.monotonic()
+        self._last_flush = self._started
+        self._chats: Dict[int, int] = {}
+        self._users: Dict[int, int] = {}
+        self._sequence = 0
+        self._messages: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self._write({"v": FORMAT_VERSION, "bot": session_name, "started": datetime.datetime.now().isoformat(timespec="seconds")})
+        logging.info(f"[{session_name}] Capturing traffic to {path}")
+
+    @classmethod
+    def for_bot(cls, session_name: str, capture_dir: str = CAPTURE_DIR) -> Optional["TrafficRecorder"]:
+        """Recorder writing to a new file in capture_dir, or None if capturing is disabled"""
+        if not capture_dir:
+            return None
+        os.makedirs(capture_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        return cls(os.path.join(capture_dir, f"{session_name}-{stamp}.jsonl"), session_name)
+
+    @staticmethod
+    def _alias(aliases: Dict[int, int], real_id: int) -> int:
+        alias = aliases.get(real_id)
+        if alias is None:
+            alias = aliases[real_id] = len(aliases) + 1
+        return alias
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        # Flushed about once a second: a crash loses at most the last second of traffic
+        now = time.monotonic()
+        if now - self._last_flush >= 1:
+            self._file.flush()
+            self._last_flush = now
+
+    def record_message(self, message, allowed: bool, owner: bool):
+        """
+        Record an incoming update
+
+        Args:
+            message: The incoming message
+            allowed: Whether the bot handles messages of this chat (whitelisted or owner)
+            owner: Whether the message was sent by the bot owner
+        """
+        self._sequence += 1
+        key = (message.chat.id, message.id)
+        self._messages[key] = self._sequence
+        if len(self._messages) > _MAX_TRACKED:
+            self._messages.popitem(last=False)
+
+        user = message.from_user
+        record = {
+            "t": round(time.monotonic() - self._started, 3),
+            "k": "m",
+            "n": self._sequence,
+            "c": self._alias(self._chats, message.chat.id),
+            "u": self._alias(self._users, user.id) if user else None,
+        }
+        if user and user.is_self or getattr(message, "outgoing", False):
+            record["me"] = 1
+        if owner:
+            record["o"] = 1
+        if allowed:
+            record["w"] = 1
+        if message.text:
+            record["text"] = anonymize_text(message.text)
+        elif message.caption:
+            record["caption"] = anonymize_text(message.caption)
+        media = media_info(message)
+        if media:
+            record["media"] = media
+        if message.media_group_id:
+            record["album"] = 1
+        if getattr(message, "forward_from", None) or getattr(message, "forward_from_chat", None):
+            record["fwd"] = 1
+        reply = message.reply_to_message
+        if reply is not None:
+            record["reply"] = media_info(reply) or {}
+
+        self._write(record)
+
+    def record_gemini(self, message, model: str, latency: float, input_tokens: int, output_tokens: int, thinking_tokens: int):
+        """Record the outcome of a Gemini call made for a message (the answer itself is not stored)"""
+        self._write({
+            "t": round(time.monotonic() - self._started, 3),
+            "k": "g",
+            "n": self._messages.get((message.chat.id, message.id)),
+            "model": model,
+            "lat": round(latency, 3),
+            "in": input_tokens,
+            "out": output_tokens,
+            "think": thinking_tokens,
+        })
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_capture(path: str) -> Tuple[dict, list, Dict[int, dict]]:
+    """
+    Load a capture file
+
+    Returns:
+        Header, message records in order and Gemini records by message sequence number
+    """
+    header: dict = {}
+    messages = []
+    gemini: Dict[int, dict] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off if the bot was killed while writing
+                logging.warning(f"{path}:{line_number}: skipping malformed record")
+                continue
+            kind = record.get("k")
+            if kind == "m":
+                messages.append(record)
+            elif kind == "g":
+                if record.get("n") is not None:
+                    gemini[record["n"]] = record
+            elif "v" in record:
+                if record["v"] != FORMAT_VERSION:
+                    raise ValueError(f"{path}: unsupported capture format version {record['v']}")
+                header = record
+    return header, messages, gemini
@@ -2,7 +2,126 @@ import sqlite3
 import os
 import datetime
 import enum
-from typing import List, Tuple, Optional
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple, Optional, Set
+
+import metrics
+import tracing
+
+DB_QUERY_SECONDS = metrics.histogram("db_query_seconds", "Duration of Database method calls", ["method"])
+DB_STATEMENT_SECONDS = metrics.histogram("db_statement_seconds", "Duration of single SQL statements including fetching", ["statement"])
+DB_SLOW_STATEMENTS = metrics.counter("db_slow_statements_total", "SQL statements slower than DB_SLOW_QUERY_MS", ["statement"])
+
+# Statements slower than this are logged with their parameters and query plan (milliseconds)
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "100"))
+# Seconds the in-memory whitelist is trusted before it is read again, so that
+# changes made by other processes (shards, a restored backup) are picked up
+WHITELIST_TTL = float(os.environ.get("WHITELIST_TTL", "30"))
+
+
+@dataclass
+class QueryStats:
+    """Aggregated timing of one SQL statement"""
+    calls: int = 0
+    slow: int = 0
+    rows: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+def _normalize(sql: str) -> str:
+    """Statement text with whitespace collapsed, used as the aggregation key"""
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """
+    Cursor timing every statement, including the fetches of its rows
+
+    SQLite produces rows lazily, so most of the time of a SELECT is spent in
+    fetchall() rather than in execute(); both count towards the statement.
+    """
+
+    def execute(self, sql, parameters=()):
+        self._statement = _normalize(sql)
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._logged = False
+        self.connection.query_stats.setdefault(self._statement, QueryStats()).calls += 1
+        return self._timed(super().execute, sql, parameters)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        self._count_rows(1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, size if size is not None else self.arraysize)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._count_rows(len(rows))
+        return rows
+
+    def _count_rows(self, count: int):
+        if getattr(self, "_statement", None) is not None:
+            self.connection.query_stats[self._statement].rows += count
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            if getattr(self, "_statement", None) is not None:
+                self._observe(time.perf_counter() - started)
+
+    def _observe(self, elapsed: float):
+        stats = self.connection.query_stats[self._statement]
+        self._elapsed += elapsed
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, self._elapsed)
+        DB_STATEMENT_SECONDS.observe(elapsed, statement=self._statement[:100])
+
+        if not self._logged and self._elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            self._logged = True
+            stats.slow += 1
+            DB_SLOW_STATEMENTS.inc(statement=self._statement[:100])
+            logging.warning(
+                f"Slow query ({self._elapsed * 1000:.1f} ms): {self._statement} "
+                f"params={repr(self._parameters)[:200]} plan: {self._query_plan()}"
+            )
+
+    def _query_plan(self) -> str:
+        try:
+            # A plain cursor, so the EXPLAIN itself is not timed
+            rows = sqlite3.Cursor(self.connection).execute(f"EXPLAIN QUERY PLAN {self._statement}", self._parameters).fetchall()
+        except sqlite3.Error as e:
+            return f"(unavailable: {e})"
+        return "; ".join(row[-1] for row in rows) or "(none)"
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection handing out _TimedCursor and aggregating into the owning Database's query_stats"""
+
+    query_stats: Dict[str, QueryStats]
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+
+def _instrumented(func):
+    """Observe every call in DB_QUERY_SECONDS and record it as a "db.<method>" span"""
+    return metrics.timed(DB_QUERY_SECONDS)(tracing.traced(f"db.{func.__name__}")(func))
+
 
 class MessageImportance(enum.Enum):
     GEMINI = "Gemini"
@@ -10,13 +129,37 @@ class MessageImportance(enum.Enum):
     DEFAULT = "None"
 
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, init_schema: bool = True):
+        """
+        Args:
+            db_path: Path to the SQLite database file
+            init_schema: Create missing tables right away; pass False to call create_tables() later
+        """
         self.db_path = db_path
-        self.create_tables()
+        # In-memory copy of whitelisted_chats, loaded on first use and again after WHITELIST_TTL
+        self._whitelist: Optional[Set[int]] = None
+        self._whitelist_loaded = 0.0
+        # Timing of every SQL statement run through this instance (normalized SQL -> stats)
+        self.query_stats: Dict[str, QueryStats] = {}
+        # Called as listener(chat_id, row) after a message is stored; row has the columns of get_last_messages
+        self.store_listeners: List[Callable[[int, Tuple], None]] = []
+        # Called as listener(chat_id) after stored messages of a chat were changed (e.g. unpinned)
+        self.change_listeners: List[Callable[[int], None]] = []
+        if init_schema:
+            self.create_tables()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection whose statements are timed into query_stats"""
+        conn = sqlite3.connect(self.db_path, factory=_TimedConnection)
+        conn.query_stats = self.query_stats
+        return conn
     
+    @_instrumented
     def create_tables(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            # Write-ahead log: readers (e.g. online backups) never block writers
+            cursor.execute("PRAGMA journal_mode=WAL")
             # Whitelist table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS whitelisted_chats (
@@ -36,38 +179,70 @@ class Database:
                     important TEXT
                 )
             ''')
+            # Token usage of Gemini requests
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS gemini_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    user_id INTEGER,
+                    date TEXT,
+                    model TEXT,
+                    request_type TEXT,
+                    context_size INTEGER,
+                    input_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    output_tokens INTEGER,
+                    thinking_tokens INTEGER,
+                    latency REAL,
+                    cost REAL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_gemini_usage_date ON gemini_usage (date)')
             conn.commit()
     
     # Whitelist methods
+    def _load_whitelist(self) -> Set[int]:
+        """Load whitelisted chats into memory (the table is small and changes rarely)"""
+        now = time.monotonic()
+        if self._whitelist is None or now - self._whitelist_loaded > WHITELIST_TTL:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT chat_id FROM whitelisted_chats')
+                self._whitelist = {row[0] for row in cursor.fetchall()}
+            self._whitelist_loaded = now
+        return self._whitelist
+    
     def is_chat_whitelisted(self, chat_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT 1 FROM whitelisted_chats WHERE chat_id = ?', (chat_id,))
-            return cursor.fetchone() is not None
+        return chat_id in self._load_whitelist()
     
+    @_instrumented
     def add_chat_to_whitelist(self, chat_id):
         if not self.is_chat_whitelisted(chat_id):
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('INSERT INTO whitelisted_chats (chat_id) VALUES (?)', (chat_id,))
                 conn.commit()
-                return True
+            self._whitelist.add(chat_id)
+            return True
         return False
     
+    @_instrumented
     def remove_chat_from_whitelist(self, chat_id):
         if self.is_chat_whitelisted(chat_id):
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM whitelisted_chats WHERE chat_id = ?', (chat_id,))
                 conn.commit()
-                return True
+            self._whitelist.discard(chat_id)
+            return True
         return False
     
     # Message storage methods
+    @_instrumented
     def store_message(self, chat_id: int, message_id: int, author: str, 
                      date: datetime.datetime, content: str, tags: str, 
                      importance: MessageImportance = MessageImportance.DEFAULT):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -77,9 +252,17 @@ class Database:
                 (chat_id, message_id, author, date.isoformat(), content, tags, importance.value)
             )
             conn.commit()
+        
+        row = (message_id, author, date.isoformat(), content, tags, importance.value)
+        for listener in self.store_listeners:
+            try:
+                listener(chat_id, row)
+            except Exception as e:
+                logging.error(f"Error in message store listener: {e}", exc_info=True)
     
+    @_instrumented
     def get_last_messages(self, chat_id: int, limit: int = 120) -> List[Tuple]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # Get all important messages
@@ -110,9 +293,10 @@ class Database:
             # Combine important and normal messages
             return normal_messages + important_messages
     
+    @_instrumented
     def get_stats(self) -> dict:
         """Get database statistics"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # Total messages
@@ -148,9 +332,10 @@ class Database:
                 'messages_by_chat': messages_by_chat
             }
     
+    @_instrumented
     def get_pinned_messages(self, chat_id: int) -> List[Tuple]:
         """Get all pinned (important) messages for a chat"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -163,13 +348,97 @@ class Database:
             )
             return cursor.fetchall()
     
+    @_instrumented
     def unpin_message(self, db_id: int) -> bool:
         """Remove important flag from a message by database ID"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT chat_id FROM messages WHERE id=? AND important='Important'", (db_id,))
+            found = cursor.fetchone()
+            if found is None:
+                return False
             cursor.execute(
                 "UPDATE messages SET important='None' WHERE id=? AND important='Important'",
                 (db_id,)
             )
             conn.commit()
-            return cursor.rowcount > 0
+            if cursor.rowcount == 0:
+                return False
+        
+        for listener in self.change_listeners:
+            try:
+                listener(found[0])
+            except Exception as e:
+                logging.error(f"Error in message change listener: {e}", exc_info=True)
+        return True
+    
+    # Gemini usage methods
+    @_instrumented
+    def store_usage(self, chat_id: int, user_id: Optional[int], model: str, request_type: str, context_size: int,
+                    input_tokens: int, cached_tokens: int, output_tokens: int, thinking_tokens: int,
+                    latency: float, cost: float, date: Optional[datetime.datetime] = None):
+        """Record token usage of one Gemini request"""
+        date = date or datetime.datetime.now()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO gemini_usage (chat_id, user_id, date, model, request_type, context_size,
+                                          input_tokens, cached_tokens, output_tokens, thinking_tokens, latency, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (chat_id, user_id, date.isoformat(), model, request_type, context_size,
+                 input_tokens, cached_tokens, output_tokens, thinking_tokens, latency, cost)
+            )
+            conn.commit()
+    
+    @_instrumented
+    def get_usage_stats(self, since: datetime.datetime, top: int = 5) -> dict:
+        """
+        Usage rollups since the given time
+        
+        Returns:
+            Dictionary with 'totals' (requests, input, cached, output, thinking, cost, avg latency),
+            'by_day' and 'by_model' rows and the 'top_chats' by cost
+            (chat_id, requests, input, output + thinking, cost, avg context size)
+        """
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            since_str = since.isoformat()
+            
+            cursor.execute("""
+                SELECT COUNT(*), COALESCE(SUM(input_tokens), 0), COALESCE(SUM(cached_tokens), 0),
+                       COALESCE(SUM(output_tokens), 0), COALESCE(SUM(thinking_tokens), 0),
+                       COALESCE(SUM(cost), 0), COALESCE(AVG(latency), 0)
+                FROM gemini_usage WHERE date >= ?
+            """, (since_str,))
+            totals = cursor.fetchone()
+            
+            cursor.execute("""
+                SELECT substr(date, 1, 10) AS day, COUNT(*), SUM(input_tokens), SUM(output_tokens + thinking_tokens), SUM(cost)
+                FROM gemini_usage WHERE date >= ?
+                GROUP BY day ORDER BY day
+            """, (since_str,))
+            by_day = cursor.fetchall()
+            
+            cursor.execute("""
+                SELECT model, COUNT(*), SUM(input_tokens), SUM(output_tokens + thinking_tokens), SUM(cost), AVG(latency)
+                FROM gemini_usage WHERE date >= ?
+                GROUP BY model ORDER BY SUM(cost) DESC
+            """, (since_str,))
+            by_model = cursor.fetchall()
+            
+            cursor.execute("""
+                SELECT chat_id, COUNT(*), SUM(input_tokens), SUM(output_tokens + thinking_tokens), SUM(cost), AVG(context_size)
+                FROM gemini_usage WHERE date >= ?
+                GROUP BY chat_id ORDER BY SUM(cost) DESC, SUM(input_tokens) DESC
+                LIMIT ?
+            """, (since_str, top))
+            top_chats = cursor.fetchall()
+            
+            return {
+                'totals': totals,
+                'by_day': by_day,
+                'by_model': by_model,
+                'top_chats': top_chats,
+            }
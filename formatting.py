@@ -0,0 +1,269 @@
+import html
+import re
+from typing import List, Optional, Tuple
+
+# Telegram limit for a single message text (in UTF-16 code units)
+MAX_MESSAGE_LENGTH = 4096
+
+# Inline delimiters understood by Pyrogram's Markdown flavour and their HTML tags
+INLINE_TAGS = {
+    "**": "b",
+    "__": "i",
+    "--": "u",
+    "~~": "s",
+    "||": "spoiler",
+}
+
+FENCE_RE = re.compile(r"^\s*```")
+# Longest info string (language) kept when a code block is reopened in the next chunk
+MAX_FENCE_INFO = 32
+INLINE_RE = re.compile(r"(`+)|\[([^\[\]\n]+)\]\(((?:https?|tg)://[^\s()]+)\)|(\*\*|__|--|~~|\|\|)")
+WORD_RE = re.compile(r"\S+\s*|\s+")
+
+
+def utf16_len(text: str) -> int:
+    """Length of a string in UTF-16 code units, as counted by Telegram"""
+    return len(text) + sum(1 for c in text if ord(c) > 0xFFFF)
+
+
+def escape_text(text: str) -> str:
+    """
+    Escape plain text for Pyrogram's HTML parser.
+
+    Pyrogram unescapes character references twice (once in HTMLParser and
+    once more in handle_data), so "&" has to be escaped twice to survive.
+    """
+    return text.replace("&", "&amp;amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _render_inline(line: str) -> str:
+    """
+    Render one line of Markdown (outside of code blocks) to HTML.
+
+    Delimiters are paired within the line only: an opening delimiter must be
+    followed by a non-space character and a closing one preceded by one.
+    Delimiters without a partner and crossing pairs are kept as literal text,
+    so the result is always well-formed.
+    """
+    # Tokens: (start, end, kind, payload); kind is "text", "code", "link" or "delim"
+    tokens: List[Tuple[int, int, str, Optional[str]]] = []
+    pos = 0
+    length = len(line)
+
+    while pos < length:
+        match = INLINE_RE.search(line, pos)
+        if not match:
+            break
+        start, end = match.span()
+        ticks, link_text, link_url, delim = match.groups()
+
+        if ticks:
+            close = line.find(ticks, end)
+            if close != -1 and close > end:
+                tokens.append((start, close + len(ticks), "code", line[end:close]))
+                pos = close + len(ticks)
+            else:
+                pos = end
+            continue
+
+        if link_text:
+            tokens.append((start, end, "link", None))
+            pos = end
+            continue
+
+        tokens.append((start, end, "delim", delim))
+        pos = end
+
+    # Pair delimiters with a stack; unmatched ones stay literal
+    pairs = {}
+    stack: List[int] = []
+    for idx, (start, end, kind, payload) in enumerate(tokens):
+        if kind != "delim":
+            continue
+        can_close = start > 0 and not line[start - 1].isspace()
+        can_open = end < length and not line[end].isspace()
+
+        open_idx = next((i for i in range(len(stack) - 1, -1, -1) if tokens[stack[i]][3] == payload), None)
+        if can_close and open_idx is not None and tokens[stack[open_idx]][1] < start:
+            # Delimiters opened after the matching one can no longer be closed properly
+            opener = stack[open_idx]
+            del stack[open_idx:]
+            pairs[opener] = idx
+            pairs[idx] = opener
+        elif can_open:
+            stack.append(idx)
+
+    out: List[str] = []
+    pos = 0
+    for idx, (start, end, kind, payload) in enumerate(tokens):
+        out.append(escape_text(line[pos:start]))
+        if kind == "code":
+            out.append(f"<code>{escape_text(payload)}</code>")
+        elif kind == "link":
+            match = INLINE_RE.match(line, start)
+            out.append(f'<a href="{html.escape(match.group(3), quote=True)}">{escape_text(match.group(2))}</a>')
+        elif idx in pairs:
+            tag = INLINE_TAGS[payload]
+            out.append(f"<{tag}>" if pairs[idx] > idx else f"</{tag}>")
+        else:
+            out.append(escape_text(payload))
+        pos = end
+    out.append(escape_text(line[pos:]))
+
+    return "".join(out)
+
+
+def render_markdown(text: str) -> str:
+    """
+    Render Markdown produced by Gemini to HTML for ParseMode.HTML.
+
+    Code blocks (```lang ... ```) become <pre>, an unterminated block is closed
+    at the end of the text. Everything else is rendered line by line with
+    _render_inline, and all plain text is escaped, so Telegram never rejects
+    the markup and every message can be sent in a single request.
+    """
+    out: List[str] = []
+    code_lines: Optional[List[str]] = None
+    language = ""
+
+    for line in text.split("\n"):
+        if FENCE_RE.match(line):
+            if code_lines is None:
+                language = line.strip()[3:].strip()
+                code_lines = []
+            else:
+                out.append(_render_pre(code_lines, language))
+                code_lines = None
+            continue
+
+        if code_lines is not None:
+            code_lines.append(line)
+        else:
+            out.append(_render_inline(line))
+
+    if code_lines is not None:
+        out.append(_render_pre(code_lines, language))
+
+    return "\n".join(out)
+
+
+def _render_pre(lines: List[str], language: str) -> str:
+    """Render the body of a code block"""
+    body = escape_text("\n".join(lines))
+    if language:
+        return f'<pre language="{html.escape(language, quote=True)}">{body}</pre>'
+    return f"<pre>{body}</pre>"
+
+
+def _split_long_line(line: str, limit: int) -> List[str]:
+    """Split a line longer than limit at whitespace, cutting words only if they do not fit"""
+    pieces: List[str] = []
+    current: List[str] = []
+    current_len = 0
+
+    for word in WORD_RE.findall(line):
+        word_len = utf16_len(word)
+        if current_len + word_len > limit and current:
+            pieces.append("".join(current))
+            current, current_len = [], 0
+
+        while word_len > limit:
+            # Hard cut of a single oversized word
+            cut, cut_len = 0, 0
+            while cut < len(word) and cut_len + utf16_len(word[cut]) <= limit:
+                cut_len += utf16_len(word[cut])
+                cut += 1
+            if cut == 0:
+                # A character wider than the limit (surrogate pair with limit 1) still has to move on
+                cut, cut_len = 1, utf16_len(word[0])
+            pieces.append(word[:cut])
+            word = word[cut:]
+            word_len -= cut_len
+
+        if word:
+            current.append(word)
+            current_len += word_len
+
+    if current:
+        pieces.append("".join(current))
+
+    return pieces
+
+
+def _reopened_fence(line: str, max_info: int) -> str:
+    """Opening fence repeated at the start of following chunks, with a bounded info string"""
+    info = line.strip()[3:].strip()
+    if utf16_len(info) > min(MAX_FENCE_INFO, max_info) or " " in info:
+        info = ""
+    return "```" + info
+
+
+def split_markdown(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split Markdown text into chunks no longer than max_length.
+
+    Chunks are cut on line boundaries where possible; lines longer than the
+    limit are split at whitespace. A code block crossing a chunk boundary is
+    closed at the end of the chunk and reopened (with its language) at the
+    start of the next one. Runs in linear time.
+
+    Args:
+        text: Markdown text
+        max_length: Maximum chunk length in UTF-16 code units
+
+    Returns:
+        List of Markdown chunks
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_len = 0
+    fence: Optional[str] = None
+    # Room for the closing fence that may have to be appended
+    reserve = 4
+
+    def flush():
+        nonlocal current, current_len
+        if fence is not None:
+            current.append("```")
+        chunk = "\n".join(current)
+        if chunk.strip() and chunk.strip() != fence:
+            chunks.append(chunk)
+        current = [fence] if fence is not None else []
+        current_len = utf16_len(fence) + 1 if fence is not None else 0
+
+    limit = max(1, max_length - reserve - 1)
+
+    for line in text.split("\n"):
+        is_fence = bool(FENCE_RE.match(line))
+        line_limit = limit - (utf16_len(fence) + 1 if fence is not None else 0)
+        pieces = [line] if utf16_len(line) <= line_limit else _split_long_line(line, max(1, line_limit))
+
+        for piece in pieces:
+            piece_len = utf16_len(piece) + (1 if current else 0)
+            if current and current_len + piece_len + reserve > max_length:
+                flush()
+                piece_len = utf16_len(piece) + (1 if current else 0)
+            current.append(piece)
+            current_len += piece_len
+
+        if is_fence:
+            fence = _reopened_fence(line, max_length // 4) if fence is None else None
+
+    fence = None
+    flush()
+
+    return chunks
+
+
+def render_chunks(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split Markdown text into message-sized chunks and render each to HTML
+
+    Args:
+        text: Markdown text
+        max_length: Maximum visible length of a chunk
+
+    Returns:
+        List of HTML chunks ready to be sent with ParseMode.HTML
+    """
+    return [render_markdown(chunk) for chunk in split_markdown(text, max_length)]
@@ -1,114 +1,538 @@
 import asyncio
+import contextlib
+import enum
 import json
 import logging
 import os
+import random
+import signal
 import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
 
+from pyrogram.errors import AuthKeyDuplicated, Unauthorized
+
+from ai_service import cleanup_downloaded_media, cleanup_pending_uploads
 from bot import Bot
+import metrics
+import resources
+import scratch
+from backup import BACKUP_DIR, BackupScheduler
+import tracing
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+CONFIG_PATH = "config.json"
+REQUIRED_FIELDS = ["session_name", "api_id", "api_hash", "bot_owner_id", "database_path", "gemini_api_key"]
+# Fields that have to be integers when present
+INTEGER_FIELDS = ["api_id", "bot_owner_id", "max_concurrent_requests", "max_queued_per_chat"]
+
+# Settings that a running bot can apply without reconnecting, with their defaults
+HOT_RELOADABLE_FIELDS = {
+    "gemini_api_key": "",
+    "max_concurrent_requests": 4,
+    "max_queued_per_chat": 3,
+}
+
+# How often config.json is checked for changes (seconds)
+CONFIG_POLL_INTERVAL = 5
+
+# Restart backoff for failed bots (seconds): delays grow from BACKOFF_BASE up to
+# BACKOFF_MAX and reset after a bot has been running for BACKOFF_RESET
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+BACKOFF_RESET = 600
 
+# How many bots may connect to Telegram at the same time, so many accounts
+# start in parallel without all connecting at once
+START_CONCURRENCY = int(os.environ.get("START_CONCURRENCY", "4"))
 
-async def run_bot(config: dict):
+# Time given to in-flight requests to finish on shutdown (seconds)
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "20"))
+
+
+def create_bot(config: dict) -> Bot:
     """
-    Initialize and run a single bot instance
-    
+    Create a bot instance from its configuration
+
     Args:
         config: Configuration dictionary for the bot
     """
-    session_name = config.get("session_name")
-    
-    if not session_name:
-        logging.error("Bot configuration missing 'session_name'")
-        return
-    
+    session_name = config["session_name"]
     logging.info(f"Initializing bot: {session_name}")
-    
-    try:
-        # Create bot instance
-        bot = Bot(
-            session_name=session_name,
-            api_id=config.get("api_id"),
-            api_hash=config.get("api_hash"),
-            bot_owner_id=config.get("bot_owner_id"),
-            db_path=config.get("database_path", f"data/{session_name}.db"),
-            gemini_api_key=config.get("gemini_api_key", "")
-        )
-        
-        # Start the bot
+
+    return Bot(
+        session_name=session_name,
+        api_id=config.get("api_id"),
+        api_hash=config.get("api_hash"),
+        bot_owner_id=config.get("bot_owner_id"),
+        db_path=config.get("database_path", f"data/{session_name}.db"),
+        **{key: config.get(key, default) for key, default in HOT_RELOADABLE_FIELDS.items()},
+    )
+
+
+class BotState(enum.Enum):
+    STARTING = "starting"
+    RUNNING = "running"
+    BACKOFF = "backoff"
+    FAILED = "failed"
+
+
+@dataclass
+class BotStatus:
+    """Supervision state of a bot"""
+    state: BotState = BotState.STARTING
+    restarts: int = 0
+    last_error: Optional[str] = None
+    since: float = field(default_factory=time.monotonic)
+
+    def set(self, state: BotState, error: Optional[str] = None):
+        self.state = state
+        self.since = time.monotonic()
+        if error is not None:
+            self.last_error = error
+
+
+def is_fatal_error(e: Exception) -> bool:
+    """
+    Errors that a restart cannot fix: revoked or invalid authorization, or a
+    session that needs interactive login. Broken configs are rejected by
+    read_configs before a bot is created; any other error is retried.
+    """
+    return isinstance(e, (Unauthorized, AuthKeyDuplicated, EOFError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """Capped exponential backoff with full jitter"""
+    return random.uniform(BACKOFF_BASE, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+async def run_bot(bot: Bot, status: Optional[BotStatus] = None, start_limit: Optional[asyncio.Semaphore] = None):
+    """
+    Start a bot and keep it running until it fails or the task is cancelled
+
+    Args:
+        bot: Bot instance to run
+        status: Optional status object that is switched to RUNNING after start
+        start_limit: Optional semaphore held while the bot connects
+
+    Raises:
+        Exception: Whatever made the bot fail (start error or dead connection)
+    """
+    # Start the bot
+    async with start_limit or contextlib.nullcontext():
         await bot.start()
-        logging.info(f"Bot {session_name} started successfully.")
-        
-        # Keep running indefinitely
-        await asyncio.Event().wait()
-        
-    except Exception as e:
-        logging.error(f"Failed to start or run bot {session_name}: {e}", exc_info=True)
+    logging.info(f"Bot {bot.session_name} started successfully.")
+    if status is not None:
+        status.set(BotState.RUNNING)
 
+    # Keep running until cancelled or the connection is dead
+    await bot.monitor()
 
-async def main():
-    """Main entry point - loads config and starts all bots"""
-    
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
-    )
-    
-    logging.info("Starting Business Bot Service...")
-    
-    # Ensure data directory exists
-    os.makedirs("data", exist_ok=True)
-    
-    # Load configuration
-    config_path = "config.json"
-    
+
+async def supervise_bot(bot: Bot, status: BotStatus, start_limit: Optional[asyncio.Semaphore] = None):
+    """
+    Run a bot and restart it with exponential backoff when it fails
+
+    Fatal errors (see is_fatal_error) are not retried. The backoff resets once
+    the bot has been running for BACKOFF_RESET seconds.
+
+    Args:
+        bot: Bot instance to run
+        status: Status object updated with the current state
+        start_limit: Optional semaphore limiting how many bots connect at once
+    """
+    name = bot.session_name
+    attempt = 0
+    # Label everything this task does (start, health checks) with the bot in metrics
+    metrics.current_bot.set(name)
+
+    while True:
+        status.set(BotState.STARTING)
+        started = time.monotonic()
+        try:
+            await run_bot(bot, status, start_limit)
+        except asyncio.CancelledError:
+            await bot.stop()
+            raise
+        except Exception as e:
+            with contextlib.suppress(Exception):
+                await bot.stop()
+
+            if is_fatal_error(e):
+                status.set(BotState.FAILED, repr(e))
+                logging.error(f"Bot {name} failed with a fatal error, not restarting: {e}", exc_info=True)
+                return
+
+            if time.monotonic() - started > BACKOFF_RESET:
+                attempt = 0
+            delay = backoff_delay(attempt)
+            attempt += 1
+            status.restarts += 1
+            status.set(BotState.BACKOFF, repr(e))
+            logging.error(f"Bot {name} failed: {e}. Restarting in {delay:.1f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+
+
+def setup_logging():
+    """Configure logging for the single-process mode"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(tracing.log_formatter(LOG_FORMAT))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    tracing.install_log_context()
+
+
+def read_configs(config_path: str = CONFIG_PATH) -> list:
+    """
+    Read and validate bot configurations
+
+    Args:
+        config_path: Path to the JSON config file
+
+    Returns:
+        List of bot configuration dictionaries
+
+    Raises:
+        ValueError: If the file is missing, malformed or a config is invalid
+    """
     if not os.path.exists(config_path):
-        logging.error(f"Configuration file not found: {config_path}")
-        logging.error("Please create config.json based on config.json.example")
-        sys.exit(1)
-    
+        raise ValueError(f"Configuration file not found: {config_path}")
+
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
             configs = json.load(f)
     except json.JSONDecodeError as e:
-        logging.error(f"Could not parse config.json: {e}")
-        sys.exit(1)
-    except Exception as e:
-        logging.error(f"Error loading config.json: {e}")
-        sys.exit(1)
-    
+        raise ValueError(f"Could not parse {config_path}: {e}")
+    except OSError as e:
+        raise ValueError(f"Error loading {config_path}: {e}")
+
     if not configs:
-        logging.warning("Config file is empty. No bots to run.")
-        sys.exit(0)
-    
+        return []
+
     if not isinstance(configs, list):
-        logging.error("config.json should contain a JSON array of bot configurations")
-        sys.exit(1)
-    
-    logging.info(f"Loaded {len(configs)} bot configuration(s)")
-    
+        raise ValueError(f"{config_path} should contain a JSON array of bot configurations")
+
     # Validate configurations
+    names = set()
     for i, config in enumerate(configs):
-        required_fields = ["session_name", "api_id", "api_hash", "bot_owner_id", "database_path", "gemini_api_key"]
-        missing = [field for field in required_fields if field not in config]
-        
+        missing = [field for field in REQUIRED_FIELDS if field not in config]
+
         if missing:
-            logging.error(f"Bot config #{i+1} is missing required fields: {missing}")
-            sys.exit(1)
-        
+            raise ValueError(f"Bot config #{i+1} is missing required fields: {missing}")
+
+        if config["session_name"] in names:
+            raise ValueError(f"Bot config #{i+1} has duplicate session_name '{config['session_name']}'")
+        names.add(config["session_name"])
+
+        # Wrong types would only fail once the bot connects
+        for key in INTEGER_FIELDS:
+            value = config.get(key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                raise ValueError(f"Bot config #{i+1} ({config['session_name']}): {key} must be an integer")
+        if not isinstance(config["api_hash"], str) or not config["api_hash"]:
+            raise ValueError(f"Bot config #{i+1} ({config['session_name']}): api_hash must be a non-empty string")
+
         # Warn if Gemini API key is empty
         if not config.get("gemini_api_key"):
             logging.warning(f"Bot config #{i+1} ({config.get('session_name')}) has empty gemini_api_key. AI features will not work.")
-    
-    # Create and run tasks for each bot
-    tasks = [asyncio.create_task(run_bot(config)) for config in configs]
-    
-    logging.info(f"Starting {len(tasks)} bot(s)...")
-    
-    # Wait for all tasks
-    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return configs
+
+
+def load_configs(config_path: str = CONFIG_PATH) -> list:
+    """
+    Load and validate bot configurations, exiting the process on fatal errors
+
+    Args:
+        config_path: Path to the JSON config file
+
+    Returns:
+        List of bot configuration dictionaries
+    """
+    try:
+        configs = read_configs(config_path)
+    except ValueError as e:
+        logging.error(str(e))
+        if not os.path.exists(config_path):
+            logging.error("Please create config.json based on config.json.example")
+        sys.exit(1)
+
+    if not configs:
+        logging.warning("Config file is empty. No bots to run.")
+        sys.exit(0)
+
+    logging.info(f"Loaded {len(configs)} bot configuration(s)")
+    return configs
+
+
+class BotManager:
+    """
+    Runs a set of bots and applies config.json changes to it without a restart.
+
+    Bots are identified by session_name. On reload, new bots are started,
+    removed bots are stopped, bots whose changes are limited to
+    HOT_RELOADABLE_FIELDS get the new settings in place, and bots with other
+    changes are restarted. Bots whose config did not change are not touched.
+    """
+
+    def __init__(self, config_path: str = CONFIG_PATH, config_filter: Optional[Callable[[dict], bool]] = None):
+        """
+        Args:
+            config_path: Path to the JSON config file to watch
+            config_filter: Optional predicate selecting the bots this manager runs (used by shards)
+        """
+        self.config_path = config_path
+        self.config_filter = config_filter
+        self.configs: Dict[str, dict] = {}
+        self.bots: Dict[str, Bot] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.statuses: Dict[str, BotStatus] = {}
+        self._reload_requested = asyncio.Event()
+        self._config_mtime: Optional[float] = None
+        self._start_limit = asyncio.Semaphore(max(1, START_CONCURRENCY))
+
+    async def apply(self, configs: list):
+        """
+        Bring the running set of bots in line with the given configurations
+
+        Args:
+            configs: Full list of bot configuration dictionaries
+        """
+        if self.config_filter:
+            configs = [c for c in configs if self.config_filter(c)]
+        new_configs = {c["session_name"]: c for c in configs}
+
+        removed = [name for name in self.configs if name not in new_configs]
+        added = [name for name in new_configs if name not in self.configs]
+        changed = [name for name in new_configs if name in self.configs and new_configs[name] != self.configs[name]]
+
+        for name in removed:
+            logging.info(f"Bot {name} was removed from config, stopping")
+            await self._stop_bot(name)
+
+        for name in changed:
+            old, new = self.configs[name], new_configs[name]
+            changed_fields = {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+            if changed_fields <= HOT_RELOADABLE_FIELDS.keys() and name in self.bots:
+                logging.info(f"Applying new settings to bot {name}: {sorted(changed_fields)}")
+                self.bots[name].update_settings(**{key: new.get(key, HOT_RELOADABLE_FIELDS[key]) for key in changed_fields})
+                self.configs[name] = new
+            else:
+                logging.info(f"Config of bot {name} changed ({sorted(changed_fields)}), restarting")
+                await self._stop_bot(name)
+                self._start_bot(new)
+
+        for name in added:
+            self._start_bot(new_configs[name])
+
+        if removed or added or changed:
+            logging.info(f"Running {len(self.tasks)} bot(s) (+{len(added)} -{len(removed)} ~{len(changed)})")
+
+    def _start_bot(self, config: dict):
+        name = config["session_name"]
+        try:
+            bot = create_bot(config)
+        except Exception as e:
+            logging.error(f"Failed to create bot {name}: {e}", exc_info=True)
+            return
+        self.configs[name] = config
+        self.bots[name] = bot
+        self.statuses[name] = BotStatus()
+        self.tasks[name] = asyncio.create_task(supervise_bot(bot, self.statuses[name], self._start_limit))
+
+    async def _stop_bot(self, name: str, timeout: float = SHUTDOWN_TIMEOUT):
+        """Drain a bot (see Bot.shutdown), then cancel its supervision"""
+        task = self.tasks.pop(name, None)
+        bot = self.bots.pop(name, None)
+        self.configs.pop(name, None)
+        self.statuses.pop(name, None)
+        if bot is not None:
+            try:
+                await bot.shutdown(timeout)
+            except Exception as e:
+                logging.error(f"Error while shutting down bot {name}: {e}", exc_info=True)
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def status(self) -> Dict[str, dict]:
+        """Current state of every bot (running/backoff/failed...), e.g. for health reports"""
+        now = time.monotonic()
+        return {
+            name: {
+                "state": status.state.value,
+                "restarts": status.restarts,
+                "last_error": status.last_error,
+                "for": round(now - status.since, 1),
+            }
+            for name, status in self.statuses.items()
+        }
+
+    async def wait_started(self, interval: float = 0.5):
+        """Wait until no bot is in the STARTING state"""
+        while any(status.state == BotState.STARTING for status in self.statuses.values()):
+            await asyncio.sleep(interval)
+
+    def collect_metrics(self):
+        """Gauge samples for the metrics endpoint: bot states, queue depths and pending sends"""
+        for name, status in self.statuses.items():
+            for state in BotState:
+                yield "bot_state", "Current supervision state of a bot", {"bot": name, "state": state.value}, int(status.state == state)
+            yield "bot_restarts", "Restarts of a bot since it was started", {"bot": name}, status.restarts
+
+        for name, bot in self.bots.items():
+            yield "request_queue_depth", "Gemini requests waiting or running", {"bot": name}, bot.request_queue.total_depth
+            yield "handlers_active", "Update handlers currently running", {"bot": name}, bot.router.active
+            yield "outbound_pending", "Outbound Telegram operations waiting to be sent", {"bot": name}, bot.sender.pending
+            if bot.transcriber is not None:
+                yield "transcribe_pending", "Voice messages and video notes waiting for transcription", {"bot": name}, bot.transcriber.pending
+
+    def request_reload(self):
+        """Ask the watcher to reload config.json now (e.g. on SIGHUP)"""
+        self._reload_requested.set()
+
+    async def reload(self):
+        """Re-read config.json and apply it; invalid configs are logged and ignored"""
+        try:
+            configs = read_configs(self.config_path)
+        except ValueError as e:
+            logging.error(f"Config reload failed, keeping current bots: {e}")
+            return
+        await self.apply(configs)
+
+    async def watch(self, interval: float = CONFIG_POLL_INTERVAL):
+        """Reload the config whenever the file changes or a reload is requested"""
+        self._config_mtime = self._get_mtime()
+
+        while True:
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+            requested = self._reload_requested.is_set()
+            self._reload_requested.clear()
+
+            mtime = self._get_mtime()
+            if requested or mtime != self._config_mtime:
+                self._config_mtime = mtime
+                logging.info(f"Reloading {self.config_path}...")
+                await self.reload()
+
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return None
+
+    async def stop_all(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Drain and stop every running bot concurrently"""
+        await asyncio.gather(*(self._stop_bot(name, timeout) for name in list(self.tasks)))
+
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """
+        Gracefully stop all bots: drain in-flight requests within the timeout,
+        flush pending sends, stop the clients and clean up leftover uploads
+        and media files
+        """
+        logging.info(f"Shutting down {len(self.bots)} bot(s), waiting up to {timeout}s for in-flight requests...")
+
+        await self.stop_all(timeout)
+
+        # Safety net for requests that were cancelled before their own cleanup ran
+        await cleanup_pending_uploads()
+        cleanup_downloaded_media()
+        resources.close()
+
+        logging.info("Shutdown complete")
+
+
+async def log_startup_time(manager: BotManager, started: float):
+    """Log how long it took until every bot has connected (or failed to)"""
+    await manager.wait_started()
+    states = [status.state for status in manager.statuses.values()]
+    running = states.count(BotState.RUNNING)
+    logging.info(f"Startup finished in {time.perf_counter() - started:.2f}s: {running}/{len(states)} bot(s) running")
+
+
+async def run_bots(configs: list, manager: Optional[BotManager] = None, metrics_port: int = metrics.METRICS_PORT):
+    """
+    Run the given bots in the current event loop and keep them in sync with config.json
+
+    Args:
+        configs: List of bot configuration dictionaries
+        manager: Optional pre-configured manager (shards pass one with their config filter)
+        metrics_port: Port of the metrics endpoint (0 disables it)
+    """
+    manager = manager or BotManager(CONFIG_PATH)
+    metrics.add_collector(manager.collect_metrics)
+    metrics.add_collector(scratch.STORE.collect_metrics)
+    # Media of a previous run that crashed or was killed
+    scratch.STORE.cleanup_orphans()
+    metrics_server = await metrics.start_server(metrics_port)
+
+    # Reload on SIGHUP in addition to watching the file, shut down gracefully on SIGTERM/SIGINT
+    loop = asyncio.get_running_loop()
+    stop_requested = asyncio.Event()
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, manager.request_reload)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_requested.set)
+
+    started = time.perf_counter()
+    await manager.apply(configs)
+    logging.info(f"Starting {len(manager.tasks)} bot(s), up to {START_CONCURRENCY} at a time...")
+
+    startup = asyncio.create_task(log_startup_time(manager, started))
+    # Load the Gemini SDK off the event loop before the first request needs it
+    gemini_warmup = asyncio.create_task(
+        resources.warm_gemini_clients(config.get("gemini_api_key", "") for config in manager.configs.values())
+    )
+    watcher = asyncio.create_task(manager.watch())
+    # Online backups of the bot databases, only if BACKUP_DIR is set
+    backups = asyncio.create_task(BackupScheduler(
+        lambda: [(name, bot.db.db_path) for name, bot in manager.bots.items()],
+    ).run()) if BACKUP_DIR else None
+    try:
+        await stop_requested.wait()
+        logging.info("Received stop signal")
+    finally:
+        startup.cancel()
+        gemini_warmup.cancel()
+        watcher.cancel()
+        if backups is not None:
+            backups.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        metrics.remove_collector(manager.collect_metrics)
+        metrics.remove_collector(scratch.STORE.collect_metrics)
+        await manager.shutdown()
+
+
+async def main():
+    """Main entry point - loads config and starts all bots"""
+
+    logging.info("Starting Business Bot Service...")
+
+    # Ensure data directory exists
+    os.makedirs("data", exist_ok=True)
+
+    started = time.perf_counter()
+    configs = load_configs()
+    logging.info(f"Configuration loaded in {time.perf_counter() - started:.2f}s")
+    await run_bots(configs)
 
 
 if __name__ == "__main__":
+    shard_count = int(os.environ.get("BOT_SHARDS", "1") or 1)
+
+    if shard_count > 1:
+        # Multi-process mode: the supervisor spreads bots across worker processes
+        from sharding import run_supervisor
+        sys.exit(run_supervisor(shard_count))
+
+    setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
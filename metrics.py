@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# In-process metrics in the Prometheus text format.
+#
+# Collection is always on and costs a dictionary lookup per observation; the
+# HTTP endpoint is only started when METRICS_PORT is set. Every sample gets a
+# "bot" label taken from current_bot, which the router sets for each update,
+# so code deep in a request (database, Gemini calls) does not have to pass
+# the bot name around.
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+
+# Latency buckets (seconds), from fast SQLite queries to slow Gemini answers
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Session name of the bot handling the current update
+current_bot: contextvars.ContextVar[str] = contextvars.ContextVar("current_bot", default="")
+
+LabelValues = Tuple[str, ...]
+# Gauge sample produced by a collector: (name, help, labels, value)
+GaugeSample = Tuple[str, str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        # "bot" always comes first and is filled in from current_bot if not given
+        self.label_names = ("bot",) + tuple(label for label in labels if label != "bot")
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        bot = labels.get("bot") or current_bot.get()
+        return (bot,) + tuple(str(labels.get(name, "")) for name in self.label_names[1:])
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Histogram of observed values (usually durations in seconds)"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {data[-1]}")
+        return lines
+
+
+# --- Registry ---
+
+_metrics: Dict[str, _Metric] = {}
+_collectors: List[Callable[[], Iterable[GaugeSample]]] = []
+
+
+def counter(name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+    """Get or create a counter"""
+    if name not in _metrics:
+        _metrics[name] = Counter(name, help_text, labels)
+    return _metrics[name]
+
+
+def histogram(name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Get or create a histogram"""
+    if name not in _metrics:
+        _metrics[name] = Histogram(name, help_text, labels, buckets)
+    return _metrics[name]
+
+
+def add_collector(collector: Callable[[], Iterable[GaugeSample]]):
+    """Register a function producing gauge samples (queue depths etc.) at scrape time"""
+    _collectors.append(collector)
+
+
+def remove_collector(collector: Callable[[], Iterable[GaugeSample]]):
+    if collector in _collectors:
+        _collectors.remove(collector)
+
+
+def timed(metric: Histogram, **labels):
+    """
+    Decorator observing the duration of every call of a function (sync or async)
+
+    Calls that raise are additionally counted in "<metric>_errors_total".
+    """
+    errors = counter(f"{metric.name.removesuffix('_seconds')}_errors_total", f"Failed calls ({metric.help})", metric.label_names)
+
+    def decorator(func):
+        call_labels = {"method": func.__name__, **labels} if "method" in metric.label_names else labels
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc(**call_labels)
+                    raise
+                finally:
+                    metric.observe(time.perf_counter() - started, **call_labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc(**call_labels)
+                raise
+            finally:
+                metric.observe(time.perf_counter() - started, **call_labels)
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines: List[str] = []
+    for metric in _metrics.values():
+        lines.extend(metric.render())
+
+    gauges: Dict[str, Tuple[str, List[str]]] = {}
+    for collector in list(_collectors):
+        try:
+            samples = list(collector())
+        except Exception as e:
+            logging.warning(f"Metrics collector failed: {e}")
+            continue
+        for name, help_text, labels, value in samples:
+            _, samples_lines = gauges.setdefault(name, (help_text, []))
+            samples_lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {value}")
+
+    for name, (help_text, samples_lines) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(samples_lines)
+
+    return "\n".join(lines) + "\n"
+
+
+# --- HTTP endpoint ---
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the headers, the request has no body we care about
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else ""
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[asyncio.AbstractServer]:
+    """
+    Serve /metrics over HTTP
+
+    Returns:
+        The server, or None if port is 0 (metrics endpoint disabled)
+    """
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import tracing
+from ai_service import remove_media_file
+from capture import media_info
+from database import Database
+from scratch import MediaRejected
+from utils import build_history_turns
+
+# Speculative work done before a request arrives, so that a request mostly
+# waits for the model: chat history of recently active chats is kept rendered
+# in memory, and media that someone replied to is downloaded in advance.
+PREFETCH = os.environ.get("PREFETCH", "").lower() in ("1", "true", "yes")
+# A chat stays active this long after the last Gemini answer in it (seconds)
+PREFETCH_ACTIVE_SECONDS = float(os.environ.get("PREFETCH_ACTIVE_SECONDS", "900"))
+# Active chats whose history is kept per bot (least recently active ones are dropped)
+PREFETCH_MAX_CHATS = int(os.environ.get("PREFETCH_MAX_CHATS", "50"))
+# Media larger than this (bytes, by the size Telegram reports) is not prefetched
+PREFETCH_MEDIA_MAX_BYTES = int(os.environ.get("PREFETCH_MEDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+# Prefetch downloads taking longer are abandoned, unused files are removed after the TTL (seconds)
+PREFETCH_MEDIA_TIMEOUT = float(os.environ.get("PREFETCH_MEDIA_TIMEOUT", "60"))
+PREFETCH_MEDIA_TTL = float(os.environ.get("PREFETCH_MEDIA_TTL", "300"))
+# Prefetched files (downloading or ready) kept per bot
+PREFETCH_MEDIA_MAX_FILES = int(os.environ.get("PREFETCH_MEDIA_MAX_FILES", "4"))
+
+PREFETCH_EVENTS = metrics.counter("prefetch_total", "Prefetched history and media by outcome", ["kind", "outcome"])
+
+
+def _remove_result(task: asyncio.Task):
+    if not task.cancelled() and task.result():
+        remove_media_file(task.result())
+
+
+@dataclass
+class _ChatHistory:
+    """Rows of get_last_messages for one chat and the turns rendered from them"""
+    normal: List[Tuple]
+    important: List[Tuple]
+    turns: List[Tuple[str, str]] = field(default_factory=list)
+    active_until: float = 0.0
+
+    def render(self):
+        self.turns = build_history_turns(self.normal + self.important)
+
+
+@dataclass
+class _MediaEntry:
+    task: asyncio.Task
+    expiry: asyncio.TimerHandle
+
+
+class Prefetcher:
+    """
+    Speculative history and media prefetch of one bot
+
+    History: once the bot answered in a chat, the rows get_last_messages
+    would return for it are kept in memory and updated from the database's
+    store listener as messages arrive; the conversation turns are rendered
+    right away. A Gemini request then takes them instead of querying and
+    formatting the history. Chats are dropped PREFETCH_ACTIVE_SECONDS after
+    the last answer, or as soon as their stored messages change (!unpin).
+
+    Media: when a message in an allowed chat replies to a message with
+    media, the media is downloaded in the background (within size, time and
+    count limits). !media takes the file if it is ready or still
+    downloading; files nobody asked for are removed after PREFETCH_MEDIA_TTL.
+    """
+
+    def __init__(self, name: str, db: Database, history_limit: int,
+                 download: Callable[[Any, Any], Awaitable[Optional[str]]],
+                 active_seconds: float = PREFETCH_ACTIVE_SECONDS, max_chats: int = PREFETCH_MAX_CHATS,
+                 media_max_bytes: int = PREFETCH_MEDIA_MAX_BYTES, media_timeout: float = PREFETCH_MEDIA_TIMEOUT,
+                 media_ttl: float = PREFETCH_MEDIA_TTL, media_max_files: int = PREFETCH_MEDIA_MAX_FILES):
+        """
+        Args:
+            name: Name used in log messages (usually the session name)
+            db: Database whose stored messages are followed
+            history_limit: Number of recent messages kept per chat (the default context size)
+            download: Coroutine function downloading the media of a message, called as download(client, message)
+            active_seconds: How long a chat is followed after the last Gemini answer
+            max_chats: Maximum number of followed chats
+            media_max_bytes: Larger media is not prefetched
+            media_timeout: Prefetch downloads are abandoned after this many seconds
+            media_ttl: Unused prefetched files are removed after this many seconds
+            media_max_files: Maximum number of prefetched files at a time
+        """
+        self.name = name
+        self.db = db
+        self.history_limit = history_limit
+        self.download = download
+        self.active_seconds = active_seconds
+        self.max_chats = max(1, max_chats)
+        self.media_max_bytes = media_max_bytes
+        self.media_timeout = media_timeout
+        self.media_ttl = media_ttl
+        self.media_max_files = max(1, media_max_files)
+        self._chats: "OrderedDict[int, _ChatHistory]" = OrderedDict()
+        self._media: Dict[Tuple[int, int], _MediaEntry] = {}
+        db.store_listeners.append(self._on_store)
+        db.change_listeners.append(self.forget)
+
+    # --- History ---
+
+    def _on_store(self, chat_id: int, row: Tuple):
+        now = time.monotonic()
+        chat = self._chats.get(chat_id)
+        if chat is not None and chat.active_until < now:
+            del self._chats[chat_id]
+            chat = None
+
+        if row[5] == "Gemini":
+            if chat is None:
+                # The answer makes the chat active: load its history once
+                rows = self.db.get_last_messages(chat_id, limit=self.history_limit)
+                chat = _ChatHistory(
+                    normal=[r for r in rows if r[5] != "Important"],
+                    important=[r for r in rows if r[5] == "Important"],
+                )
+                self._chats[chat_id] = chat
+                self._evict()
+                chat.active_until = now + self.active_seconds
+                chat.render()
+                return
+            chat.active_until = now + self.active_seconds
+            self._chats.move_to_end(chat_id)
+        elif chat is None:
+            return
+
+        # Same order and window as get_last_messages: newest first, pins kept apart
+        if row[5] == "Important":
+            chat.important.insert(0, row)
+        else:
+            chat.normal.insert(0, row)
+            del chat.normal[self.history_limit:]
+        chat.render()
+
+    def forget(self, chat_id: int):
+        """Drop the history of a chat whose stored messages changed; it is loaded again with the next answer"""
+        self._chats.pop(chat_id, None)
+
+    def _evict(self):
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def history(self, chat_id: int, limit: int) -> Optional[Tuple[List[Tuple], List[Tuple[str, str]]]]:
+        """
+        Prefetched history of a chat
+
+        Returns:
+            Rows as returned by get_last_messages and the turns built from them, or None
+            if the chat is not followed or a different limit is requested
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.active_until < time.monotonic() or limit != self.history_limit:
+            PREFETCH_EVENTS.inc(kind="history", outcome="miss")
+            return None
+        PREFETCH_EVENTS.inc(kind="history", outcome="hit")
+        return chat.normal + chat.important, chat.turns
+
+    # --- Media ---
+
+    def prefetch_media(self, client, message) -> bool:
+        """
+        Start downloading the media of a message in the background
+
+        Returns:
+            False if the message is skipped (already prefetched, too large or too many files)
+        """
+        key = (message.chat.id, message.id)
+        if key in self._media:
+            return False
+        info = media_info(message) or {}
+        if info.get("size", 0) > self.media_max_bytes:
+            PREFETCH_EVENTS.inc(kind="media", outcome="too_large")
+            return False
+        if len(self._media) >= self.media_max_files:
+            PREFETCH_EVENTS.inc(kind="media", outcome="skipped")
+            return False
+
+        # Not part of the trace of the update that caused it
+        task = asyncio.create_task(self._download(client, message), context=tracing.detached_context())
+        expiry = asyncio.get_running_loop().call_later(self.media_ttl, self._expire, key)
+        self._media[key] = _MediaEntry(task=task, expiry=expiry)
+        logging.debug(f"[{self.name}] Prefetching media of message {message.id} in chat {message.chat.id}")
+        return True
+
+    async def _download(self, client, message) -> Optional[str]:
+        try:
+            return await asyncio.wait_for(self.download(client, message), timeout=self.media_timeout)
+        except asyncio.TimeoutError:
+            PREFETCH_EVENTS.inc(kind="media", outcome="timeout")
+        except MediaRejected:
+            PREFETCH_EVENTS.inc(kind="media", outcome="rejected")
+        except Exception as e:
+            PREFETCH_EVENTS.inc(kind="media", outcome="error")
+            logging.warning(f"[{self.name}] Prefetch of message {message.id} failed: {e}")
+        return None
+
+    def _discard(self, entry: _MediaEntry):
+        entry.expiry.cancel()
+        if entry.task.done():
+            _remove_result(entry.task)
+        else:
+            entry.task.cancel()
+
+    def _expire(self, key: Tuple[int, int]):
+        entry = self._media.pop(key, None)
+        if entry is not None:
+            PREFETCH_EVENTS.inc(kind="media", outcome="expired")
+            self._discard(entry)
+
+    async def take_media(self, message) -> Optional[str]:
+        """
+        Path of the prefetched media of a message, waiting for a download in progress
+
+        The caller owns the returned file and removes it with remove_media_file.
+
+        Returns:
+            Path to the file, or None if the media was not prefetched or the download failed
+        """
+        entry = self._media.pop((message.chat.id, message.id), None)
+        if entry is None:
+            PREFETCH_EVENTS.inc(kind="media", outcome="miss")
+            return None
+        entry.expiry.cancel()
+        try:
+            path = await asyncio.shield(entry.task)
+        except asyncio.CancelledError:
+            # The caller is gone but the download goes on, its file has to be removed
+            entry.task.add_done_callback(_remove_result)
+            raise
+        PREFETCH_EVENTS.inc(kind="media", outcome="hit" if path else "failed")
+        return path
+
+    async def stop(self):
+        """Cancel prefetch downloads and remove unused prefetched files"""
+        entries = list(self._media.values())
+        self._media.clear()
+        for entry in entries:
+            entry.expiry.cancel()
+            entry.task.cancel()
+        await asyncio.gather(*(entry.task for entry in entries), return_exceptions=True)
+        for entry in entries:
+            if not entry.task.cancelled() and entry.task.result():
+                remove_media_file(entry.task.result())
+        self._chats.clear()
@@ -0,0 +1,199 @@
+import asyncio
+import inspect
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# Only one profile can run at a time: the sampler and tracemalloc are process-wide
+_lock = asyncio.Lock()
+
+# Frames in these files mean the thread is waiting, not working
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+FrameKey = Tuple[str, int, str]
+
+
+def _frame_key(frame) -> FrameKey:
+    code = frame.f_code
+    return os.path.basename(code.co_filename), frame.f_lineno, code.co_qualname if hasattr(code, "co_qualname") else code.co_name
+
+
+def _format_key(key: FrameKey) -> str:
+    filename, lineno, name = key
+    # Line 0 marks per-function (not per-line) entries
+    return f"{name} ({filename}:{lineno})" if lineno else f"{name} ({filename})"
+
+
+class _Sampler(threading.Thread):
+    """
+    Wall-clock sampling profiler
+
+    Periodically reads the stacks of all threads with sys._current_frames().
+    For the event loop thread it also records which coroutine was running,
+    i.e. which task was blocking the loop at that moment.
+    """
+
+    def __init__(self, loop_thread: int, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.loop_thread = loop_thread
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.samples = 0
+        self.loop_busy = 0
+        # "loop" / "workers" -> Counter of frames
+        self.self_counts: Dict[str, Counter] = {"loop": Counter(), "workers": Counter()}
+        self.total_counts: Dict[str, Counter] = {"loop": Counter(), "workers": Counter()}
+        self.coroutines: Counter = Counter()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                group = "loop" if ident == self.loop_thread else "workers"
+                self._record(group, frame)
+
+    def _record(self, group: str, frame):
+        self.self_counts[group][_frame_key(frame)] += 1
+        seen = set()
+        outermost_coroutine = None
+        while frame is not None:
+            key = _frame_key(frame)
+            # Count a function once per sample even if it recurses
+            if key[::2] not in seen:
+                seen.add(key[::2])
+                self.total_counts[group][(key[0], 0, key[2])] += 1
+            if group == "loop" and frame.f_code.co_flags & inspect.CO_COROUTINE:
+                outermost_coroutine = key
+            frame = frame.f_back
+        if group == "loop":
+            self.loop_busy += 1
+            if outermost_coroutine is not None:
+                self.coroutines[(outermost_coroutine[0], 0, outermost_coroutine[2])] += 1
+
+
+async def _measure_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.05):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+def is_running() -> bool:
+    """Whether a profile is being captured right now"""
+    return _lock.locked()
+
+
+async def capture(seconds: float, interval: float = 0.01, top: int = 25) -> str:
+    """
+    Profile the whole process for the given number of seconds
+
+    Runs a sampling profiler over all threads, takes tracemalloc snapshots
+    at the start and the end of the window and measures the event loop lag.
+    Snapshots are taken and compared in a worker thread, as on a large heap
+    that takes long enough to stall every chat.
+
+    Args:
+        seconds: Length of the profiling window
+        interval: Sampling interval of the CPU profiler in seconds
+        top: Number of entries in each list of the report
+
+    Returns:
+        Plain text report
+    """
+    async with _lock:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        before = await asyncio.to_thread(tracemalloc.take_snapshot)
+
+        sampler = _Sampler(threading.get_ident(), interval)
+        lag: List[float] = []
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(_measure_loop_lag(lag, stop))
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop_event.set()
+            stop.set()
+            await lag_task
+            elapsed = time.perf_counter() - started
+            await asyncio.to_thread(sampler.join)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            current, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+
+        allocations = await asyncio.to_thread(_format_allocations, before, after, current, peak, started_tracing, top)
+        return _format_report(sampler, lag, elapsed, top) + allocations
+
+
+def _format_counter(title: str, counter: Counter, total: int, top: int, unit: Optional[float] = None) -> List[str]:
+    lines = [title]
+    if not counter:
+        return lines + ["  (no samples)", ""]
+    for key, count in counter.most_common(top):
+        share = count / total * 100 if total else 0
+        time_str = f"{count * unit:8.2f}s " if unit else ""
+        lines.append(f"  {share:5.1f}% {count:6d} {time_str}{_format_key(key)}")
+    return lines + [""]
+
+
+def _format_report(sampler: _Sampler, lag: List[float], elapsed: float, top: int) -> str:
+    samples = sampler.samples or 1
+    lines = [
+        f"Profile of pid {os.getpid()}, {elapsed:.1f}s, {sampler.samples} samples every {sampler.interval * 1000:.0f} ms",
+        f"Event loop busy: {sampler.loop_busy / samples * 100:.1f}% of samples, tasks: {len(asyncio.all_tasks())}, threads: {threading.active_count()}",
+        "",
+    ]
+
+    if lag:
+        ordered = sorted(lag)
+        lines += [
+            "=== Event loop lag ===",
+            f"  avg {sum(lag) / len(lag) * 1000:.1f} ms, p50 {ordered[len(ordered) // 2] * 1000:.1f} ms, "
+            f"p99 {ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000:.1f} ms, max {ordered[-1] * 1000:.1f} ms",
+            "",
+        ]
+
+    # Samples are taken less often than the interval when threads hold the GIL,
+    # so the time per sample is derived from the real number of samples
+    lines += _format_counter("=== Coroutines blocking the event loop (share of samples, est. time) ===",
+                             sampler.coroutines, samples, top, elapsed / samples)
+    lines += _format_counter("=== Event loop: hottest lines (self) ===", sampler.self_counts["loop"], samples, top)
+    lines += _format_counter("=== Event loop: functions (inclusive) ===", sampler.total_counts["loop"], samples, top)
+    lines += _format_counter("=== Worker threads: hottest lines (self, all threads) ===", sampler.self_counts["workers"], samples, top)
+    lines += _format_counter("=== Worker threads: functions (inclusive, all threads) ===", sampler.total_counts["workers"], samples, top)
+    return "\n".join(lines) + "\n"
+
+
+def _format_allocations(before, after, current: int, peak: int, started_tracing: bool, top: int) -> str:
+    """Allocation part of the report (blocking: compares the tracemalloc snapshots)"""
+    lines = ["=== Allocations during the window (net size by line) ==="]
+    if started_tracing:
+        lines.append("  (tracemalloc was started for this profile, so only allocations inside the window are seen)")
+    lines.append(f"  traced memory: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB")
+    for stat in after.compare_to(before, "lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  "
+            f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        )
+    lines.append("")
+
+    lines.append("=== Largest live allocation sites ===")
+    for stat in after.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {os.path.basename(frame.filename)}:{frame.lineno}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+import tracing
+
+
+@dataclass
+class _Job:
+    """Single pending request in a chat queue"""
+    user_id: Optional[int]
+    handler: Callable[[], Awaitable[None]]
+    # Context of the submitter, so the request runs in the trace of its update
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    # Span covering the time spent in the queue
+    wait_span: Any = None
+
+
+@dataclass
+class _ChatState:
+    """Queue and worker bookkeeping for one chat"""
+    pending: Deque[_Job] = field(default_factory=deque)
+    workers: Set[asyncio.Task] = field(default_factory=set)
+
+
+class ChatRequestQueue:
+    """
+    Per-chat request queue with a global concurrency limit.
+
+    Requests of a chat are started in arrival order and at most
+    `per_chat_concurrency` of them run at the same time. All chats of a bot
+    share one semaphore of `max_concurrent` slots, so a single busy chat
+    cannot exhaust the upstream quota. A newer request from the same user
+    replaces their request that is still waiting in the queue.
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 4, per_chat_concurrency: int = 1, max_pending_per_chat: int = 3):
+        """
+        Args:
+            name: Name used in log messages (usually the session name)
+            max_concurrent: Maximum number of requests running at once across all chats
+            per_chat_concurrency: Maximum number of requests running at once in a single chat
+            max_pending_per_chat: Maximum number of requests waiting in a single chat
+        """
+        self.name = name
+        self.per_chat_concurrency = max(1, per_chat_concurrency)
+        self.max_pending_per_chat = max(0, max_pending_per_chat)
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        self._chats: Dict[int, _ChatState] = {}
+
+    def submit(self, chat_id: int, user_id: Optional[int], handler: Callable[[], Awaitable[None]]) -> bool:
+        """
+        Enqueue a request for a chat
+
+        Args:
+            chat_id: Chat the request belongs to
+            user_id: Author of the request, used to supersede their older pending request
+            handler: Coroutine function that processes the request
+
+        Returns:
+            False if the chat queue is full and the request was rejected, True otherwise
+        """
+        state = self._chats.setdefault(chat_id, _ChatState())
+
+        # Drop an older pending request of the same user - the new one supersedes it
+        if user_id is not None:
+            for job in list(state.pending):
+                if job.user_id == user_id:
+                    state.pending.remove(job)
+                    job.wait_span.set(superseded=True)
+                    job.wait_span.end()
+                    logging.info(f"[{self.name}] Superseded pending request of user {user_id} in chat {chat_id}")
+
+        if len(state.pending) >= self.max_pending_per_chat and len(state.workers) >= self.per_chat_concurrency:
+            logging.warning(f"[{self.name}] Request queue for chat {chat_id} is full, rejecting request")
+            return False
+
+        state.pending.append(_Job(user_id=user_id, handler=handler, wait_span=tracing.span("queue.wait", chat_id=chat_id)))
+
+        if len(state.workers) < self.per_chat_concurrency:
+            task = asyncio.create_task(self._worker(chat_id, state), context=tracing.detached_context())
+            state.workers.add(task)
+
+        return True
+
+    async def _worker(self, chat_id: int, state: _ChatState):
+        """Process pending requests of a chat one by one"""
+        try:
+            while state.pending:
+                async with self._semaphore:
+                    # The queue may have been emptied by superseding while waiting for a slot
+                    if not state.pending:
+                        break
+                    job = state.pending.popleft()
+                    run_span = job.context.run(tracing.span, "queue.run", chat_id=chat_id)
+                    job.wait_span.end()
+                    try:
+                        await asyncio.create_task(self._run(job, run_span), context=job.context)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        job.context.run(logging.error, f"[{self.name}] Request in chat {chat_id} failed: {e}", exc_info=True)
+        finally:
+            state.workers.discard(asyncio.current_task())
+            if not state.workers and not state.pending and self._chats.get(chat_id) is state:
+                del self._chats[chat_id]
+
+    @staticmethod
+    async def _run(job: _Job, run_span):
+        with run_span:
+            await job.handler()
+
+    def resize(self, max_concurrent: Optional[int] = None, max_pending_per_chat: Optional[int] = None):
+        """
+        Change the limits of a running queue
+
+        A new global semaphore only applies to requests that have not started yet.
+        """
+        if max_concurrent is not None:
+            self._semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        if max_pending_per_chat is not None:
+            self.max_pending_per_chat = max(0, max_pending_per_chat)
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Wait until all queued and running requests are processed
+
+        Returns:
+            True if the queue became empty within the timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._chats:
+            workers = {task for state in self._chats.values() for task in state.workers}
+            remaining = deadline - loop.time()
+            if not workers or remaining <= 0:
+                break
+            await asyncio.wait(workers, timeout=remaining)
+        return not self._chats
+
+    def cancel_all(self):
+        """Drop pending requests and cancel running ones"""
+        for state in self._chats.values():
+            for job in state.pending:
+                job.wait_span.end(asyncio.CancelledError())
+            state.pending.clear()
+            for task in state.workers:
+                task.cancel()
+
+    def depth(self, chat_id: int) -> int:
+        """Number of requests waiting or running in a chat"""
+        state = self._chats.get(chat_id)
+        return len(state.pending) + len(state.workers) if state else 0
+
+    @property
+    def total_depth(self) -> int:
+        """Number of requests waiting or running across all chats"""
+        return sum(len(s.pending) + len(s.workers) for s in self._chats.values())
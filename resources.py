@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Optional, TypeVar
+
+if TYPE_CHECKING:
+    from google import genai
+
+# Process-wide resources shared by all bots: bots with the same Gemini API key
+# share one client (and with it one pool of keep-alive HTTP connections), and
+# blocking work runs in a few named executors of a fixed size instead of the
+# default executor. Downloaded media files are managed by scratch.py.
+
+T = TypeVar("T")
+
+# Threads for blocking Gemini SDK calls (uploads, generate_content); this also
+# bounds the number of HTTP connections per API key
+GEMINI_WORKERS = int(os.environ.get("GEMINI_WORKERS", "16"))
+# Threads for blocking local I/O (SQLite schema setup and the like)
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "4"))
+
+EXECUTOR_SIZES = {
+    "gemini": GEMINI_WORKERS,
+    "io": IO_WORKERS,
+}
+
+_gemini_clients: Dict[str, "genai.Client"] = {}
+# Clients are also created by warm_gemini_clients in the I/O executor
+_gemini_clients_lock = threading.Lock()
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+# --- Gemini clients ---
+
+def get_gemini_client(api_key: str) -> Optional["genai.Client"]:
+    """
+    Shared Gemini client for an API key, created on first use
+
+    Returns:
+        The client, or None if the key is empty
+    """
+    if not api_key:
+        return None
+
+    client = _gemini_clients.get(api_key)
+    if client is None:
+        with _gemini_clients_lock:
+            client = _gemini_clients.get(api_key)
+            if client is None:
+                import httpx
+                from google import genai
+                from google.genai import types as genai_types
+
+                limits = httpx.Limits(max_connections=GEMINI_WORKERS, max_keepalive_connections=GEMINI_WORKERS)
+                client = genai.Client(
+                    api_key=api_key,
+                    http_options=genai_types.HttpOptions(client_args={"limits": limits}),
+                )
+                _gemini_clients[api_key] = client
+                logging.info(f"Gemini client created ({len(_gemini_clients)} distinct API key(s) in use)")
+    return client
+
+
+async def warm_gemini_clients(api_keys: Iterable[str]):
+    """
+    Import google.genai and create the clients of the given API keys in the I/O executor
+
+    Run in the background after startup: the import takes a noticeable part
+    of a second, which would otherwise stall the event loop (and every bot of
+    the process) during the first Gemini request.
+    """
+    started = time.perf_counter()
+    await run_blocking("io", importlib.import_module, "google.genai.types")
+    keys = sorted({key for key in api_keys if key})
+    for key in keys:
+        await run_blocking("io", get_gemini_client, key)
+    logging.info(f"Gemini SDK loaded and {len(keys)} client(s) created in {time.perf_counter() - started:.2f}s")
+
+
+def gemini_client_count() -> int:
+    """Number of Gemini clients created in this process"""
+    return len(_gemini_clients)
+
+
+# --- Executors ---
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """Shared executor by name ("gemini" or "io"), created on first use"""
+    executor = _executors.get(name)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=EXECUTOR_SIZES[name], thread_name_prefix=name)
+        _executors[name] = executor
+    return executor
+
+
+async def run_blocking(name: str, func: Callable[..., T], *args) -> T:
+    """Run a blocking function in the named shared executor (with the caller's context, like asyncio.to_thread)"""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(name), call)
+
+
+# --- Shutdown ---
+
+def close():
+    """Close all Gemini clients and shut down the executors (called once all bots are stopped)"""
+    for client in _gemini_clients.values():
+        try:
+            # Client.close only exists in newer google-genai versions; older ones
+            # are closed through their underlying httpx client
+            close_client = getattr(client, "close", None)
+            if close_client is None:
+                http_client = getattr(getattr(client, "_api_client", None), "_httpx_client", None)
+                close_client = getattr(http_client, "close", None)
+            if close_client is not None:
+                close_client()
+        except Exception as e:
+            logging.warning(f"Error closing Gemini client: {e}")
+    _gemini_clients.clear()
+
+    for executor in _executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    _executors.clear()
@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from pyrogram.types import Message
+
+import metrics
+import tracing
+
+HANDLER_SECONDS = metrics.histogram("handler_seconds", "Duration of update handlers", ["handler"])
+HANDLER_ERRORS = metrics.counter("handler_errors_total", "Update handlers that raised an exception", ["handler"])
+
+Handler = Callable[..., Awaitable[None]]
+
+
+@dataclass
+class HandlerStats:
+    """Call count and timing of a single handler"""
+    calls: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+@dataclass
+class _Command:
+    handler: Handler
+    me_only: bool
+
+
+class UpdateRouter:
+    """
+    Single-pass dispatcher for incoming messages.
+
+    Replaces a chain of Pyrogram handlers with separate filters: every update
+    is classified once - a command is looked up in a table by its first word,
+    a trigger is found with one precompiled regex, and everything else goes to
+    the fallback handler. Triggers and the fallback only run for allowed
+    updates (e.g. whitelisted chats), so updates from other chats cost a
+    dictionary lookup at most.
+    """
+
+    def __init__(self, name: str, is_allowed: Callable[[Message], bool], prefixes: str = "!"):
+        """
+        Args:
+            name: Name used in log messages (usually the session name)
+            is_allowed: Predicate deciding whether triggers and the fallback may handle a message
+            prefixes: Characters that start a command
+        """
+        self.name = name
+        self.is_allowed = is_allowed
+        self.prefixes = prefixes
+        self.stats: Dict[str, HandlerStats] = {}
+        self._commands: Dict[str, _Command] = {}
+        self._triggers: List[Tuple[re.Pattern, Handler]] = []
+        self._fallback: Optional[Handler] = None
+        self._active: Set[asyncio.Task] = set()
+
+    # --- Registration ---
+
+    def command(self, names, handler: Handler, me_only: bool = True):
+        """
+        Register a command handler
+
+        Args:
+            names: Command name or list of names (case-insensitive, without prefix)
+            handler: Handler called as handler(client, message)
+            me_only: Only handle the command in messages sent by this account
+        """
+        names = names if isinstance(names, list) else [names]
+        for command_name in names:
+            self._commands[command_name.lower()] = _Command(handler=handler, me_only=me_only)
+
+    def trigger(self, pattern: str, handler: Handler):
+        """Register a handler for messages whose text matches a regex (checked in registration order)"""
+        self._triggers.append((re.compile(pattern), handler))
+
+    def fallback(self, handler: Handler):
+        """Register the handler for all remaining allowed messages"""
+        self._fallback = handler
+
+    # --- Dispatching ---
+
+    @staticmethod
+    def _is_me(message: Message) -> bool:
+        """Same check as pyrogram.filters.me"""
+        return bool(message.from_user and message.from_user.is_self or getattr(message, "outgoing", False))
+
+    def _match_command(self, client, message: Message, text: str) -> Optional[Handler]:
+        if not text or text[0] not in self.prefixes:
+            return None
+
+        word = text[1:].split(maxsplit=1)[0].lower() if len(text) > 1 and not text[1].isspace() else ""
+        # Allow "!command@username" like pyrogram.filters.command does
+        if "@" in word:
+            word, _, username = word.partition("@")
+            me = getattr(client, "me", None)
+            if username and not (me and me.username and me.username.lower() == username):
+                return None
+
+        command = self._commands.get(word)
+        if command is None or (command.me_only and not self._is_me(message)):
+            return None
+        return command.handler
+
+    def classify(self, client, message: Message) -> Optional[Handler]:
+        """
+        Pick the handler for a message
+
+        Returns:
+            The handler to run, or None if the message should be ignored
+        """
+        text = message.text or message.caption or ""
+
+        handler = self._match_command(client, message, text)
+        if handler is not None:
+            return handler
+
+        if not self.is_allowed(message):
+            return None
+
+        if text:
+            for pattern, trigger_handler in self._triggers:
+                if pattern.search(text):
+                    return trigger_handler
+
+        return self._fallback
+
+    async def dispatch(self, client, message: Message):
+        """Pyrogram message handler: classify the update and run the chosen handler"""
+        handler = self.classify(client, message)
+        if handler is None:
+            return
+
+        name = handler.__name__
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerStats()
+
+        # Run the handler in its own task so it can be cancelled on shutdown
+        # without cancelling Pyrogram's dispatcher worker. Everything the
+        # handler does is labelled with this bot in metrics and belongs to
+        # the trace of this update
+        context = contextvars.copy_context()
+        context.run(metrics.current_bot.set, self.name)
+        root = context.run(tracing.start_trace, "update", handler=name, chat_id=message.chat.id, message_id=message.id)
+        task = asyncio.create_task(handler(client, message), context=context)
+        self._active.add(task)
+        task.add_done_callback(self._active.discard)
+
+        started = time.perf_counter()
+        await asyncio.wait({task})
+        elapsed = time.perf_counter() - started
+
+        stats.calls += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        HANDLER_SECONDS.observe(elapsed, bot=self.name, handler=name)
+
+        if task.cancelled():
+            root.end(asyncio.CancelledError())
+            logging.info(f"[{self.name}] Handler {name} was cancelled")
+        elif task.exception() is not None:
+            root.end(task.exception())
+            stats.errors += 1
+            HANDLER_ERRORS.inc(bot=self.name, handler=name)
+            context.run(logging.error, f"[{self.name}] Handler {name} failed: {task.exception()}", exc_info=task.exception())
+        else:
+            root.end()
+
+    @property
+    def active(self) -> int:
+        """Number of handlers currently running"""
+        return len(self._active)
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        Wait until no handler is running
+
+        Returns:
+            True if all handlers finished within the timeout
+        """
+        if self._active:
+            await asyncio.wait(set(self._active), timeout=timeout)
+        return not self._active
+
+    def cancel_active(self):
+        """Cancel all running handlers"""
+        for task in list(self._active):
+            task.cancel()
@@ -0,0 +1,204 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+import metrics
+from ai_service import GeminiError, GeminiModel
+
+# Pick the model of a request from its size and media and the recent health of
+# the models. With MODEL_ROUTING=0 the fixed choice is used: FLASH for text
+# (FLASH_THINKING with !думай) and FLASH_MULTIMODAL for media.
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "1").lower() not in ("0", "false", "no")
+# Calls considered for the health of a model, and how old they may be (seconds)
+ROUTING_WINDOW = int(os.environ.get("ROUTING_WINDOW", "50"))
+ROUTING_WINDOW_SECONDS = float(os.environ.get("ROUTING_WINDOW_SECONDS", "600"))
+# A model with at least ROUTING_MIN_CALLS recent calls is avoided if more than
+# this share of them failed or their median latency is over its budget
+ROUTING_MIN_CALLS = int(os.environ.get("ROUTING_MIN_CALLS", "5"))
+ROUTING_MAX_ERROR_RATE = float(os.environ.get("ROUTING_MAX_ERROR_RATE", "0.3"))
+
+# Text requests up to these sizes (characters) without signs of a complex task go to FLASH_LITE
+LITE_MAX_QUERY = int(os.environ.get("ROUTING_LITE_MAX_QUERY", "300"))
+LITE_MAX_CONTEXT = int(os.environ.get("ROUTING_LITE_MAX_CONTEXT", "6000"))
+# Media requests go to FLASH_MULTIMODAL above these limits
+HEAVY_MEDIA_SECONDS = int(os.environ.get("ROUTING_HEAVY_MEDIA_SECONDS", "300"))
+HEAVY_MEDIA_FILES = int(os.environ.get("ROUTING_HEAVY_MEDIA_FILES", "4"))
+HEAVY_MEDIA_PROMPT = int(os.environ.get("ROUTING_HEAVY_MEDIA_PROMPT", "400"))
+
+# Median latency (seconds) above which a model counts as degraded
+LATENCY_BUDGET = {
+    GeminiModel.FLASH_LITE: 10.0,
+    GeminiModel.FLASH: 20.0,
+    GeminiModel.FLASH_MULTIMODAL: 60.0,
+}
+
+# Model tried instead of a degraded one
+FALLBACK = {
+    GeminiModel.FLASH_LITE: GeminiModel.FLASH,
+    GeminiModel.FLASH: GeminiModel.FLASH_LITE,
+    GeminiModel.FLASH_MULTIMODAL: GeminiModel.FLASH,
+}
+
+# Words asking for reasoning, code or long output rather than a quick answer; only
+# the listed forms match, so e.g. "кодекс", "планета" or "codec" do not count
+_COMPLEX = re.compile(
+    r"```|\b(?:почему|(?:объясни|докажи|сравни|проанализируй|посчитай|вычисли|реши|напиши)(?:те)?|"
+    r"(?:анализ|код|скрипт|план)(?:а|у|е|ом|ы|ов|ами|ах)?|explain|code|codes)\b",
+    re.IGNORECASE,
+)
+
+# Media that needs the heavy model whatever its size
+_HEAVY_MEDIA_KINDS = {"document"}
+_MEDIA_KINDS = ("photo", "sticker", "animation", "video", "video_note", "voice", "audio", "document")
+
+MODEL_ROUTES = metrics.counter("model_routes_total", "Gemini requests by routed model and reason", ["model", "reason"])
+
+
+@dataclass
+class Route:
+    """Model chosen for a request and why"""
+    model: GeminiModel
+    reason: str
+
+
+@dataclass
+class ModelHealth:
+    """Recent calls of a model"""
+    calls: int = 0
+    errors: int = 0
+    median_latency: float = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.calls if self.calls else 0.0
+
+
+class ModelStats:
+    """Rolling latency and error record of the Gemini models (shared by all bots of a process)"""
+
+    def __init__(self, window: int = ROUTING_WINDOW, window_seconds: float = ROUTING_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._calls: Dict[GeminiModel, Deque[Tuple[float, float, bool]]] = {}
+        self._window = max(1, window)
+        self._lock = threading.Lock()
+
+    def record(self, model: GeminiModel, latency: float, ok: bool):
+        with self._lock:
+            calls = self._calls.setdefault(model, deque(maxlen=self._window))
+            calls.append((time.monotonic(), latency, ok))
+
+    def health(self, model: GeminiModel) -> ModelHealth:
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            calls = [(latency, ok) for at, latency, ok in self._calls.get(model, ()) if at >= cutoff]
+        if not calls:
+            return ModelHealth()
+        latencies = sorted(latency for latency, _ in calls)
+        return ModelHealth(
+            calls=len(calls),
+            errors=sum(1 for _, ok in calls if not ok),
+            median_latency=latencies[len(latencies) // 2],
+        )
+
+    def degraded(self, model: GeminiModel) -> bool:
+        """Whether recent calls of a model failed too often or were too slow"""
+        health = self.health(model)
+        if health.calls < ROUTING_MIN_CALLS:
+            return False
+        return health.error_rate > ROUTING_MAX_ERROR_RATE or health.median_latency > LATENCY_BUDGET.get(model, 60.0)
+
+    def snapshot(self) -> Dict[GeminiModel, ModelHealth]:
+        with self._lock:
+            models = list(self._calls)
+        return {model: self.health(model) for model in models}
+
+
+MODEL_STATS = ModelStats()
+
+
+def record_call(route: Route, latency: float, response: str, stats: ModelStats = MODEL_STATS):
+    """Record the outcome of a routed call_gemini_api call (failed if it returned a GeminiError)"""
+    MODEL_ROUTES.inc(model=route.model.value, reason=route.reason)
+    stats.record(route.model, latency, ok=not isinstance(response, GeminiError))
+
+
+def _choose(route: Route, stats: ModelStats) -> Route:
+    """Replace a degraded model by its fallback, unless that one is degraded too"""
+    fallback = FALLBACK.get(route.model)
+    if fallback is not None and stats.degraded(route.model) and not stats.degraded(fallback):
+        return Route(fallback, f"{route.model.value} degraded")
+    return route
+
+
+def route_text(query: str, context_chars: int, stats: ModelStats = MODEL_STATS) -> Route:
+    """
+    Model for a text request with chat history
+
+    Args:
+        query: The user's query
+        context_chars: Length of the chat history sent with it
+    """
+    if "!думай" in query.lower():
+        # Explicit request for the thinking model, never rerouted
+        return Route(GeminiModel.FLASH_THINKING, "override")
+    if not MODEL_ROUTING:
+        return Route(GeminiModel.FLASH, "fixed")
+
+    if len(query) > LITE_MAX_QUERY:
+        route = Route(GeminiModel.FLASH, "long query")
+    elif context_chars > LITE_MAX_CONTEXT:
+        route = Route(GeminiModel.FLASH, "long context")
+    elif _COMPLEX.search(query):
+        route = Route(GeminiModel.FLASH, "complex query")
+    else:
+        route = Route(GeminiModel.FLASH_LITE, "simple query")
+    return _choose(route, stats)
+
+
+def _media_of(message) -> Optional[Tuple[str, object]]:
+    for kind in _MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            return kind, media
+    return None
+
+
+def route_media(messages: Iterable, prompt: str, stats: ModelStats = MODEL_STATS) -> Route:
+    """
+    Model for a media analysis request
+
+    Args:
+        messages: Messages whose media is analyzed
+        prompt: The user's prompt
+    """
+    if "!думай" in prompt.lower():
+        return Route(GeminiModel.FLASH_MULTIMODAL, "override")
+    if not MODEL_ROUTING:
+        return Route(GeminiModel.FLASH_MULTIMODAL, "fixed")
+
+    media = [found for found in map(_media_of, messages) if found is not None]
+    kinds = {kind for kind, _ in media}
+    duration = sum(getattr(item, "duration", 0) or 0 for _, item in media)
+    complex_prompt = len(prompt) > HEAVY_MEDIA_PROMPT or _COMPLEX.search(prompt) is not None
+    images_only = bool(media) and all(
+        kind in ("photo", "sticker") or (kind == "document" and (getattr(item, "mime_type", "") or "").startswith("image/"))
+        for kind, item in media
+    )
+
+    if images_only and not complex_prompt and len(media) < HEAVY_MEDIA_FILES:
+        route = Route(GeminiModel.FLASH, "images")
+    elif kinds & _HEAVY_MEDIA_KINDS:
+        route = Route(GeminiModel.FLASH_MULTIMODAL, "document")
+    elif duration > HEAVY_MEDIA_SECONDS:
+        route = Route(GeminiModel.FLASH_MULTIMODAL, "long media")
+    elif len(media) >= HEAVY_MEDIA_FILES:
+        route = Route(GeminiModel.FLASH_MULTIMODAL, "many files")
+    elif complex_prompt:
+        route = Route(GeminiModel.FLASH_MULTIMODAL, "complex prompt")
+    else:
+        route = Route(GeminiModel.FLASH, "short media")
+    return _choose(route, stats)
@@ -0,0 +1,232 @@
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+from typing import AsyncIterator, Dict, Optional
+
+import metrics
+
+# Disk area for media downloaded from Telegram. Every process writes to its
+# own subdirectory (named by its pid), so the shards of the multi-process mode
+# can share one location and leftovers of dead processes can be told apart
+# from files in use. The files of a process count against a byte quota; a
+# download reserves the size Telegram reports for the file before it starts
+# and waits (up to MEDIA_SCRATCH_WAIT seconds) until enough space is free.
+# MEDIA_SCRATCH_DIR may point to a tmpfs mount to keep media off the disk.
+MEDIA_SCRATCH_DIR = os.environ.get("MEDIA_SCRATCH_DIR", "data/media")
+# Bytes of downloaded media all processes together may keep at a time; in the
+# multi-process mode every shard gets an equal part (see SHARD_QUOTA)
+MEDIA_SCRATCH_QUOTA = int(os.environ.get("MEDIA_SCRATCH_QUOTA", str(2 * 1024 ** 3)))
+# Worker processes sharing MEDIA_SCRATCH_DIR; set by the supervisor for its shards, as
+# it starts fewer than BOT_SHARDS when there are fewer bots
+SHARD_COUNT = max(1, int(os.environ.get("BOT_SHARD_COUNT", "1") or 1))
+SHARD_QUOTA = MEDIA_SCRATCH_QUOTA // SHARD_COUNT
+# Larger files are rejected before downloading (bytes)
+MEDIA_MAX_FILE_BYTES = int(os.environ.get("MEDIA_MAX_FILE_BYTES", str(512 * 1024 ** 2)))
+# Concurrent downloads of a process, and of each bot
+MEDIA_DOWNLOADS = int(os.environ.get("MEDIA_DOWNLOADS", "6"))
+MEDIA_DOWNLOADS_PER_BOT = int(os.environ.get("MEDIA_DOWNLOADS_PER_BOT", "2"))
+# Concurrent background downloads (prefetch, transcription) of a process, and of
+# each bot; they have their own slots, so they never hold up downloads of requests
+MEDIA_BACKGROUND_DOWNLOADS = int(os.environ.get("MEDIA_BACKGROUND_DOWNLOADS", "2"))
+MEDIA_BACKGROUND_DOWNLOADS_PER_BOT = int(os.environ.get("MEDIA_BACKGROUND_DOWNLOADS_PER_BOT", "1"))
+# Seconds a download waits for free space before it is rejected
+MEDIA_SCRATCH_WAIT = float(os.environ.get("MEDIA_SCRATCH_WAIT", "30"))
+
+# Space reserved for media whose size Telegram does not report
+UNKNOWN_SIZE = 20 * 1024 ** 2
+
+MEDIA_REJECTED = metrics.counter("media_rejected_total", "Media downloads refused by the scratch store", ["reason"])
+
+
+class MediaRejected(Exception):
+    """A download was refused; the message is meant for the user"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def _megabytes(size: int) -> str:
+    return f"{size / 1024 ** 2:.0f} МБ"
+
+
+class Reservation:
+    """Quota reserved for one download (see ScratchStore.download)"""
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+        self.path: Optional[str] = None
+
+    def keep(self, path: str):
+        """Keep the downloaded file; it is tracked until ScratchStore.release"""
+        self.path = path
+
+
+class ScratchStore:
+    """Quota, download limit and bookkeeping of the downloaded media files of a process"""
+
+    def __init__(self, root: str = MEDIA_SCRATCH_DIR, quota: int = SHARD_QUOTA,
+                 max_file_size: int = MEDIA_MAX_FILE_BYTES, downloads: int = MEDIA_DOWNLOADS,
+                 background_downloads: int = MEDIA_BACKGROUND_DOWNLOADS, wait: float = MEDIA_SCRATCH_WAIT):
+        """
+        Args:
+            root: Directory shared by all processes, each uses a subdirectory of it
+            quota: Bytes of files and running downloads a process may have
+            max_file_size: Larger files are rejected
+            downloads: Maximum number of concurrent downloads
+            background_downloads: Maximum number of concurrent background downloads (counted apart from downloads)
+            wait: Seconds a download waits for free space
+        """
+        self.root = root
+        self.quota = quota
+        self.max_file_size = max_file_size
+        self.wait = wait
+        self._slots = asyncio.Semaphore(max(1, downloads))
+        self._background_slots = asyncio.Semaphore(max(1, background_downloads))
+        # Tracked files (path -> size) and space reserved by running downloads
+        self._files: Dict[str, int] = {}
+        self._reserved = 0
+        self._freed = asyncio.Event()
+        self.downloading = 0
+
+    @property
+    def directory(self) -> str:
+        """Directory of this process"""
+        return os.path.join(self.root, str(os.getpid()))
+
+    @property
+    def used(self) -> int:
+        """Bytes of tracked files and running downloads"""
+        return sum(self._files.values()) + self._reserved
+
+    @property
+    def file_count(self) -> int:
+        return len(self._files)
+
+    def cleanup_orphans(self) -> int:
+        """
+        Remove media left behind by processes that are gone (called once at startup)
+
+        Subdirectories of running processes are kept; the one of this process
+        is emptied, as a restarted container may reuse the pid.
+
+        Returns:
+            Number of removed files
+        """
+        if not os.path.isdir(self.root):
+            return 0
+        removed = 0
+        for entry in os.scandir(self.root):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name.isdigit() and int(entry.name) != os.getpid() and _process_alive(int(entry.name)):
+                    continue
+                removed += sum(len(files) for _, _, files in os.walk(entry.path))
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                # Files directly in the root were written by older versions
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+                    removed += 1
+        if removed:
+            logging.info(f"Removed {removed} orphaned media file(s) from {self.root}")
+        return removed
+
+    def _reject(self, message: str, reason: str):
+        MEDIA_REJECTED.inc(reason=reason)
+        raise MediaRejected(message, reason)
+
+    async def _reserve(self, size: int):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait
+        while self.used + size > self.quota:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._reject("Недостаточно места для загрузки медиа, попробуйте позже", "quota")
+            self._freed.clear()
+            try:
+                await asyncio.wait_for(self._freed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        self._reserved += size
+
+    @contextlib.asynccontextmanager
+    async def download(self, size: Optional[int], background: bool = False) -> AsyncIterator[Reservation]:
+        """
+        Reserve space and a download slot for a file of the given size
+
+        Files that cannot fit are rejected right away, otherwise the download
+        waits for free space and a slot. The file passed to Reservation.keep
+        is tracked with its real size; without it the reservation is dropped.
+
+        Args:
+            size: File size reported by Telegram (None if unknown)
+            background: Take a background slot instead of one for requests
+
+        Raises:
+            MediaRejected: The file is too large or no space became free in time
+        """
+        expected = size or UNKNOWN_SIZE
+        if expected > self.max_file_size:
+            self._reject(f"Файл слишком большой ({_megabytes(expected)}, максимум {_megabytes(self.max_file_size)})", "too_large")
+        if expected > self.quota:
+            self._reject(f"Файл не помещается в хранилище медиа ({_megabytes(expected)})", "too_large")
+
+        await self._reserve(expected)
+        reservation = Reservation(self.directory, expected)
+        try:
+            async with self._background_slots if background else self._slots:
+                self.downloading += 1
+                try:
+                    os.makedirs(reservation.directory, exist_ok=True)
+                    yield reservation
+                finally:
+                    self.downloading -= 1
+        finally:
+            self._reserved -= expected
+            if reservation.path is not None:
+                try:
+                    self._files[reservation.path] = os.path.getsize(reservation.path)
+                except OSError:
+                    pass
+            self._freed.set()
+
+    def release(self, path: str):
+        """Remove a downloaded media file and stop tracking it"""
+        self._files.pop(path, None)
+        self._freed.set()
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+                logging.info(f"Removed local media file: {path}")
+            except Exception as e:
+                logging.error(f"Failed to remove local media file: {e}")
+
+    def cleanup(self):
+        """Remove all tracked media files that were not removed yet"""
+        for path in list(self._files):
+            self.release(path)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.directory)
+
+    def collect_metrics(self):
+        """Gauge samples for the metrics endpoint"""
+        yield "media_scratch_bytes", "Bytes of downloaded media and running downloads", {}, self.used
+        yield "media_scratch_files", "Downloaded media files not removed yet", {}, self.file_count
+        yield "media_downloads_active", "Media downloads in progress", {}, self.downloading
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Store of this process, shared by all bots
+STORE = ScratchStore()
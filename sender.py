@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from pyrogram.errors import FloodWait
+
+import metrics
+import tracing
+
+TELEGRAM_REQUEST_SECONDS = metrics.histogram(
+    "telegram_request_seconds", "Duration of outbound Telegram operations (without queueing)", ["op", "outcome"]
+)
+TELEGRAM_QUEUE_SECONDS = metrics.histogram("telegram_queue_seconds", "Time outbound operations wait in the queue", ["op"])
+TELEGRAM_FLOOD_WAITS = metrics.counter("telegram_flood_waits_total", "FloodWait errors received", ["op"])
+
+
+class TokenBucket:
+    """Simple token bucket rate limiter"""
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens (burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds to wait until a token is available (0 if one is available now)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Do not hand out tokens for the given number of seconds (used for FloodWait)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        """Whether the bucket is full again and not blocked, i.e. no different from a new one"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+@dataclass
+class _Op:
+    """Pending outbound operation"""
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    key: Optional[Hashable] = None
+    op: str = "send"
+    queued_at: float = field(default_factory=time.monotonic)
+    # Span of the submitting update, covering the queueing and the request itself
+    span: Any = None
+
+
+@dataclass
+class _ChatQueue:
+    """Outbound queue of a single chat"""
+    bucket: TokenBucket
+    ops: Deque[_Op] = field(default_factory=deque)
+    worker: Optional[asyncio.Task] = None
+
+
+class OutboundScheduler:
+    """
+    Outbound send scheduler for one Telegram client.
+
+    Every reply, edit and delete goes through a per-chat queue, so the order
+    of operations within a chat is preserved. Sends are throttled by a
+    per-chat and a global token bucket, FloodWait errors are waited out and
+    retried, and an edit of a message that is still waiting in the queue
+    replaces the pending edit instead of being sent separately. The rate
+    state of a chat outlives its queue: it is only dropped once the chat's
+    bucket is full again and no FloodWait is pending.
+    """
+
+    def __init__(self, name: str, global_rate: float = 25.0, per_chat_rate: float = 1.0,
+                 per_chat_burst: int = 3, max_flood_wait: int = 120, max_retries: int = 3):
+        """
+        Args:
+            name: Name used in log messages (usually the session name)
+            global_rate: Maximum number of operations per second across all chats
+            per_chat_rate: Sustained number of operations per second in a single chat
+            per_chat_burst: Number of operations a chat may send in a burst
+            max_flood_wait: Longest FloodWait (seconds) that is waited out instead of failing
+            max_retries: How many times an operation is retried after FloodWait
+        """
+        self.name = name
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_flood_wait = max_flood_wait
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = asyncio.Lock()
+        self._chats: Dict[int, _ChatQueue] = {}
+        # Rate limit state per chat, kept while the chat's queue is empty
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._buckets_pruned = time.monotonic()
+
+    # --- Public API ---
+
+    def reply(self, message, text: str, **kwargs) -> asyncio.Future:
+        """Queue a reply to a message. Returns a future resolving to the sent message."""
+        return self.submit(message.chat.id, lambda: message.reply(text, **kwargs), op="reply")
+
+    def edit(self, message, text: str, background: bool = False, **kwargs) -> asyncio.Future:
+        """
+        Queue an edit of a message. Returns a future resolving to the edited message.
+
+        If an edit of the same message is still waiting, it is replaced by this one.
+        With background=True the caller is not expected to await the result and
+        failures are only logged.
+        """
+        key = ("edit", message.chat.id, message.id)
+        future = self.submit(message.chat.id, lambda: message.edit_text(text, **kwargs), key=key, op="edit")
+        if background:
+            future.add_done_callback(self._log_failure)
+        return future
+
+    def delete(self, message) -> asyncio.Future:
+        """Queue deletion of a message; edits of it that are still waiting are dropped"""
+        chat = self._chats.get(message.chat.id)
+        if chat is not None:
+            edit_key = ("edit", message.chat.id, message.id)
+            for pending in chat.ops:
+                if pending.key == edit_key:
+                    # Skipped by the worker; callers of the edit see it cancelled
+                    pending.future.cancel()
+        key = ("delete", message.chat.id, message.id)
+        return self.submit(message.chat.id, lambda: message.delete(), key=key, op="delete")
+
+    def submit(self, chat_id: int, factory: Callable[[], Awaitable[Any]], key: Optional[Hashable] = None,
+               op: str = "send") -> asyncio.Future:
+        """
+        Queue an arbitrary outbound operation for a chat
+
+        Args:
+            chat_id: Chat the operation targets (used for ordering and rate limiting)
+            factory: Function creating the awaitable that performs the operation
+            key: Optional coalescing key; a pending operation with the same key is replaced
+            op: Operation name used in metrics
+
+        Returns:
+            Future resolving to the result of the operation
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatQueue(bucket=self._bucket(chat_id))
+            self._chats[chat_id] = chat
+
+        if key is not None:
+            for pending in chat.ops:
+                if pending.key == key and not pending.future.done():
+                    # Coalesce: only the latest content is sent, all callers get its result
+                    pending.factory = factory
+                    pending.op = op
+                    pending.span.set(coalesced=True)
+                    return pending.future
+
+        future = asyncio.get_running_loop().create_future()
+        span = tracing.span(f"telegram.{op}", chat_id=chat_id)
+        chat.ops.append(_Op(factory=factory, future=future, key=key, op=op, span=span))
+
+        if chat.worker is None or chat.worker.done():
+            chat.worker = asyncio.create_task(self._worker(chat_id, chat), context=tracing.detached_context())
+
+        return future
+
+    @property
+    def pending(self) -> int:
+        """Number of operations waiting to be sent"""
+        return sum(len(c.ops) for c in self._chats.values())
+
+    async def flush(self, timeout: Optional[float] = None):
+        """Wait until all queued operations are sent"""
+        workers = [c.worker for c in self._chats.values() if c.worker and not c.worker.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    # --- Internals ---
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        """Rate limit state of a chat, created on first use and dropped once idle"""
+        now = time.monotonic()
+        if now - self._buckets_pruned > 60:
+            self._buckets_pruned = now
+            for idle_chat in [c for c, bucket in self._buckets.items() if c not in self._chats and bucket.idle(now)]:
+                del self._buckets[idle_chat]
+
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _log_failure(self, future: asyncio.Future):
+        """Done callback for background operations"""
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f"[{self.name}] Background send failed: {future.exception()}")
+
+    async def _acquire(self, chat: _ChatQueue):
+        """Wait for both the chat and the global rate limit"""
+        while True:
+            wait = chat.bucket.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            async with self._global_lock:
+                wait = self._global.delay()
+                if wait <= 0:
+                    self._global.consume()
+                    chat.bucket.consume()
+                    return
+            await asyncio.sleep(wait)
+
+    async def _worker(self, chat_id: int, chat: _ChatQueue):
+        """Send queued operations of a chat in order"""
+        op: Optional[_Op] = None
+        try:
+            while chat.ops:
+                await self._acquire(chat)
+                op = chat.ops.popleft()
+
+                if op.future.done():
+                    op.span.end(asyncio.CancelledError())
+                    continue
+
+                queued = time.monotonic() - op.queued_at
+                TELEGRAM_QUEUE_SECONDS.observe(queued, bot=self.name, op=op.op)
+                op.span.set(queue_ms=round(queued * 1000, 1))
+
+                for attempt in range(self.max_retries + 1):
+                    started = time.perf_counter()
+                    try:
+                        result = await op.factory()
+                        TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, bot=self.name, op=op.op, outcome="ok")
+                        if not op.future.done():
+                            op.future.set_result(result)
+                        break
+                    except FloodWait as e:
+                        TELEGRAM_FLOOD_WAITS.inc(bot=self.name, op=op.op)
+                        wait = int(e.value or 1)
+                        if wait > self.max_flood_wait or attempt == self.max_retries:
+                            logging.error(f"[{self.name}] FloodWait of {wait}s in chat {chat_id}, giving up")
+                            if not op.future.done():
+                                op.future.set_exception(e)
+                            break
+                        logging.warning(f"[{self.name}] FloodWait of {wait}s in chat {chat_id}, waiting "
+                                        f"(attempt {attempt + 1}/{self.max_retries + 1})")
+                        chat.bucket.block(wait)
+                        await asyncio.sleep(wait)
+                    except Exception as e:
+                        TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, bot=self.name, op=op.op, outcome="error")
+                        if not op.future.done():
+                            op.future.set_exception(e)
+                        break
+
+                op.span.set(attempts=attempt + 1)
+                op.span.end(None if op.future.cancelled() else op.future.exception())
+                op = None
+        finally:
+            # The worker was cancelled (e.g. at shutdown): callers awaiting the
+            # operation in progress and the queued ones must not hang
+            pending = ([op] if op is not None else []) + list(chat.ops)
+            chat.ops.clear()
+            for pending_op in pending:
+                if not pending_op.future.done():
+                    pending_op.future.cancel()
+                    pending_op.span.end(asyncio.CancelledError())
+
+            if self._chats.get(chat_id) is chat and not chat.ops:
+                del self._chats[chat_id]
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import tracing
+
+SHARD_LOG_FORMAT = '%(asctime)s - %(levelname)s - %(processName)s - %(name)s - %(funcName)s - %(message)s'
+
+# Heartbeat settings (seconds)
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+HEALTH_REPORT_INTERVAL = 300
+
+# Delay before a crashed shard is started again (seconds)
+RESTART_DELAY = 5
+# Time given to shards to exit after SIGTERM before they are killed (seconds),
+# must be longer than the graceful shutdown timeout of the bots
+STOP_TIMEOUT = 30
+
+
+def shard_for(config: dict, shard_count: int) -> int:
+    """
+    Stable shard index for a bot
+
+    An explicit "shard" field in the bot config wins. Otherwise the index is
+    derived from the session name only, so a bot stays in the same shard
+    across restarts and config changes.
+    """
+    if isinstance(config.get("shard"), int):
+        return config["shard"] % shard_count
+    return zlib.crc32(config["session_name"].encode("utf-8")) % shard_count
+
+
+@dataclass
+class ShardState:
+    """Supervisor-side state of one worker process"""
+    index: int
+    process: Optional[multiprocessing.Process] = None
+    started_at: float = 0.0
+    last_heartbeat: float = 0.0
+    restarts: int = 0
+    restart_at: Optional[float] = None
+    finished: bool = False
+    info: dict = field(default_factory=dict)
+
+
+# --- Worker side ---
+
+def _worker_main(index: int, shard_count: int, log_queue, health_queue):
+    """Entry point of a worker process"""
+    # All log records go to the supervisor, which writes them with the shard name
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # Trace and bot attributes are added in the worker, where the context is known
+    tracing.install_log_context()
+
+    try:
+        asyncio.run(_run_shard(index, shard_count, health_queue))
+    except Exception as e:
+        logging.error(f"Shard {index} crashed: {e}", exc_info=True)
+        raise SystemExit(1)
+
+
+async def _run_shard(index: int, shard_count: int, health_queue):
+    """Run the bots assigned to this shard and report heartbeats"""
+    from main import CONFIG_PATH, BotManager, load_configs, run_bots
+    from metrics import METRICS_PORT
+
+    manager = BotManager(CONFIG_PATH, config_filter=lambda c: shard_for(c, shard_count) == index)
+    logging.info(f"Shard {index} started (pid {os.getpid()})")
+
+    heartbeat = asyncio.create_task(_heartbeat(index, manager, health_queue))
+    try:
+        # Shards stay up even without bots: a config reload may assign some later.
+        # run_bots returns after a graceful shutdown on SIGTERM (sent by the supervisor)
+        # Each shard serves its own metrics on METRICS_PORT + shard index
+        await run_bots(load_configs(), manager, metrics_port=METRICS_PORT + index if METRICS_PORT else 0)
+    finally:
+        heartbeat.cancel()
+
+
+async def _heartbeat(index: int, manager, health_queue):
+    """Periodically send shard health to the supervisor"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        # How late the event loop woke us up - a direct measure of CPU saturation
+        lag = time.monotonic() - started - HEARTBEAT_INTERVAL
+        health_queue.put({
+            "shard": index,
+            "pid": os.getpid(),
+            "bots": manager.status(),
+            "tasks": len(asyncio.all_tasks()),
+            "loop_lag": round(lag, 4),
+            "time": time.time(),
+        })
+
+
+# --- Supervisor side ---
+
+def _start_shard(ctx, state: ShardState, shard_count: int, log_queue, health_queue):
+    state.process = ctx.Process(
+        target=_worker_main,
+        args=(state.index, shard_count, log_queue, health_queue),
+        name=f"shard-{state.index}",
+    )
+    state.process.start()
+    state.started_at = time.monotonic()
+    state.last_heartbeat = state.started_at
+    state.restart_at = None
+    logging.info(f"Started shard {state.index} (pid {state.process.pid})")
+
+
+def _log_health(shards: Dict[int, ShardState]):
+    for state in shards.values():
+        if state.finished:
+            continue
+        alive = state.process is not None and state.process.is_alive()
+        info = state.info
+        bots = info.get("bots", {})
+        states = ", ".join(f"{name}={bot['state']}" for name, bot in sorted(bots.items()))
+        logging.info(
+            f"Shard {state.index}: {'alive' if alive else 'down'}, pid {info.get('pid')}, "
+            f"tasks {info.get('tasks')}, loop lag {info.get('loop_lag')}s, restarts {state.restarts}, "
+            f"bots: {states or 'none'}"
+        )
+
+
+def run_supervisor(shard_count: int) -> int:
+    """
+    Run bots from config.json in shard_count worker processes
+
+    Each worker runs its share of bots in its own event loop and watches
+    config.json for changes itself. The supervisor writes the log records of
+    all workers, forwards SIGTERM/SIGINT/SIGHUP to them, tracks their
+    heartbeats and restarts shards that crash.
+
+    Args:
+        shard_count: Number of worker processes
+
+    Returns:
+        Process exit code
+    """
+    from main import load_configs
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(tracing.log_formatter(SHARD_LOG_FORMAT))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+    logging.info(f"Starting Business Bot Service in sharded mode ({shard_count} shards)...")
+    os.makedirs("data", exist_ok=True)
+
+    # Validate the config once before any worker starts
+    configs = load_configs()
+    shard_count = max(1, min(shard_count, len(configs)))
+    # Number of shards actually started, inherited by the workers (e.g. to split the media quota)
+    os.environ["BOT_SHARD_COUNT"] = str(shard_count)
+
+    ctx = multiprocessing.get_context("spawn")
+    log_queue = ctx.Queue()
+    health_queue = ctx.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    shards = {i: ShardState(index=i) for i in range(shard_count)}
+    stopping = False
+
+    def on_signal(signum, _frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logging.info(f"Received signal {signum}, stopping shards...")
+        for state in shards.values():
+            if state.process is not None and state.process.is_alive():
+                state.process.terminate()
+
+    def on_reload(_signum, _frame):
+        logging.info("Received SIGHUP, forwarding config reload to shards")
+        for state in shards.values():
+            if state.process is not None and state.process.is_alive():
+                os.kill(state.process.pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, on_reload)
+
+    for state in shards.values():
+        _start_shard(ctx, state, shard_count, log_queue, health_queue)
+
+    last_report = time.monotonic()
+    stop_deadline: Optional[float] = None
+
+    while True:
+        try:
+            info = health_queue.get(timeout=1)
+            state = shards.get(info.get("shard"))
+            if state is not None:
+                state.info = info
+                state.last_heartbeat = time.monotonic()
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+
+        if stopping:
+            stop_deadline = stop_deadline or now + STOP_TIMEOUT
+            alive = [s for s in shards.values() if s.process is not None and s.process.is_alive()]
+            if not alive:
+                break
+            if now > stop_deadline:
+                for state in alive:
+                    logging.warning(f"Shard {state.index} did not stop in time, killing")
+                    state.process.kill()
+                break
+            continue
+
+        for state in shards.values():
+            if state.finished:
+                continue
+
+            if state.process is not None and not state.process.is_alive():
+                exitcode = state.process.exitcode
+                state.process.join()
+                state.process = None
+                if exitcode == 0:
+                    state.finished = True
+                    logging.info(f"Shard {state.index} finished")
+                    continue
+                state.restarts += 1
+                state.restart_at = now + RESTART_DELAY
+                logging.error(f"Shard {state.index} exited with code {exitcode}, restarting in {RESTART_DELAY}s")
+
+            if state.process is None and state.restart_at is not None and now >= state.restart_at:
+                _start_shard(ctx, state, shard_count, log_queue, health_queue)
+            elif state.process is not None and now - state.last_heartbeat > HEARTBEAT_TIMEOUT:
+                logging.warning(f"Shard {state.index} sent no heartbeat for {now - state.last_heartbeat:.0f}s")
+                state.last_heartbeat = now
+
+        if all(s.finished for s in shards.values()):
+            break
+
+        if now - last_report > HEALTH_REPORT_INTERVAL:
+            _log_health(shards)
+            last_report = now
+
+    for state in shards.values():
+        if state.process is not None:
+            state.process.join(timeout=5)
+
+    logging.info("All shards stopped")
+    listener.stop()
+    return 0
@@ -0,0 +1,274 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import metrics
+
+# Lightweight per-update tracing.
+#
+# The router starts a trace for every update it handles; code running on
+# behalf of the update opens spans with `with tracing.span("name"):` (sync
+# or async code, the current span lives in a context variable). Work that
+# continues in other tasks (request queue, outbound scheduler) keeps a
+# reference to its parent span, and a trace is finished once all of its
+# spans have ended. Finished traces are appended to TRACE_FILE as JSON lines
+# (one line per span) and slow ones are logged.
+
+# Append finished spans to this file as JSON lines (disabled if empty)
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+# Traces slower than this are logged with a per-stage breakdown (milliseconds)
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "3000"))
+# Write log records as JSON lines instead of plain text
+LOG_JSON = os.environ.get("LOG_JSON", "").lower() in ("1", "true", "yes")
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_file_lock = threading.Lock()
+_trace_file = None
+
+
+class _Trace:
+    """Spans of one update"""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.spans: List["Span"] = []
+        self.open = 0
+        # Spans already exported; spans started after the trace finished are exported separately
+        self.exported = 0
+
+    def span_ended(self):
+        self.open -= 1
+        if self.open == 0:
+            _export(self)
+
+
+class Span:
+    """
+    Timed stage of a trace
+
+    Used as a context manager it becomes the current span for the code in
+    the block; end() can also be called explicitly for spans that outlive
+    the block they were created in (queued work).
+    """
+
+    def __init__(self, trace: _Trace, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.id if parent else None
+        self.attributes = attributes
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._token = None
+        trace.spans.append(self)
+        trace.open += 1
+
+    def set(self, **attributes):
+        """Add attributes to the span"""
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = "cancelled" if isinstance(error, asyncio.CancelledError) else repr(error)
+        self.trace.span_ended()
+
+    def child(self, name: str, **attributes) -> "Span":
+        """Start a child span without making it current (end it with end())"""
+        return Span(self.trace, name, self, attributes)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.end(exc)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.id,
+            "span_id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "error": self.error,
+            **({"attributes": self.attributes} if self.attributes else {}),
+        }
+
+
+class _NoopSpan:
+    """Returned by span() outside of a trace, so instrumented code does not need to check"""
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def child(self, name: str, **attributes) -> "_NoopSpan":
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+# --- API ---
+
+def start_trace(name: str, **attributes) -> Span:
+    """Start a new trace and make its root span current (call inside the context the work runs in)"""
+    root = Span(_Trace(name), name, None, attributes)
+    _current.set(root)
+    return root
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def detached_context() -> contextvars.Context:
+    """Copy of the current context without the current span (for long-lived worker tasks)"""
+    context = contextvars.copy_context()
+    context.run(_current.set, None)
+    return context
+
+
+def span(name: str, parent: Optional[Span] = None, **attributes):
+    """
+    Child span of `parent` (default: the current span), or a no-op span if there is no trace
+
+    Use as a context manager; the span ends when the block exits.
+    """
+    parent = parent or _current.get()
+    if parent is None:
+        return _NOOP
+    return Span(parent.trace, name, parent, attributes)
+
+
+def traced(name: str):
+    """Decorator wrapping every call of a function (sync or async) in a span"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# --- Export ---
+
+def _export(trace: _Trace):
+    first_export = trace.exported == 0
+    spans = trace.spans
+    new_spans = spans[trace.exported:]
+    trace.exported = len(spans)
+
+    if TRACE_FILE:
+        _write_spans(new_spans)
+
+    root = spans[0]
+    end = max(s.start + (s.duration or 0) for s in spans)
+    total_ms = (end - root.start) * 1000
+    if first_export and total_ms >= TRACE_SLOW_MS:
+        stages: Dict[str, float] = {}
+        for s in spans[1:]:
+            stages[s.name] = stages.get(s.name, 0) + (s.duration or 0) * 1000
+        breakdown = ", ".join(f"{name} {ms:.0f} ms" for name, ms in sorted(stages.items(), key=lambda item: -item[1]))
+        logging.getLogger("tracing").info(
+            f"Slow trace {trace.id} ({trace.name}) took {total_ms:.0f} ms: {breakdown}",
+            extra={"duration_ms": round(total_ms, 1), "spans": [s.to_dict() for s in spans]},
+        )
+
+
+def _write_spans(spans: List[Span]):
+    global _trace_file
+    lines = "".join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in spans)
+    try:
+        with _file_lock:
+            if _trace_file is None:
+                _trace_file = open(TRACE_FILE, "a", encoding="utf-8")
+            _trace_file.write(lines)
+            _trace_file.flush()
+    except OSError as e:
+        logging.error(f"Failed to write spans to {TRACE_FILE}: {e}")
+
+
+# --- Logging ---
+
+def install_log_context():
+    """
+    Add trace_id, span_id and bot attributes to every log record
+
+    The attributes are taken when the record is created, so they survive
+    formatting in another thread or process (sharded mode).
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "_adds_trace_context", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        current = _current.get()
+        record.trace_id = current.trace.id if current else None
+        record.span_id = current.id if current else None
+        record.bot = metrics.current_bot.get() or None
+        return record
+
+    record_factory._adds_trace_context = True
+    logging.setLogRecordFactory(record_factory)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per log record, with trace context and any extra fields"""
+
+    STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.STANDARD_ATTRS and value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def log_formatter(text_format: str) -> logging.Formatter:
+    """JsonFormatter if LOG_JSON is set, otherwise a plain formatter with the given format"""
+    return JsonFormatter() if LOG_JSON else logging.Formatter(text_format)
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import re
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+import tracing
+from ai_service import GeminiError, GeminiModel, GeminiUsage, call_gemini_api, remove_media_file
+from database import Database, MessageImportance
+from utils import generate_tags
+
+# Transcribe incoming voice messages and video notes of whitelisted chats in the background
+AUTO_TRANSCRIBE = os.environ.get("AUTO_TRANSCRIBE", "").lower() in ("1", "true", "yes")
+# Concurrent transcription requests per bot
+TRANSCRIBE_WORKERS = int(os.environ.get("TRANSCRIBE_WORKERS", "2"))
+# Messages waiting for transcription per bot; newer ones are dropped when the queue is full
+TRANSCRIBE_QUEUE_SIZE = int(os.environ.get("TRANSCRIBE_QUEUE_SIZE", "100"))
+# Messages sent to Gemini in one request, and how long a worker waits to fill a batch (seconds)
+TRANSCRIBE_BATCH_SIZE = int(os.environ.get("TRANSCRIBE_BATCH_SIZE", "4"))
+TRANSCRIBE_BATCH_WINDOW = float(os.environ.get("TRANSCRIBE_BATCH_WINDOW", "2"))
+# Longer recordings are not transcribed (seconds)
+TRANSCRIBE_MAX_DURATION = int(os.environ.get("TRANSCRIBE_MAX_DURATION", "600"))
+
+TRANSCRIPTIONS = metrics.counter("transcriptions_total", "Voice messages and video notes processed by the transcriber", ["outcome"])
+TRANSCRIBE_BATCH = metrics.histogram("transcribe_batch_size", "Messages per transcription request", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+
+NO_SPEECH = "[без речи]"
+
+_SECTION = re.compile(r"^\s*#{2,}\s*(\d+)\s*$", re.MULTILINE)
+
+
+def _prompt(count: int) -> str:
+    if count == 1:
+        return f"Расшифруй аудиозапись дословно, на языке оригинала. Выведи только текст расшифровки без комментариев. Если речи нет, выведи {NO_SPEECH}."
+    return (
+        f"Расшифруй дословно каждую из {count} аудиозаписей, на языке оригинала, в порядке их следования. "
+        f"Для каждой записи выведи строку `### <номер записи>` (от 1 до {count}), а на следующих строках - только текст "
+        f"её расшифровки без комментариев. Если в записи нет речи, выведи {NO_SPEECH}."
+    )
+
+
+def parse_transcripts(response: str, count: int) -> Optional[List[str]]:
+    """
+    Split the answer to a batch request into transcripts
+
+    Returns:
+        One transcript per recording, or None if the answer does not have the expected sections
+    """
+    if count == 1 and not _SECTION.search(response):
+        return [response.strip()]
+
+    parts = _SECTION.split(response)
+    # parts = [text before the first section, number, text, number, text, ...]
+    sections: Dict[int, str] = {}
+    for number, text in zip(parts[1::2], parts[2::2]):
+        sections[int(number)] = text.strip()
+    if sorted(sections) != list(range(1, count + 1)):
+        return None
+    return [sections[i] for i in range(1, count + 1)]
+
+
+def _media(message):
+    return message.voice or getattr(message, "video_note", None)
+
+
+class _RequestFailed(Exception):
+    """The transcription request itself failed (as opposed to an answer that could not be split)"""
+
+
+@dataclass
+class _Job:
+    client: Any
+    message: Any
+
+
+class Transcriber:
+    """
+    Background transcription of voice messages and video notes of one bot
+
+    Messages are put in a bounded queue and processed by a few workers.
+    A worker takes up to `batch_size` messages (waiting at most
+    `batch_window` seconds for more to arrive), downloads them concurrently
+    and transcribes them with a single Gemini request. Transcripts are
+    stored as regular message rows, so later Gemini requests find them in
+    the chat history. If the answer to a batch cannot be split into
+    transcripts, its messages are retried one by one.
+    """
+
+    def __init__(self, name: str, db: Database, get_gemini_client: Callable[[], Any],
+                 download: Callable[[Any, Any], Awaitable[Optional[str]]],
+                 usage_recorder: Optional[Callable[[Any, str], Callable[[GeminiUsage], None]]] = None,
+                 workers: int = TRANSCRIBE_WORKERS, queue_size: int = TRANSCRIBE_QUEUE_SIZE,
+                 batch_size: int = TRANSCRIBE_BATCH_SIZE, batch_window: float = TRANSCRIBE_BATCH_WINDOW,
+                 max_duration: int = TRANSCRIBE_MAX_DURATION):
+        """
+        Args:
+            name: Name used in log messages (usually the session name)
+            db: Database the transcripts are stored in
+            get_gemini_client: Returns the Gemini client to use (looked up for every batch)
+            download: Coroutine function downloading the media of a message, called as download(client, message)
+            usage_recorder: Returns the on_usage callback for a message and request type
+            workers: Number of concurrent transcription requests
+            queue_size: Maximum number of messages waiting for transcription
+            batch_size: Maximum number of messages in one request
+            batch_window: Seconds a worker waits for more messages to fill a batch
+            max_duration: Recordings longer than this (seconds) are skipped
+        """
+        self.name = name
+        self.db = db
+        self.get_gemini_client = get_gemini_client
+        self.download = download
+        self.usage_recorder = usage_recorder
+        self.worker_count = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.max_duration = max_duration
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self._workers: List[asyncio.Task] = []
+
+    @staticmethod
+    def wants(message) -> bool:
+        """Whether a message has media the transcriber handles"""
+        return _media(message) is not None
+
+    def submit(self, client, message) -> bool:
+        """
+        Queue a voice message or video note for transcription
+
+        Returns:
+            False if the message was skipped (too long) or the queue is full
+        """
+        duration = getattr(_media(message), "duration", 0) or 0
+        if duration > self.max_duration:
+            TRANSCRIPTIONS.inc(outcome="too_long")
+            return False
+
+        try:
+            self._queue.put_nowait(_Job(client=client, message=message))
+        except asyncio.QueueFull:
+            TRANSCRIPTIONS.inc(outcome="dropped")
+            logging.warning(f"[{self.name}] Transcription queue is full, skipping message {message.id} in chat {message.chat.id}")
+            return False
+
+        if not self._workers:
+            context = tracing.detached_context()
+            self._workers = [asyncio.create_task(self._worker(), context=context) for _ in range(self.worker_count)]
+        return True
+
+    @property
+    def pending(self) -> int:
+        """Number of messages waiting for transcription"""
+        return self._queue.qsize()
+
+    async def stop(self):
+        """Cancel the workers; messages still in the queue are not transcribed"""
+        for task in self._workers:
+            task.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        dropped = self._queue.qsize()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        if dropped:
+            logging.info(f"[{self.name}] Dropped {dropped} pending transcription(s) on shutdown")
+
+    # --- Internals ---
+
+    async def _next_batch(self) -> List[_Job]:
+        """Wait for a job, then collect more for up to batch_window seconds"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._transcribe(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                TRANSCRIPTIONS.inc(len(batch), outcome="error")
+                logging.error(f"[{self.name}] Transcription of {len(batch)} message(s) failed: {e}", exc_info=True)
+
+    async def _transcribe(self, batch: List[_Job]):
+        results = await asyncio.gather(*(self.download(job.client, job.message) for job in batch), return_exceptions=True)
+        downloaded = []
+        for job, result in zip(batch, results):
+            if isinstance(result, Exception) or not result:
+                TRANSCRIPTIONS.inc(outcome="download_error")
+                logging.warning(f"[{self.name}] Could not download message {job.message.id} for transcription: {result}")
+            else:
+                downloaded.append((job, result))
+
+        try:
+            if not downloaded:
+                return
+            try:
+                transcripts = await self._request(downloaded)
+            except _RequestFailed:
+                # Retrying one by one would only add load to an API that is failing
+                transcripts = None
+            else:
+                if transcripts is None and len(downloaded) > 1:
+                    # Retry the messages of a batch whose answer could not be split, one by one
+                    logging.warning(f"[{self.name}] Could not split batch transcription of {len(downloaded)} messages, retrying one by one")
+                    transcripts = []
+                    for item in downloaded:
+                        try:
+                            single = await self._request([item])
+                        except _RequestFailed:
+                            break
+                        transcripts.append(single[0] if single else None)
+                    transcripts += [None] * (len(downloaded) - len(transcripts))
+
+            for (job, _), text in zip(downloaded, transcripts or [None] * len(downloaded)):
+                if text is None:
+                    TRANSCRIPTIONS.inc(outcome="error")
+                else:
+                    self._store(job.message, text)
+        finally:
+            for path in results:
+                if isinstance(path, str):
+                    remove_media_file(path)
+
+    def _usage_callback(self, items) -> Optional[Callable[[GeminiUsage], None]]:
+        """
+        on_usage callback of a batch request
+
+        A batch may hold recordings of several chats: the usage is split
+        between the chats by the length of their recordings and recorded
+        once per chat.
+        """
+        if self.usage_recorder is None:
+            return None
+        weights: Dict[int, float] = {}
+        messages: Dict[int, Any] = {}
+        for job, _ in items:
+            chat_id = job.message.chat.id
+            weights[chat_id] = weights.get(chat_id, 0) + max(1, getattr(_media(job.message), "duration", 0) or 0)
+            messages.setdefault(chat_id, job.message)
+
+        def record(usage: GeminiUsage):
+            total = sum(weights.values())
+            for chat_id, weight in weights.items():
+                share = weight / total
+                self.usage_recorder(messages[chat_id], "transcribe")(replace(
+                    usage,
+                    input_tokens=round(usage.input_tokens * share),
+                    cached_tokens=round(usage.cached_tokens * share),
+                    output_tokens=round(usage.output_tokens * share),
+                    thinking_tokens=round(usage.thinking_tokens * share),
+                ))
+        return record
+
+    async def _request(self, items) -> Optional[List[str]]:
+        """
+        Transcribe downloaded files with one Gemini call
+
+        Returns:
+            One transcript per file, or None if the answer could not be split
+
+        Raises:
+            _RequestFailed: Gemini returned an error
+        """
+        TRANSCRIBE_BATCH.observe(len(items))
+        response = await call_gemini_api(
+            self.get_gemini_client(),
+            _prompt(len(items)),
+            GeminiModel.FLASH,
+            media_paths=[path for _, path in items],
+            use_system_prompt=False,
+            on_usage=self._usage_callback(items),
+        )
+        if isinstance(response, GeminiError):
+            logging.warning(f"[{self.name}] Transcription request failed: {response}")
+            raise _RequestFailed(response)
+        return parse_transcripts(response, len(items))
+
+    def _store(self, message, text: str):
+        if not text or text == NO_SPEECH:
+            TRANSCRIPTIONS.inc(outcome="no_speech")
+            return
+        self.db.store_message(
+            chat_id=message.chat.id,
+            message_id=message.id,
+            author=message.from_user.first_name if message.from_user else "unknown",
+            date=message.date,
+            content=text,
+            tags=generate_tags(message),
+            importance=MessageImportance.DEFAULT,
+        )
+        TRANSCRIPTIONS.inc(outcome="ok")
@@ -59,6 +59,12 @@ def generate_tags(msg: Message) -> str:
 
     return ", ".join(tags)
 
+def _format_message_line(msg_id, author, date_str, content, tags, prefix: str = "") -> str:
+    date_formatted = datetime.datetime.fromisoformat(date_str).strftime('%Y-%m-%d %H:%M:%S')
+    if tags:
+        return f"{prefix}{msg_id} {date_formatted} {author} ({tags}): {content}"
+    return f"{prefix}{msg_id} {date_formatted} {author}: {content}"
+
 def format_chat_history(messages: List[Tuple]) -> str:
     """Format chat history for display and AI processing"""
     
@@ -71,14 +77,83 @@ def format_chat_history(messages: List[Tuple]) -> str:
         if important == "Gemini":
             author = "Gemini"
             
-        date_obj = datetime.datetime.fromisoformat(date_str)
-        date_formatted = date_obj.strftime('%Y-%m-%d %H:%M:%S')
+        lines.append(_format_message_line(msg_id, author, date_str, content, tags, i))
         
-        if tags:
-            line = f"{i}{msg_id} {date_formatted} {author} ({tags}): {content}"
+    return "\n".join(lines)
+
+PINS_HEADER = "Важные сообщения этого чата (закреплены):"
+PINS_ACK = "Понял, учту важные сообщения."
+HISTORY_CUT_NOTE = "(более ранние сообщения чата не показаны)"
+QUERY_PREFIX = "Текущий запрос пользователя: "
+
+def build_history_turns(messages: List[Tuple]) -> List[Tuple[str, str]]:
+    """
+    Build Gemini conversation turns from stored messages, without the query
+    
+    Pinned messages come first, as a user turn followed by a fixed model
+    acknowledgement, so the beginning of the prompt does not change between
+    requests of a chat (which allows implicit prefix caching). The history
+    follows as alternating turns: runs of chat messages become one user turn,
+    stored Gemini answers become model turns.
+    
+    Args:
+        messages: Rows of Database.get_last_messages (newest first)
+    
+    Returns:
+        List of (role, text) pairs with role "user" or "model"
+    """
+    pins = []
+    history = []
+    # Reverse to go from oldest to newest
+    for m in reversed(messages):
+        (pins if m[5] == "Important" else history).append(m)
+    
+    turns: List[Tuple[str, List[str]]] = []
+    if pins:
+        lines = [_format_message_line(msg_id, author, date_str, content, tags)
+                 for msg_id, author, date_str, content, tags, _ in pins]
+        turns.append(("user", [PINS_HEADER] + lines))
+        turns.append(("model", [PINS_ACK]))
+    # The pins section is never extended, so it stays the same
+    fixed = len(turns)
+    
+    for msg_id, author, date_str, content, tags, important in history:
+        if important == "Gemini":
+            role, text = "model", content.removeprefix("🎩")
         else:
-            line = f"{i}{msg_id} {date_formatted} {author}: {content}"
-            
-        lines.append(line)
+            role, text = "user", _format_message_line(msg_id, author, date_str, content, tags)
         
-    return "\n".join(lines)
\ No newline at end of file
+        if len(turns) > fixed and turns[-1][0] == role:
+            turns[-1][1].append(text)
+            continue
+        if role == "model" and (not turns or turns[-1][0] == "model"):
+            # Turns alternate, so an answer whose request fell out of the window needs a user turn before it
+            turns.append(("user", [HISTORY_CUT_NOTE]))
+        turns.append((role, [text]))
+    
+    return [(role, "\n".join(lines)) for role, lines in turns]
+
+def add_query(turns: List[Tuple[str, str]], query: str) -> List[Tuple[str, str]]:
+    """
+    Add the current request to turns built by build_history_turns
+    
+    The query is appended to the last user turn, or forms a new one. The
+    given list is not modified.
+    """
+    if turns and turns[-1][0] == "user":
+        return turns[:-1] + [("user", f"{turns[-1][1]}\n\n{QUERY_PREFIX}{query}")]
+    return turns + [("user", QUERY_PREFIX + query)]
+
+def build_conversation(messages: List[Tuple], query: str) -> List[Tuple[str, str]]:
+    """
+    Build Gemini conversation turns from stored messages and the current request
+    
+    Args:
+        messages: Rows of Database.get_last_messages (newest first)
+        query: Text of the current request
+    
+    Returns:
+        List of (role, text) pairs with role "user" or "model", ending with a user turn
+        (see build_history_turns and add_query)
+    """
+    return add_query(build_history_turns(messages), query)